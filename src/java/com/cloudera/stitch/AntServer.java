@@ -0,0 +1,250 @@
+// (c) Copyright 2009 Cloudera, Inc.
+//
+// AntServer: a resident ant process for the build script generated by
+// stitch (see the ant-server property in stitch-config.properties).
+//
+// Starting a JVM and loading ant's classes dominates the time taken by a
+// small build. The build script starts this server once, through ant's own
+// launcher so that it sees the same classpath as ant does:
+//
+//   ant -lib stitch-ant.jar -main com.cloudera.stitch.AntServer \
+//       <port file> <idle minutes>
+//
+// and then sends it its builds over a socket on the loopback interface.
+// The server writes "<port> <token>" to the port file; a client must send
+// the token first. A request is a series of lines: the token, the absolute
+// path of the build file, and then the arguments (-Dname=value properties
+// and target names), ending with an empty line. The build's output is sent
+// back in frames of the form "<length>\n<bytes>", followed by a last line
+// "=<exit status>".
+//
+// Each request is run in a new Project, parsed afresh from the build file:
+// ant's properties cannot be unset, so a project that has run one build
+// cannot be reused for the next. What the server saves is the JVM startup
+// and class loading, and the JIT-compiled parser.
+//
+// The server exits when it has been idle for the given number of minutes,
+// or when its port file is removed or taken over by another server.
+
+package com.cloudera.stitch;
+
+import java.io.BufferedOutputStream;
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.FileReader;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.net.SocketTimeoutException;
+import java.security.SecureRandom;
+import java.util.Properties;
+import java.util.Vector;
+
+import org.apache.tools.ant.DefaultLogger;
+import org.apache.tools.ant.DemuxOutputStream;
+import org.apache.tools.ant.Project;
+import org.apache.tools.ant.ProjectHelper;
+import org.apache.tools.ant.launch.AntMain;
+
+public class AntServer implements AntMain {
+
+  // how often (in ms) to check the port file and the idle time
+  private static final int POLL_INTERVAL = 5000;
+
+  private File portFile;
+  private String token;
+  private ClassLoader coreLoader;
+
+  public void startAnt(String[] args, Properties additionalUserProperties,
+      ClassLoader coreLoader) {
+    if (args.length != 2) {
+      System.err.println("Usage: AntServer <port file> <idle minutes>");
+      System.exit(1);
+    }
+
+    this.portFile = new File(args[0]);
+    this.coreLoader = coreLoader;
+    long idleLimit = Long.parseLong(args[1]) * 60L * 1000L;
+
+    try {
+      serve(idleLimit);
+    } catch (IOException ioe) {
+      System.err.println("AntServer: " + ioe);
+      System.exit(1);
+    }
+    System.exit(0);
+  }
+
+  private void serve(long idleLimit) throws IOException {
+    ServerSocket server = new ServerSocket(0, 50,
+        InetAddress.getByName("127.0.0.1"));
+    server.setSoTimeout(POLL_INTERVAL);
+    token = Long.toHexString(new SecureRandom().nextLong());
+    writePortFile(server.getLocalPort());
+
+    long lastUsed = System.currentTimeMillis();
+    try {
+      while (ownsPortFile()
+          && System.currentTimeMillis() - lastUsed < idleLimit) {
+        Socket client;
+        try {
+          client = server.accept();
+        } catch (SocketTimeoutException ste) {
+          continue;
+        }
+
+        try {
+          handle(client);
+        } catch (IOException ioe) {
+          // the client went away; wait for the next one.
+        } finally {
+          client.close();
+          lastUsed = System.currentTimeMillis();
+        }
+      }
+    } finally {
+      if (ownsPortFile()) {
+        portFile.delete();
+      }
+      server.close();
+    }
+  }
+
+  private void writePortFile(int port) throws IOException {
+    File tmpFile = new File(portFile.getPath() + ".tmp");
+    FileOutputStream out = new FileOutputStream(tmpFile);
+    try {
+      out.write((port + " " + token + "\n").getBytes("UTF-8"));
+    } finally {
+      out.close();
+    }
+    if (!tmpFile.renameTo(portFile)) {
+      throw new IOException("Could not write " + portFile);
+    }
+  }
+
+  /** @return true if the port file still names this server. */
+  private boolean ownsPortFile() {
+    try {
+      BufferedReader in = new BufferedReader(new FileReader(portFile));
+      try {
+        String line = in.readLine();
+        return line != null && line.endsWith(" " + token);
+      } finally {
+        in.close();
+      }
+    } catch (IOException ioe) {
+      return false;
+    }
+  }
+
+  private void handle(Socket client) throws IOException {
+    BufferedReader in = new BufferedReader(
+        new InputStreamReader(client.getInputStream(), "UTF-8"));
+    if (!token.equals(in.readLine())) {
+      return;
+    }
+
+    File buildFile = new File(in.readLine());
+    Vector args = new Vector();
+    String line = in.readLine();
+    while (line != null && line.length() > 0) {
+      args.add(line);
+      line = in.readLine();
+    }
+
+    OutputStream rawOut = client.getOutputStream();
+    PrintStream out = new PrintStream(
+        new BufferedOutputStream(new FrameOutputStream(rawOut)), true);
+    int status = runBuild(buildFile, args, out);
+    out.flush();
+    rawOut.write(("=" + status + "\n").getBytes("UTF-8"));
+    rawOut.flush();
+  }
+
+  /**
+   * Run the build the way ant's Main does, sending its output to 'out'.
+   * @return the exit status for the client.
+   */
+  private int runBuild(File buildFile, Vector args, PrintStream out) {
+    Project project = new Project();
+    project.setCoreLoader(coreLoader);
+
+    DefaultLogger logger = new DefaultLogger();
+    logger.setOutputPrintStream(out);
+    logger.setErrorPrintStream(out);
+    logger.setMessageOutputLevel(Project.MSG_INFO);
+    project.addBuildListener(logger);
+
+    PrintStream savedOut = System.out;
+    PrintStream savedErr = System.err;
+    Throwable error = null;
+    try {
+      // tasks that print directly still reach the client.
+      System.setOut(new PrintStream(new DemuxOutputStream(project, false)));
+      System.setErr(new PrintStream(new DemuxOutputStream(project, true)));
+
+      project.fireBuildStarted();
+      project.init();
+
+      Vector targets = new Vector();
+      for (int i = 0; i < args.size(); i++) {
+        String arg = (String) args.get(i);
+        if (arg.startsWith("-D")) {
+          int eq = arg.indexOf('=');
+          if (eq > 2) {
+            project.setUserProperty(arg.substring(2, eq),
+                arg.substring(eq + 1));
+          }
+        } else {
+          targets.add(arg);
+        }
+      }
+
+      project.setUserProperty("ant.file", buildFile.getAbsolutePath());
+      ProjectHelper.configureProject(project, buildFile);
+      if (targets.isEmpty()) {
+        targets.add(project.getDefaultTarget());
+      }
+      project.executeTargets(targets);
+    } catch (Throwable t) {
+      error = t;
+    } finally {
+      System.setOut(savedOut);
+      System.setErr(savedErr);
+      project.fireBuildFinished(error);
+      project.removeBuildListener(logger);
+    }
+
+    return error == null ? 0 : 1;
+  }
+
+  /** Sends each write to the client as a "<length>\n<bytes>" frame. */
+  private static class FrameOutputStream extends OutputStream {
+    private final OutputStream out;
+
+    FrameOutputStream(OutputStream out) {
+      this.out = out;
+    }
+
+    public void write(int b) throws IOException {
+      write(new byte[] { (byte) b }, 0, 1);
+    }
+
+    public void write(byte[] b, int off, int len) throws IOException {
+      if (len > 0) {
+        out.write((len + "\n").getBytes("UTF-8"));
+        out.write(b, off, len);
+      }
+    }
+
+    public void flush() throws IOException {
+      out.flush();
+    }
+  }
+}
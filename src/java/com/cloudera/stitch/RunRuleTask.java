@@ -0,0 +1,102 @@
+// (c) Copyright 2009 Cloudera, Inc.
+//
+// RunRuleTask: the <stitch-run rule="..." /> task, which runs a rule of the
+// project it is in, after the rules it depends on, skipping any rule that
+// an earlier <stitch-run> task has already run.
+//
+// With stitch-threads above 1, the top-level build, test and clean rules
+// that stitch generates run their targets' rules in <parallel> groups of
+// <stitch-run> tasks. Unlike <antcall>, these run in the same project, so
+// a rule sees the properties set by the rules it depends on, and the
+// top-level rule sees the "failed" property set by any of them. A rule
+// needed by tasks in several threads is run by the first to reach it; the
+// others wait for it to finish.
+
+package com.cloudera.stitch;
+
+import java.util.HashSet;
+import java.util.Set;
+import java.util.Vector;
+
+import org.apache.tools.ant.BuildException;
+import org.apache.tools.ant.Project;
+import org.apache.tools.ant.Target;
+import org.apache.tools.ant.Task;
+
+public class RunRuleTask extends Task {
+
+  // the project reference which holds the state of the rules
+  private static final String STATE_REFERENCE = "stitch.run-rule.state";
+
+  private String rule;
+
+  public void setRule(String rule) {
+    this.rule = rule;
+  }
+
+  public void execute() throws BuildException {
+    if (rule == null) {
+      throw new BuildException("stitch-run requires a rule attribute");
+    }
+
+    Project project = getProject();
+    RuleState state = getState(project);
+    Vector rules = project.topoSort(rule, project.getTargets(), false);
+    for (int i = 0; i < rules.size(); i++) {
+      state.run((Target) rules.get(i));
+    }
+  }
+
+  private static RuleState getState(Project project) {
+    synchronized (project) {
+      RuleState state = (RuleState) project.getReference(STATE_REFERENCE);
+      if (state == null) {
+        state = new RuleState();
+        project.addReference(STATE_REFERENCE, state);
+      }
+      return state;
+    }
+  }
+
+  /** The rules run, or being run, by the stitch-run tasks of a project. */
+  private static class RuleState {
+    private final Set done = new HashSet();
+    private final Set running = new HashSet();
+    private final Set failed = new HashSet();
+
+    void run(Target target) throws BuildException {
+      String name = target.getName();
+      synchronized (this) {
+        while (running.contains(name)) {
+          try {
+            wait();
+          } catch (InterruptedException ie) {
+            throw new BuildException("Interrupted waiting for " + name, ie);
+          }
+        }
+        if (failed.contains(name)) {
+          throw new BuildException("Rule " + name + " failed");
+        } else if (done.contains(name)) {
+          return;
+        }
+        running.add(name);
+      }
+
+      boolean succeeded = false;
+      try {
+        target.performTasks();
+        succeeded = true;
+      } finally {
+        synchronized (this) {
+          running.remove(name);
+          if (succeeded) {
+            done.add(name);
+          } else {
+            failed.add(name);
+          }
+          notifyAll();
+        }
+      }
+    }
+  }
+}
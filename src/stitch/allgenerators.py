@@ -9,5 +9,6 @@ from stitch.antgenerator import AntGenerator
 from stitch.buildgenerator import BuildGenerator
 from stitch.eclipsegen import EclipseGenerator
 from stitch.generator import *
+from stitch.parallelgenerator import ParallelGenerator
 
 
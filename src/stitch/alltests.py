@@ -5,12 +5,40 @@
 import sys
 import unittest
 
+import stitch.antgeneratortest as antgeneratortest
+import stitch.antservertest as antservertest
+import stitch.graphtest as graphtest
+import stitch.parallelgeneratortest as parallelgeneratortest
+import stitch.signoretest as signoretest
 import stitch.targets.packagetargettest as packagetargettest
+import stitch.targets.targettest as targettest
+import stitch.targets.thunkstest as thunkstest
 
 def testSuite():
   dir_comp_suite = unittest.makeSuite(packagetargettest.CopyDirTest, 'test')
+  ignore_trie_suite = unittest.makeSuite(signoretest.IgnoreTrieTest, 'test')
+  build_graph_suite = unittest.makeSuite(graphtest.BuildGraphTest, 'test')
+  thunk_cache_suite = unittest.makeSuite(thunkstest.ThunkCacheTest, 'test')
+  macro_suite = unittest.makeSuite(targettest.SubstituteMacrosTest, 'test')
+  rule_plan_suite = unittest.makeSuite(parallelgeneratortest.RulePlanTest,
+      'test')
+  parallel_build_suite = unittest.makeSuite(
+      parallelgeneratortest.ParallelBuildTest, 'test')
+  ant_server_suite = unittest.makeSuite(antservertest.AntServerTest, 'test')
+  stitch_run_suite = unittest.makeSuite(antgeneratortest.StitchRunTest, 'test')
+  server_jar_suite = unittest.makeSuite(antgeneratortest.AntServerJarTest,
+      'test')
 
   alltests = unittest.TestSuite([dir_comp_suite,
+                                 ignore_trie_suite,
+                                 build_graph_suite,
+                                 thunk_cache_suite,
+                                 macro_suite,
+                                 rule_plan_suite,
+                                 parallel_build_suite,
+                                 ant_server_suite,
+                                 stitch_run_suite,
+                                 server_jar_suite,
                                  ])
   return alltests
 
@@ -4,11 +4,25 @@
 # Targets and generate some output plans; e.g.,
 # ant-directed builds, Eclipse workspace generator, etc.
 
+from cStringIO import StringIO
 import os
+import shutil
+import tempfile
 
 import stitch.generator as generator
+import stitch.graph as graph
+import stitch.manifest as manifest
+import stitch.parsecache as parsecache
 import stitch.paths as paths
 import stitch.propstack as propstack
+import stitch.targets.thunks as thunks
+import stitch.util.fileutils as fileutils
+import stitch.util.xmlwriter as xmlwriter
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
 
 def unique(lst):
   """ uniquify a list of strings """
@@ -26,6 +40,147 @@ def getAntGenerator():
     antGenerator = AntGenerator()
   return antGenerator
 
+def resetAntGenerator():
+  """ discard the singleton ant generator, so that the next build generation
+      (e.g., in stitch --watch) starts from scratch """
+  global antGenerator
+  antGenerator = None
+
+
+# Number of worker processes that generate the targets' rules (stitch -j).
+# Each target's rules depend only on the (already resolved) targets, so
+# they can be generated in forked copies of this process. The results are
+# written out in the original order, so build.xml is the same either way.
+generationJobs = 1
+
+def setGenerationJobs(jobs):
+  global generationJobs
+  if multiprocessing == None:
+    jobs = 1
+  generationJobs = jobs
+
+def getGenerationJobs():
+  global generationJobs
+  return generationJobs
+
+
+# The targets being generated by the worker processes, which inherit this
+# list when they are forked.
+workTargets = None
+
+def generateTargetRules(index):
+  """ Worker function: generate the rules of workTargets[index]. Returns
+      the result of renderTarget(), or None if anything goes wrong; the
+      main process then generates the target itself, reporting any errors
+      in the usual way. """
+  try:
+    target = workTargets[index]
+    target.validate_arguments()
+    return renderTarget(target)
+  except:
+    return None
+
+
+# The FragmentCache consulted for each target's rules, or None.
+fragmentCache = None
+
+def setFragmentCache(cache):
+  global fragmentCache
+  fragmentCache = cache
+
+def getFragmentCache():
+  global fragmentCache
+  return fragmentCache
+
+
+def renderTarget(target):
+  """ Generate a target's fragment of build.xml: the tuple (preamble text
+      or None, ant rule map, list of rule texts). Returns the fragment and
+      the canonical names of the targets looked up to generate it. """
+  thunks.startRecordingReferences()
+  try:
+    preamble = None
+    if target.generates_preamble():
+      preamble = renderAntRule(target, "preamble")
+
+    rules = []
+    rule_map = target.get_ant_rule_map()
+    if rule_map != None:
+      for rule in unique(rule_map.values()):
+        rules.append(renderAntRule(target, rule))
+  finally:
+    references = thunks.stopRecordingReferences()
+  return ((preamble, rule_map, rules), references)
+
+
+# The build script's table of targets' ant rules, in ${outdir}.
+ANT_MAP_INDEX_FILENAME = "ant_map.index"
+
+# Where the resident ant server (see ant-server in stitch-config.properties)
+# advertises its port, in the stitch cache directory.
+ANT_SERVER_PORT_FILENAME = "antserver.port"
+
+
+# With the split-build-xml property set to true, build.xml is split up
+# so that ant need not parse the rules of the whole tree to build one
+# target. The rules of the targets in each directory go to a file of their
+# own in ${outdir}/ant, and build.xml just imports them. Each target also
+# gets an "entry" file there, importing only the files for the directories
+# of the targets it depends on; the build script runs ant on that instead
+# of build.xml when asked to build a single target.
+ANT_FILE_SUBDIR = "ant"
+DIRECTORY_FILE_SUFFIX = "targets.xml"
+ENTRY_FILE_SUFFIX = ".entry.xml"
+
+def isSplitBuildFile():
+  antprops = propstack.get_properties()
+  return antprops.getProperty("split-build-xml", "false") == "true"
+
+def getDirectoryAntFile(build_file):
+  """ return the name of the file in ${outdir}/ant that holds the rules of
+      the targets defined by 'build_file' """
+  safe_name = build_file.getSafeName()
+  if len(safe_name) == 0:
+    return DIRECTORY_FILE_SUFFIX
+  return safe_name + "." + DIRECTORY_FILE_SUFFIX
+
+
+# The top-level rules which, if stitch-threads is more than 1, run the
+# rules of targets that don't depend on one another in parallel.
+PARALLEL_PHASES = [ "build", "test", "clean" ]
+
+def getStitchThreads():
+  """ return the stitch-threads property: the number of threads the
+      top-level rules in PARALLEL_PHASES may run targets' rules in """
+  antprops = propstack.get_properties()
+  try:
+    return int(antprops.getProperty("stitch-threads", "1"))
+  except ValueError:
+    return 1
+
+
+def getStitchAntJar():
+  """ return the path to the jar holding stitch's ant extensions """
+  antprops = propstack.get_properties()
+  return antprops.getProperty("stitch-ant-jar", "")
+
+
+def useStitchRun():
+  """ return True if the top-level rules in PARALLEL_PHASES run targets'
+      rules in parallel with the <stitch-run> task: stitch-threads is more
+      than 1, and the jar with that task has been built. """
+  return getStitchThreads() > 1 and os.path.exists(getStitchAntJar())
+
+
+def renderAntRule(target, rule):
+  """ return the text target.writeAntRule() writes for 'rule' """
+  buf = StringIO()
+  writer = xmlwriter.XmlWriter(buf)
+  target.writeAntRule(writer, rule)
+  writer.flush()
+  return buf.getvalue()
+
+
 class AntGenerator(generator.Generator):
   """ Generates a build.xml file in the current directory
       suitable for building all Java and Jar-based targets
@@ -65,6 +220,11 @@ class AntGenerator(generator.Generator):
     # Set to true if there are any python rules.
     self.has_python = False
 
+    # With split-build-xml: the files written to ${outdir}/ant, and a map
+    # from each target's ant rules to the entry file that defines them.
+    self.ant_files = {}
+    self.entry_files = {}
+
 
   def ensureHandle(self):
     if self.handle == None:
@@ -77,11 +237,16 @@ class AntGenerator(generator.Generator):
 
       if not os.path.exists(build_outputs_dir):
         os.mkdir(build_outputs_dir)
-      self.handle = open(os.path.join(build_outputs_dir, "build.xml"), "w")
+
+      # Write to a temp file; build.xml is only replaced if it changed.
+      self.filename = os.path.join(build_outputs_dir, "build.xml")
+      self.handle = open(self.filename + ".tmp", "w")
 
   def closeHandle(self):
     if self.handle != None:
       self.handle.close()
+      self.handle = None
+      fileutils.replace_if_changed(self.filename + ".tmp", self.filename)
 
   def add_to_phase(self, phase, target_mapping):
     """
@@ -100,52 +265,94 @@ class AntGenerator(generator.Generator):
 
   def generate(self, allTargets):
 
-    rule_text = ""
-    public_text = ""
-    preamble_text = ""
+    # The top-level rules come first in build.xml, but they can't be
+    # written until every target has added to the phase lists. The
+    # targets' rules are spooled to temporary files in the meantime.
+    rule_spool = tempfile.TemporaryFile()
+    preamble_spool = tempfile.TemporaryFile()
+    rule_writer = xmlwriter.XmlWriter(rule_spool)
+    preamble_writer = xmlwriter.XmlWriter(preamble_spool)
+    public_text = []
+    self.target_levels = None
 
     try:
       # Clear isGenerated marks for this generator.
       for target in allTargets:
         target.clearGenerated()
 
-      # Now do actual generation.
+      # prevent redundant generation of rules for targets w/ multiple names
+      work = []
       for target in allTargets:
-        # prevent redundant generation of rules for targets w/ multiple names
-        if target.isGenerated():
-          continue
-
-        if target.generatesAntRules():
+        if not target.isGenerated() and target.generatesAntRules():
           target.markAsGenerated()
-          target.validate_arguments()
-
-          if target.language() == "python":
-            self.has_python = True
-
-          if target.generates_preamble():
-            # Grab the special preamble rule text.
-            preamble_text = preamble_text + target.antRule("preamble")
+          work.append(target)
+
+      # Reuse the fragments of targets that haven't changed, and have the
+      # workers (if any) generate the rest.
+      fragmentCache = getFragmentCache()
+      fragments = [ None ] * len(work)
+      if fragmentCache != None:
+        fragmentCache.compute_fingerprints(work)
+        for i in range(len(work)):
+          fragments[i] = fragmentCache.lookup(work[i])
+
+      missing = [ i for i in range(len(work)) if fragments[i] == None ]
+      results = self.generateInWorkers([ work[i] for i in missing ])
+      for j in range(len(missing)):
+        if results[j] != None:
+          (fragment, references) = results[j]
+          fragments[missing[j]] = fragment
+          if fragmentCache != None:
+            fragmentCache.store(work[missing[j]], fragment, references)
 
-          # get a map from phase |--> rulename for this target
-          my_rule_map = target.get_ant_rule_map()
-          if my_rule_map != None:
-            for rule in unique(my_rule_map.values()):
-              rule_text = rule_text + target.antRule(rule)
-
-            for phase in my_rule_map.keys():
-              # add the entries in this target's rule_map to the
-              # list associated with the complete rule map
-              tuple = (target.getCanonicalName(), my_rule_map[phase])
-              self.add_to_phase(phase, tuple)
+      # Now do actual generation.
+      rule_maps = [ None ] * len(work)
+      if isSplitBuildFile():
+        for (filename, indices) in self.groupByDirectory(work):
+          # each directory's rules are written to a file of their own.
+          dir_preamble = StringIO()
+          dir_rules = StringIO()
+          dir_preamble_writer = xmlwriter.XmlWriter(dir_preamble)
+          dir_rule_writer = xmlwriter.XmlWriter(dir_rules)
+          for i in indices:
+            rule_maps[i] = self.emitTarget(work[i], fragments[i],
+                dir_preamble_writer, dir_rule_writer)
+          dir_preamble_writer.flush()
+          dir_rule_writer.flush()
+          self.writeAntFile(filename, [
+              self.projectHeader(filename[:-len(".xml")], "../.."),
+              dir_preamble.getvalue(), dir_rules.getvalue(),
+              self.antFooter() ])
+      else:
+        for i in range(len(work)):
+          rule_maps[i] = self.emitTarget(work[i], fragments[i],
+              preamble_writer, rule_writer)
+
+      for i in range(len(work)):
+        target = work[i]
+        my_rule_map = rule_maps[i]
+
+        if target.language() == "python":
+          self.has_python = True
+
+        if my_rule_map != None:
+          for phase in my_rule_map.keys():
+            # add the entries in this target's rule_map to the
+            # list associated with the complete rule map
+            tuple = (target.getCanonicalName(), my_rule_map[phase])
+            self.add_to_phase(phase, tuple)
 
       # we handle cleaning of all python all-at-once with a rule
-      # inserted by the generator, not the targets themselves.
+      # inserted by the generator, not the targets themselves. There is
+      # only a python-build rule if some target (unlike VerStringTarget)
+      # added to that phase.
       if self.has_python:
         tuple = ("___special_no_target", "python-clean")
         self.add_to_phase("clean", tuple)
 
-        tuple = ("___special_no_target", "python-build")
-        self.add_to_phase("build", tuple)
+        if self.rule_map.has_key("python-build"):
+          tuple = ("___special_no_target", "python-build")
+          self.add_to_phase("build", tuple)
 
       # the top-level production rules also depend on the init rule;
       # this must run first. (it will force a new stitch if needed)
@@ -155,32 +362,225 @@ class AntGenerator(generator.Generator):
 
       # now generate the top-level rules that depend on all the
       # specific instances.
+      if useStitchRun():
+        self.target_levels = self.getDependencyLevels(allTargets)
+      elif getStitchThreads() > 1:
+        print "Warning: " + getStitchAntJar() + " has not been built;" \
+            + " ignoring stitch-threads."
       for phase in self.rule_map.keys():
-        public_text = public_text + self.generate_phase(phase)
+        public_text.append(self.generate_phase(phase))
+
+      public_text.append("\n\n<!-- private targets follow -->\n\n")
+
+      if isSplitBuildFile():
+        self.writeSplitBuildFiles(work, rule_maps, public_text)
+
+    finally:
+      try:
+        if rule_writer.length > 0:
+          rule_writer.flush()
+          preamble_writer.flush()
+          self.ensureHandle()
+          self.handle.write(self.antHeader())
+          self.handle.write(self.stitchRule())
+          self.handle.write(self.release_version_rule())
+          self.handle.write("".join(public_text))
+          for spool in [ preamble_spool, rule_spool ]:
+            spool.seek(0)
+            shutil.copyfileobj(spool, self.handle)
+          self.handle.write(self.antFooter())
+          self.closeHandle()
+      finally:
+        rule_spool.close()
+        preamble_spool.close()
+
+
+  def emitTarget(self, target, fragment, preamble_writer, rule_writer):
+    """ Write the preamble and rules of 'target' (or its cached fragment,
+        if not None) to the given writers. Returns its map from phase to
+        ant rule. """
+    if fragment == None:
+      # generate it here.
+      target.validate_arguments()
+
+      fragmentCache = getFragmentCache()
+      if fragmentCache != None:
+        (fragment, references) = renderTarget(target)
+        fragmentCache.store(target, fragment, references)
+
+    if fragment == None:
+      if target.generates_preamble():
+        # Grab the special preamble rule text.
+        target.writeAntRule(preamble_writer, "preamble")
+
+      # get a map from phase |--> rulename for this target
+      my_rule_map = target.get_ant_rule_map()
+      if my_rule_map != None:
+        for rule in unique(my_rule_map.values()):
+          target.writeAntRule(rule_writer, rule)
+    else:
+      (preamble, my_rule_map, rules) = fragment
+      if preamble != None:
+        preamble_writer.write(preamble)
+      for text in rules:
+        rule_writer.write(text)
+
+    return my_rule_map
+
+
+  def getPhaseRules(self):
+    """ return the map from each phase to the (canonical target name,
+        rule) pairs of the rules it depends on, for the build last
+        generated. Shared rules (e.g., init) have no target name. """
+    return self.rule_map
+
+
+  def groupByDirectory(self, work):
+    """ Return a list of (ant file name, indices into 'work') with one
+        entry for each directory that defines targets in 'work', in the
+        order the directories are first seen. """
+    groups = []
+    indices_for_file = {}
+    for i in range(len(work)):
+      filename = getDirectoryAntFile(work[i].getBuildFile())
+      if not indices_for_file.has_key(filename):
+        indices_for_file[filename] = []
+        groups.append((filename, indices_for_file[filename]))
+      indices_for_file[filename].append(i)
+    return groups
+
+
+  def writeSplitBuildFiles(self, work, rule_maps, public_text):
+    """ With split-build-xml set, the rules of each directory's targets
+        have already been written to ${outdir}/ant/*.targets.xml. Write
+        the definitions they share to ant/common.xml, a build.xml which
+        imports all of them, and for each target an ant/*.entry.xml which
+        imports only the directories its rules may need. Then remove the
+        files left in ant/ by earlier runs. """
+
+    dir_files = unique([ getDirectoryAntFile(target.getBuildFile())
+        for target in work ])
+    dir_order = {}
+    for i in range(len(dir_files)):
+      dir_order[dir_files[i]] = i
+
+    self.writeAntFile("common.xml", [ self.projectHeader("common", "../.."),
+        self.commonDefinitions(), self.stitchRule(),
+        self.release_version_rule(), self.antFooter() ])
+
+    root_text = [ self.projectHeader("world", ".."),
+        "  <import file=\"ant/common.xml\" />\n" ]
+    root_text.extend(public_text)
+    for filename in dir_files:
+      root_text.append("  <import file=\"ant/" + filename + "\" />\n")
+    root_text.append(self.antFooter())
+    self.ensureHandle()
+    self.handle.write("".join(root_text))
+    self.closeHandle()
+
+    # the directories whose files each target's rules may need: its own,
+    # and those of everything it depends on.
+    closures = {}
+    buildGraph = graph.getBuildGraph()
+    for target in buildGraph.topologicalOrder():
+      closure = { getDirectoryAntFile(target.getBuildFile()) : True }
+      for dep in buildGraph.getDependencies(target):
+        closure.update(closures[dep])
+      closures[target] = closure
+
+    self.entry_files = {}
+    for i in range(len(work)):
+      target = work[i]
+      if rule_maps[i] == None:
+        continue
+
+      filename = target.getSafeName() + ENTRY_FILE_SUFFIX
+      closure = closures.get(target)
+      if closure == None:
+        closure = { getDirectoryAntFile(target.getBuildFile()) : True }
+      imports = [ f for f in closure.keys() if dir_order.has_key(f) ]
+      imports.sort(key=lambda f: dir_order[f])
+
+      text = [ self.projectHeader(filename[:-len(".xml")], "../.."),
+          "  <import file=\"common.xml\" />\n" ]
+      for dir_file in imports:
+        text.append("  <import file=\"" + dir_file + "\" />\n")
+      text.append(self.antFooter())
+      self.writeAntFile(filename, text)
+
+      for rule in rule_maps[i].values():
+        self.entry_files[rule] = filename
+
+    self.removeStaleAntFiles()
+
+
+  def getAntFileDir(self):
+    """ return the directory that split-build-xml files are written to """
+    antprops = propstack.get_properties()
+    build_outputs_dir = antprops.getProperty("outsubdir", "build")
+    return os.path.join(build_outputs_dir, ANT_FILE_SUBDIR)
 
-      public_text = public_text + "\n\n<!-- private targets follow -->\n\n"
 
+  def writeAntFile(self, filename, text):
+    """ write the list of strings 'text' to 'filename' in the ant/
+        subdirectory of the build outputs. The file is only replaced if
+        its contents change. """
+    ant_dir = self.getAntFileDir()
+    if not os.path.exists(ant_dir):
+      os.makedirs(ant_dir)
+
+    path = os.path.join(ant_dir, filename)
+    handle = open(path + ".tmp", "w")
+    try:
+      handle.write("".join(text))
     finally:
-      if len(rule_text) > 0:
-        self.ensureHandle()
-        self.handle.write(self.antHeader())
-        self.handle.write(self.stitchRule())
-        self.handle.write(self.release_version_rule())
-        self.handle.write(public_text)
-        self.handle.write(preamble_text)
-        self.handle.write(rule_text)
-        self.handle.write(self.antFooter())
-        self.closeHandle()
+      handle.close()
+    fileutils.replace_if_changed(path + ".tmp", path)
+    self.ant_files[filename] = True
+
+
+  def removeStaleAntFiles(self):
+    """ delete the files in ant/ that were not written by this run """
+    ant_dir = self.getAntFileDir()
+    for filename in os.listdir(ant_dir):
+      if filename.endswith(".xml") and not self.ant_files.has_key(filename):
+        os.remove(os.path.join(ant_dir, filename))
+
+
+  def generateInWorkers(self, work):
+    """ Generate the rules of the targets in 'work' in a pool of worker
+        processes (see setGenerationJobs()). Returns a list, parallel to
+        'work', of the results of generateTargetRules() (None for targets
+        the caller must generate itself). """
+    global workTargets
+
+    jobs = getGenerationJobs()
+    if jobs < 2 or len(work) < 2:
+      return [ None ] * len(work)
+
+    workTargets = work
+    pool = multiprocessing.Pool(jobs)
+    try:
+      chunksize = max(1, len(work) / (jobs * 4))
+      return pool.map(generateTargetRules, range(len(work)), chunksize)
+    finally:
+      pool.close()
+      pool.join()
+      workTargets = None
+
 
   def stitchRule(self):
     """ returns a rule that runs stitch if one of the Targets files
-        has been updated since this build.xml file """
+        has been updated since this build.xml file. The build script
+        defines stitch.up-to-date itself if the files in the manifest
+        (see stitch.manifest) are unchanged, so that ant need not scan
+        the tree for them. """
 
     # lazy import to defeat circularity.
     import stitch.buildfile as buildfile
 
     text = """
-<target name="stitch-uptodate">
+<target name="stitch-uptodate" unless="stitch.up-to-date">
   <uptodate property="stitch.up-to-date" targetfile="${outdir}/build.xml">
     <srcfiles dir="${basedir}">
       <include name="%(targetsfile)s" />
@@ -225,11 +625,12 @@ class AntGenerator(generator.Generator):
   </if>
 </target>
 """
-  def getBuildScriptMap(self, allTargets):
-    """ given all Target objects, map their canonical name to the
-        build script name. """
+  def getAntMapEntries(self, allTargets):
+    """ given all Target objects, return the list of (phase, name, ant_rule)
+        entries for the build script's lookup table. Each target is listed
+        under all the names the user may use for it. """
 
-    text = ""
+    entries = []
 
     for target in allTargets:
       if target.generatesAntRules():
@@ -251,39 +652,107 @@ class AntGenerator(generator.Generator):
           # no colon; just tack the slash on the end
           trail_slash_target = target_name + os.sep
 
-        # Emit the lookup table entries.
         for phase in ant_map.keys():
           ant_rule = ant_map[phase]
-          text = text + """
-ant_map[("%(phase)s", "%(target)s")] = "%(ant_rule)s"
-ant_map[("%(phase)s", "%(trail_slash_target)s")] = "%(ant_rule)s"
-ant_map[("%(phase)s", "//%(target)s")] = "%(ant_rule)s"
-ant_map[("%(phase)s", "//%(trail_slash_target)s")] = "%(ant_rule)s"
-""" % { "phase" : phase,
-        "target" : target_name,
-        "trail_slash_target" : trail_slash_target,
-        "ant_rule" : ant_rule }
+          entries.append((phase, target_name, ant_rule))
+          entries.append((phase, trail_slash_target, ant_rule))
+          entries.append((phase, "//" + target_name, ant_rule))
+          entries.append((phase, "//" + trail_slash_target, ant_rule))
 
-    return text
+    return entries
 
 
+  def getAntServerJar(self):
+    """ return the jar holding the resident ant server the build script
+        should use, or "" if the ant-server property is not set or the
+        jar has not been built. """
+    antprops = propstack.get_properties()
+    if antprops.getProperty("ant-server", "false") != "true":
+      return ""
+    if not os.path.exists(getStitchAntJar()):
+      print "Warning: " + getStitchAntJar() + " has not been built;" \
+          + " ignoring ant-server."
+      return ""
+    return getStitchAntJar()
+
+
+  def writeAntMapIndex(self, allTargets):
+    """ write the build script's lookup table to ${outdir}/ant_map.index.
+        It is only used by the build script if the stitch server (see
+        stitch.server) cannot answer for it.
+
+        Each line of the file is a key and a value separated by a tab, and
+        the lines are sorted by key, so the build script can binary search
+        the file for the key it wants instead of loading the whole table.
+        Keys are of two kinds:
+
+          "a<TAB>phase<TAB>target name" -- the value is the target's ant
+              rule for that phase;
+          "e<TAB>ant rule" -- the value is the entry file to run the rule
+              from, if build.xml is split (see split-build-xml).
+    """
+
+    antprops = propstack.get_properties()
+    build_dir = antprops.getProperty("outsubdir", "build")
+
+    records = {}
+    for (phase, target_name, ant_rule) in self.getAntMapEntries(allTargets):
+      records["a\t" + phase + "\t" + target_name] = ant_rule
+    for rule in self.entry_files.keys():
+      records["e\t" + rule] = os.path.join(build_dir, ANT_FILE_SUBDIR,
+          self.entry_files[rule])
+
+    keys = records.keys()
+    keys.sort()
+    lines = [ key + "\t" + records[key] + "\n" for key in keys ]
+
+    if not os.path.exists(build_dir):
+      os.mkdir(build_dir)
+    filename = os.path.join(build_dir, ANT_MAP_INDEX_FILENAME)
+    handle = open(filename + ".tmp", "w")
+    try:
+      handle.write("".join(lines))
+    finally:
+      handle.close()
+    fileutils.replace_if_changed(filename + ".tmp", filename)
 
 
   def antHeader(self):
     """ return the preamble at the top of the build.xml file """
+    return self.projectHeader("world", "..") + self.commonDefinitions()
 
-    stitch_home = propstack.get_stitch_home()
-    stitch_props = os.path.join(stitch_home, "etc/stitch-config.properties")
 
-    text = """<!-- (c) Copyright 2009 Cloudera, Inc. -->
+  def projectHeader(self, name, basedir):
+    """ return the opening of a generated ant file, up to and including
+        its <project> element """
+
+    return """<!-- (c) Copyright 2009 Cloudera, Inc. -->
 <!-- ******* AUTOGENERATED *******
      DO NOT MODIFY THIS FILE - Recreate with stitch
      Note: While it is possible to run ant directly on this
      file, the recommended method to build targets is via
      the build script in the srcroot (one level up from here)
 -->
-<project name="world" default="default" basedir="..">
-  <property name="stitch-home" value="%(stitchhome)s" />
+<project name="%(name)s" default="default" basedir="%(basedir)s">
+""" % { "name"    : name,
+        "basedir" : basedir }
+
+
+  def commonDefinitions(self):
+    """ return the properties, task definitions and rules that every
+        target's rules may rely upon """
+
+    stitch_home = propstack.get_stitch_home()
+    stitch_props = os.path.join(stitch_home, "etc/stitch-config.properties")
+
+    stitch_tasks = ""
+    if useStitchRun():
+      stitch_tasks = """  <taskdef name="stitch-run"
+    classname="com.cloudera.stitch.RunRuleTask"
+    classpath="${stitch-ant-jar}" />
+"""
+
+    text = """  <property name="stitch-home" value="%(stitchhome)s" />
   <property file="my.properties" />
   <property file="build.properties" />
   <property file="%(stitchprops)s" />
@@ -305,7 +774,7 @@ ant_map[("%(phase)s", "//%(trail_slash_target)s")] = "%(ant_rule)s"
     classpath="${stitch-java-libs}/AntelopeTasks_3.4.5.jar" />
   <taskdef resource="cpptasks.tasks"
     classpath="${stitch-java-libs}/cpptasks.jar" />
-
+%(stitchtasks)s
   <!-- macros -->
 
   <!--
@@ -344,7 +813,8 @@ ant_map[("%(phase)s", "//%(trail_slash_target)s")] = "%(ant_rule)s"
   <!-- init rule: everything depends on init so that it runs first -->
   <target name="init" depends="stitch-refresh" />
 """ % { "stitchprops" : stitch_props,
-        "stitchhome"  : stitch_home }
+        "stitchhome"  : stitch_home,
+        "stitchtasks" : stitch_tasks }
 
     if self.has_python:
       text = text + """
@@ -370,21 +840,26 @@ ant_map[("%(phase)s", "//%(trail_slash_target)s")] = "%(ant_rule)s"
         depend on a series of lower-level rules """
 
 
-    str = "<target name=\"" + phase + "\" depends=\""
-    first = True
     if self.rule_map.has_key(phase + "-inner"):
       # top-level target depends on the "inner" production rule
       lookup_phase = phase + "-inner"
     else:
       lookup_phase = phase
 
-    for (target, dep) in self.rule_map[lookup_phase]:
-      if not first:
-        str = str + ","
-      first = False
-      str = str + dep
-    str = str + "\"\n"
-    str = str + "description=\"\">\n"
+    if self.target_levels != None and phase in PARALLEL_PHASES:
+      str = "<target name=\"" + phase + "\"\n"
+      str = str + "description=\"\">\n"
+      str = str + self.parallelRuleGroups(self.rule_map[lookup_phase])
+    else:
+      str = "<target name=\"" + phase + "\" depends=\""
+      first = True
+      for (target, dep) in self.rule_map[lookup_phase]:
+        if not first:
+          str = str + ","
+        first = False
+        str = str + dep
+      str = str + "\"\n"
+      str = str + "description=\"\">\n"
 
     # special-case handling for some phases is done here:
     if phase == "test" or phase == "python-test":
@@ -402,6 +877,67 @@ ant_map[("%(phase)s", "//%(trail_slash_target)s")] = "%(ant_rule)s"
     str = str + "</target>\n"
     return str
 
+  def getDependencyLevels(self, allTargets):
+    """ return a map from the canonical name of each target to its level:
+        0 if it requires no other targets, and otherwise one more than the
+        highest level of those it requires. Targets at the same level do
+        not depend on one another. """
+    buildGraph = graph.getBuildGraph()
+    if buildGraph == None:
+      buildGraph = graph.BuildGraph(allTargets)
+
+    levels = {}
+    levelOfTarget = {}
+    for target in buildGraph.topologicalOrder():
+      level = 0
+      for dep in buildGraph.getDependencies(target):
+        level = max(level, levelOfTarget[dep] + 1)
+      levelOfTarget[target] = level
+      levels[target.getCanonicalName()] = level
+    return levels
+
+
+  def parallelRuleGroups(self, entries):
+    """ return the body of a top-level rule which runs the ant rules in
+        'entries', a list of (target name, rule) pairs, with <stitch-run>
+        tasks: first init, then the targets' rules, a level at a time (see
+        getDependencyLevels()) with the rules in each level run in
+        parallel, and then any other shared rules. """
+
+    first = []
+    last = []
+    levels = {}
+    for (target, rule) in entries:
+      if rule == "init":
+        first.append(rule)
+      elif self.target_levels.has_key(target):
+        level = self.target_levels[target]
+        if not levels.has_key(level):
+          levels[level] = []
+        if not rule in levels[level]:
+          levels[level].append(rule)
+      else:
+        last.append(rule)
+
+    text = ""
+    for rule in first:
+      text = text + "  <stitch-run rule=\"" + rule + "\" />\n"
+    keys = levels.keys()
+    keys.sort()
+    for level in keys:
+      if len(levels[level]) == 1:
+        text = text + "  <stitch-run rule=\"" + levels[level][0] + "\" />\n"
+        continue
+      text = text + "  <parallel threadCount=\"${stitch-threads}\"" \
+          + " failonany=\"true\">\n"
+      for rule in levels[level]:
+        text = text + "    <stitch-run rule=\"" + rule + "\" />\n"
+      text = text + "  </parallel>\n"
+    for rule in last:
+      text = text + "  <stitch-run rule=\"" + rule + "\" />\n"
+    return text
+
+
   def getTopLevelRules(self):
     """ Return a list of the names of rules that we introduce
         into the top-level script """
@@ -426,40 +962,273 @@ ant_map[("%(phase)s", "//%(trail_slash_target)s")] = "%(ant_rule)s"
 
     text = """
 
-def formatProperties():
+def formatProperties(target_props):
   # return properties definition string from the user:
-  global props
   propStr = ""
-  for prop in props:
+  for prop in target_props:
     propStr = propStr + "'" + prop + "' "
   return propStr
 
-ant_map = {}
+# Look 'key' up in the table that stitch wrote to %(INDEX)s,
+# whose lines are "key<TAB>value", sorted by key. Returns the value, or
+# None if the key is not there. The file is binary searched, so only a few
+# blocks of it are read however large the tree is.
+def lookup_index(key):
+  try:
+    handle = open("%(INDEX)s")
+  except IOError:
+    return None
+  try:
+    handle.seek(0, 2)
+    lo = 0
+    hi = handle.tell()
+    # find the first offset at which the next line's key is >= key
+    while lo < hi:
+      mid = (lo + hi) / 2
+      line = index_line_at(handle, mid)
+      if len(line) == 0 or line[:line.rindex("\\t")] >= key:
+        hi = mid
+      else:
+        lo = mid + 1
+    line = index_line_at(handle, lo)
+    if len(line) > 0 and line[:line.rindex("\\t")] == key:
+      return line[len(key) + 1:].rstrip("\\n")
+    return None
+  finally:
+    handle.close()
+
+# return the first line of the index that starts at or after 'offset'
+def index_line_at(handle, offset):
+  if offset == 0:
+    handle.seek(0)
+  else:
+    handle.seek(offset - 1)
+    handle.readline()
+  return handle.readline()
+
+# return the ant rule for a target in a phase, asking the stitch
+# server if one is running. Raises KeyError if there is none.
+def lookup_ant_rule(phase, target):
+  result = query_stitch_server("lookup", phase, target)
+  if result == None:
+    # no server; use the table stitch wrote.
+    result = lookup_index("a\\t" + phase + "\\t" + target)
+    if result == None:
+      raise KeyError((phase, target))
+    return result
+  elif len(result) == 0:
+    raise KeyError((phase, target))
+  else:
+    return result[0]
+
+# If 'stitch --watch' is regenerating the build, wait for it to finish
+# and then run the new version of this script instead.
+sbuild_mtime = os.stat(base).st_mtime
+def wait_for_stitch_watch():
+  import time
+  watch_dir = "%(WATCH_DIR)s"
+  try:
+    handle = open(os.path.join(watch_dir, "watch.pid"))
+    try:
+      os.kill(int(handle.read().strip()), 0)
+    finally:
+      handle.close()
+  except (IOError, OSError, ValueError):
+    return # no watcher running.
+
+  busy_file = os.path.join(watch_dir, "watch.busy")
+  if os.path.exists(busy_file):
+    print "Waiting for stitch --watch to regenerate the build..."
+    while os.path.exists(busy_file):
+      time.sleep(0.1)
+
+  if os.stat(base).st_mtime != sbuild_mtime:
+    os.chdir(cwd)
+    os.execv(sys.executable, [sys.executable, base] + sys.argv[1:])
+
+# return the build file that ant should run ant_targets from: their entry
+# file if they all share one, or else build.xml.
+def ant_build_file(ant_targets):
+  build_file = None
+  for ant_target in ant_targets:
+    entry_file = lookup_index("e\\t" + ant_target)
+    if entry_file == None or (build_file != None and entry_file != build_file):
+      return "%(BUILD_DIR)s/build.xml"
+    build_file = entry_file
+  return build_file
+
+# Return True if none of the files that stitch generated the build from
+# have changed since, according to the manifest it wrote; None if there
+# is no manifest.
+def stitch_inputs_unchanged():
+  try:
+    handle = open("%(MANIFEST)s")
+  except IOError:
+    return None
+  try:
+    for line in handle:
+      if line.startswith("#"):
+        continue
+      (mtime, size, filename) = line.rstrip("\\n").split(" ", 2)
+      try:
+        st = os.stat(filename)
+      except OSError:
+        if mtime != "-":
+          return False
+        continue
+      if mtime == "-" or float(mtime) != st.st_mtime \\
+          or int(size) != st.st_size:
+        return False
+  finally:
+    handle.close()
+  return True
+
+# Run stitch if its inputs have changed, and then the new version of this
+# script instead. Otherwise, return the list of arguments (if any) that
+# tell ant the build is up to date.
+stitch_checked_args = None
+def check_stitch_inputs():
+  global stitch_checked_args
+  if stitch_checked_args != None:
+    return stitch_checked_args
+
+  unchanged = stitch_inputs_unchanged()
+  if unchanged:
+    stitch_checked_args = [ "-Dstitch.up-to-date=true" ]
+    return stitch_checked_args
+
+  stitch_checked_args = []
+  if unchanged == None:
+    return stitch_checked_args # let ant check the Targets files.
+  for prop in props:
+    if prop.startswith("-Dstitch-disallow-refresh"):
+      return stitch_checked_args # leave it to ant's stitch-refresh rule.
+  if os.getenv("STITCH_REFRESHED") != None:
+    return stitch_checked_args # we just ran it; don't loop.
 
-# run anything from ant
-def run_ant_target(ant_target):
-  # Hack - Ant 1.7.1 on dev server doesn't seem to respect its
-  # own classpath with respect to JUnit and ant.jar. So we're
-  # hardcoding it in here.
-  # TODO(aaron): Remove this hard-coded path dependency.
+  print "Targets files have changed; running stitch..."
+  if os.system("%(STITCH_EXEC)s") != 0:
+    sys.exit(1)
+  os.environ["STITCH_REFRESHED"] = "1"
+  os.chdir(cwd)
+  os.execv(sys.executable, [sys.executable, base] + sys.argv[1:])
+
+# Hack - Ant 1.7.1 on dev server doesn't seem to respect its
+# own classpath with respect to JUnit and ant.jar. So we're
+# hardcoding it in here.
+# TODO(aaron): Remove this hard-coded path dependency.
+def fix_ant_classpath():
   if os.path.exists("/usr/share/ant/lib/ant.jar"):
     classpath = os.getenv("CLASSPATH", "")
     if len(classpath) > 0 and not classpath.endswith(":"):
       classpath = classpath + ":"
     classpath = classpath + "/usr/share/ant/lib/ant.jar"
     os.environ["CLASSPATH"] = classpath
-  callString = "ant -f %(BUILD_DIR)s/build.xml " + formatProperties() + ant_target
-  ret = os.system(callString)
+
+# The resident ant server (see the ant-server property), if enabled.
+ant_server_jar = "%(ANT_SERVER_JAR)s"
+ant_server_port_file = "%(ANT_SERVER_PORT_FILE)s"
+
+# Run a build in the ant server. Returns its exit status, or None if the
+# server is not running; in that case one is started for next time.
+def run_in_ant_server(build_file, args):
+  if len(ant_server_jar) == 0 or not os.path.exists(ant_server_jar):
+    return None
+
+  import socket
+  try:
+    handle = open(ant_server_port_file)
+    try:
+      (port, token) = handle.read().split()
+    finally:
+      handle.close()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(("127.0.0.1", int(port)))
+  except (IOError, ValueError, socket.error):
+    start_ant_server()
+    return None
+
+  try:
+    request = [ token, os.path.abspath(build_file) ] + args + [ "" ]
+    sock.sendall("\\n".join(request) + "\\n")
+    response = sock.makefile("rb")
+    while True:
+      header = response.readline()
+      if len(header) == 0:
+        print "Error: lost the connection to the ant server"
+        return 1
+      elif header.startswith("="):
+        return int(header[1:])
+      sys.stdout.write(response.read(int(header)))
+      sys.stdout.flush()
+  finally:
+    sock.close()
+
+def start_ant_server():
+  fix_ant_classpath()
+  log_file = os.path.join(os.path.dirname(ant_server_port_file),
+      "antserver.log")
+  os.system("nohup ant -lib '" + ant_server_jar + "' "
+      + "-main com.cloudera.stitch.AntServer '" + ant_server_port_file
+      + "' %(ANT_SERVER_IDLE)s > '" + log_file + "' 2>&1 < /dev/null &")
+
+# run anything from ant, in a single invocation.
+def run_ant_targets(ant_targets, target_props):
+  wait_for_stitch_watch()
+  args = check_stitch_inputs()[:]
+  ret = None
+  if jobs > 1:
+    ret = run_ant_jobs(ant_targets, args + target_props)
+    if ret != None:
+      if ret > 0:
+        sys.exit(1)
+      return
+
+  if len(ant_targets) > 1:
+    # run the dependencies the targets have in common only once.
+    args.append("-Dant.executor.class="
+        + "org.apache.tools.ant.helper.SingleCheckExecutor")
+  args.extend(target_props)
+  build_file = ant_build_file(ant_targets)
+
+  ret = run_in_ant_server(build_file, args + ant_targets)
+  if ret == None:
+    fix_ant_classpath()
+    callString = "ant -f " + build_file + " " + formatProperties(args) + \\
+        " ".join(ant_targets)
+    ret = os.system(callString)
   if ret > 0:
     sys.exit(1)
 
 
+# The ant rules for the targets named on the command line are queued up
+# and run together once they have all been looked up (see finish_handlers),
+# so that ant starts and parses its build file only once. The properties
+# defined so far are saved with them; since each -D applies only to the
+# targets to its right, the queue is run early if they change.
+queued_ant_targets = []
+queued_props = []
+
+def queue_ant_target(ant_target):
+  global queued_props
+  if len(queued_ant_targets) > 0 and queued_props != props:
+    run_queued_ant_targets()
+  queued_props = props[:]
+  queued_ant_targets.append(ant_target)
+
+def run_queued_ant_targets():
+  global queued_ant_targets
+  if len(queued_ant_targets) > 0:
+    ant_targets = queued_ant_targets
+    queued_ant_targets = []
+    run_ant_targets(ant_targets, queued_props)
+
 def ant_phase(phase):
-  run_ant_target(phase)
+  run_ant_targets([ phase ], props)
   sys.exit(0)
 
 def ant_topLevelAnt(phase, target):
-  global ant_map, lookup_only, cwd, common_path
+  global lookup_only, cwd, common_path
 
   if not target.startswith(os.sep):
     # This is not guaranteed to be an absolute target.
@@ -470,27 +1239,41 @@ def ant_topLevelAnt(phase, target):
     if len(target_parts) > 1:
       abs_target += ":" + ":".join(target_parts[1:])
     try:
-      ant_target = ant_map[(phase, abs_target)]
+      ant_target = lookup_ant_rule(phase, abs_target)
     except KeyError:
       # Couldn't find that. Try it as an absolute.
-      ant_target = ant_map[(phase, target)]
+      ant_target = lookup_ant_rule(phase, target)
   else:
     # Definitely an absolute target.
-    ant_target = ant_map[(phase, target)]
+    ant_target = lookup_ant_rule(phase, target)
 
   if lookup_only:
     # lookup succeeded
     return True
   else:
-    run_ant_target(ant_target)
+    queue_ant_target(ant_target)
 
 target_handlers.append(ant_topLevelAnt)
 phase_handlers.append(ant_phase)
-""" % { "BUILD_DIR" : build_dir }
+finish_handlers.append(run_queued_ant_targets)
+""" % { "BUILD_DIR" : build_dir,
+        "WATCH_DIR" : os.path.join(paths.getBuildRoot(),
+            parsecache.get_cache_dir()),
+        "MANIFEST" : os.path.join(paths.getBuildRoot(),
+            manifest.get_manifest_filename()),
+        "STITCH_EXEC" : antprops.getProperty("stitch-exec", "stitch"),
+        "INDEX" : os.path.join(build_dir, ANT_MAP_INDEX_FILENAME),
+        "ANT_SERVER_JAR" : self.getAntServerJar(),
+        "ANT_SERVER_PORT_FILE" : os.path.join(paths.getBuildRoot(),
+            parsecache.get_cache_dir(), ANT_SERVER_PORT_FILENAME),
+        "ANT_SERVER_IDLE" : antprops.getProperty("ant-server-idle-minutes",
+            "60") }
+
+    self.writeAntMapIndex(allTargets)
+    return text
+
 
-    text = text + self.getBuildScriptMap(allTargets)
 
-    return text
 
 
 
@@ -0,0 +1,236 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Test cases for the top-level rules the AntGenerator writes when
+# stitch-threads is more than 1. Running them needs ant and a JDK;
+# without them those tests pass with a note.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import stitch.testutil.anttools as anttools
+from   stitch.testutil.asserts import TestCaseWithAsserts
+
+# //one and //two do not depend on each other; //three requires both.
+BUILD_XML = """<echo message="building %(NAME)s" />%(CHECKS)s
+    <touch file="${basedir}/%(NAME)s.done" />"""
+
+CHECK_XML = """
+    <fail message="%(NAME)s ran before %(REQ)s">
+      <condition>
+        <not><available file="${basedir}/%(REQ)s.done" /></not>
+      </condition>
+    </fail>"""
+
+# rules run by <stitch-run> tasks in parallel: a and b both need the slow
+# shared rule; c and d both need broken, which fails.
+RUN_RULE_XML = """<project name="runrule" default="all">
+  <taskdef name="stitch-run" classname="com.cloudera.stitch.RunRuleTask"
+      classpath="%(JAR)s" />
+  <target name="shared">
+    <echo message="shared starts" />
+    <sleep seconds="1" />
+    <property name="shared.done" value="true" />
+  </target>
+  <target name="a" depends="shared">
+    <fail unless="shared.done" message="a ran before shared finished" />
+    <echo message="a ran" />
+  </target>
+  <target name="b" depends="shared">
+    <fail unless="shared.done" message="b ran before shared finished" />
+    <echo message="b ran" />
+  </target>
+  <target name="broken">
+    <sleep seconds="1" />
+    <fail message="broken on purpose" />
+  </target>
+  <target name="c" depends="broken" />
+  <target name="d" depends="broken" />
+  <target name="all">
+    <parallel threadCount="2" failonany="true">
+      <stitch-run rule="a" />
+      <stitch-run rule="b" />
+    </parallel>
+  </target>
+  <target name="all-broken">
+    <parallel threadCount="2">
+      <stitch-run rule="c" />
+      <stitch-run rule="d" />
+    </parallel>
+  </target>
+</project>
+"""
+
+class StitchRunTest(TestCaseWithAsserts):
+
+  def setUp(self):
+    self.project_dir = tempfile.mkdtemp()
+    self.writeFile("targets", "all = ProjectList(required_targets=[ "
+        + "'//one', '//two', '//three' ])\n")
+    self.writeTarget("one", [])
+    self.writeTarget("two", [])
+    self.writeTarget("three", [ "one", "two" ])
+    self.jar_file = os.path.join(self.project_dir, "stitch-ant.jar")
+    self.writeFile("build.properties", "stitch-threads=2\n"
+        + "stitch-ant-jar=" + self.jar_file + "\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.project_dir)
+
+  def writeFile(self, name, text):
+    anttools.write_file(os.path.join(self.project_dir, name), text)
+
+  def writeTarget(self, name, requires):
+    os.mkdir(os.path.join(self.project_dir, name))
+    checks = ""
+    for req in requires:
+      checks = checks + CHECK_XML % { "NAME" : name, "REQ" : req }
+    build_xml = BUILD_XML % { "NAME" : name, "CHECKS" : checks }
+    self.writeFile(os.path.join(name, "targets"),
+        "%s = RawAntTarget(buildXml=%r, required_targets=%r)\n"
+        % (name, build_xml, [ "//" + req for req in requires ]))
+
+  def stitch(self):
+    """ run stitch on the project; returns its output and build.xml """
+    (status, output) = anttools.run_stitch(self.project_dir)
+    self.assertEquals(status, 0, output)
+    handle = open(os.path.join(self.project_dir, "build", "build.xml"))
+    try:
+      return (output, handle.read())
+    finally:
+      handle.close()
+
+  def test_missing_jar(self):
+    # without the jar, the phases depend on the targets' rules as usual.
+    (output, build_xml) = self.stitch()
+    self.assert_(output.find("Warning: " + self.jar_file) != -1, output)
+    self.assertEquals(build_xml.find("stitch-run"), -1)
+    self.assertEquals(build_xml.find("<parallel"), -1)
+
+  def test_parallel_rules(self):
+    anttools.write_file(self.jar_file, "")
+    (output, build_xml) = self.stitch()
+    self.assertEquals(output.find("Warning: " + self.jar_file), -1, output)
+    self.assert_(build_xml.find("com.cloudera.stitch.RunRuleTask") != -1)
+    self.assert_(build_xml.find("""  <stitch-run rule="init" />
+  <parallel threadCount="${stitch-threads}" failonany="true">
+    <stitch-run rule="one-build" />
+    <stitch-run rule="two-build" />
+  </parallel>
+  <stitch-run rule="three-build" />
+""") != -1, build_xml)
+
+  def test_parallel_build(self):
+    if not anttools.have_jdk("StitchRunTest.test_parallel_build"):
+      return
+    anttools.build_stitch_ant_jar(self.jar_file)
+    self.stitch()
+    (status, output) = anttools.run_sbuild(self.project_dir,
+        [ "--phase", "build" ])
+    self.assertEquals(status, 0, output)
+    for name in [ "one", "two", "three" ]:
+      self.assert_(output.find("building " + name) != -1, output)
+      self.assert_(os.path.exists(os.path.join(self.project_dir,
+          name + ".done")))
+
+    # a failing rule fails the phase.
+    os.mkdir(os.path.join(self.project_dir, "four"))
+    self.writeFile(os.path.join("four", "targets"), "four = RawAntTarget("
+        + "buildXml='<fail message=\"four fails on purpose\" />')\n")
+    self.writeFile("targets", "all = ProjectList(required_targets=[ "
+        + "'//one', '//two', '//three', '//four' ])\n")
+    self.stitch()
+    (status, output) = anttools.run_sbuild(self.project_dir,
+        [ "--phase", "build" ])
+    self.assertNotEquals(status, 0, output)
+    self.assert_(output.find("four fails on purpose") != -1, output)
+
+  def test_failed_property(self):
+    if not anttools.have_jdk("StitchRunTest.test_failed_property"):
+      return
+    # a test that fails in one thread fails the test phase, once the
+    # others have run.
+    self.writeFile(os.path.join("one", "targets"), "one = RawAntTarget("
+        + "testXml='<sleep seconds=\"1\" /><echo message=\"one tested\" />"
+        + "<property name=\"failed\" value=\"true\" />')\n")
+    self.writeFile(os.path.join("two", "targets"), "two = RawAntTarget("
+        + "testXml='<echo message=\"two tested\" />')\n")
+    self.writeFile("targets", "all = ProjectList(required_targets=[ "
+        + "'//one', '//two' ])\n")
+    anttools.build_stitch_ant_jar(self.jar_file)
+    (output, build_xml) = self.stitch()
+    self.assert_(build_xml.find("<parallel") != -1, build_xml)
+    (status, output) = anttools.run_sbuild(self.project_dir,
+        [ "--phase", "test" ])
+    self.assertNotEquals(status, 0, output)
+    self.assert_(output.find("one tested") != -1, output)
+    self.assert_(output.find("two tested") != -1, output)
+    self.assert_(output.find("Unit tests failed") != -1, output)
+
+  def test_shared_rules(self):
+    if not anttools.have_jdk("StitchRunTest.test_shared_rules"):
+      return
+    anttools.build_stitch_ant_jar(self.jar_file)
+    self.writeFile("runrule.xml", RUN_RULE_XML % { "JAR" : self.jar_file })
+
+    # a rule needed by both threads runs once; the other thread waits.
+    (status, output) = anttools.run_ant(self.project_dir,
+        [ "-f", "runrule.xml", "all" ])
+    self.assertEquals(status, 0, output)
+    self.assertEquals(output.count("shared starts"), 1, output)
+    self.assert_(output.find("a ran") != -1, output)
+    self.assert_(output.find("b ran") != -1, output)
+
+    # if it fails, it fails both.
+    (status, output) = anttools.run_ant(self.project_dir,
+        [ "-f", "runrule.xml", "all-broken" ])
+    self.assertNotEquals(status, 0, output)
+    self.assertEquals(output.count("broken on purpose"), 1, output)
+    self.assert_(output.find("Rule broken failed") != -1, output)
+
+
+class AntServerJarTest(TestCaseWithAsserts):
+
+  def setUp(self):
+    self.project_dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(self.project_dir, "one"))
+    anttools.write_file(os.path.join(self.project_dir, "targets"),
+        "all = ProjectList(required_targets=[ '//one' ])\n")
+    anttools.write_file(os.path.join(self.project_dir, "one", "targets"),
+        "one = RawAntTarget(buildXml='<echo message=\"one\" />')\n")
+    self.jar_file = os.path.join(self.project_dir, "stitch-ant.jar")
+    anttools.write_file(os.path.join(self.project_dir, "build.properties"),
+        "ant-server=true\nstitch-ant-jar=" + self.jar_file + "\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.project_dir)
+
+  def getServerJar(self):
+    """ run stitch; returns its output and the build script's server jar """
+    (status, output) = anttools.run_stitch(self.project_dir)
+    self.assertEquals(status, 0, output)
+    script = {}
+    handle = open(os.path.join(self.project_dir, "sbuild"))
+    try:
+      for line in handle:
+        if line.startswith("ant_server_jar = "):
+          exec line in script
+    finally:
+      handle.close()
+    return (output, script["ant_server_jar"])
+
+  def test_missing_jar(self):
+    (output, jar) = self.getServerJar()
+    self.assert_(output.find("Warning: " + self.jar_file) != -1, output)
+    self.assertEquals(jar, "")
+
+  def test_jar(self):
+    anttools.write_file(self.jar_file, "")
+    (output, jar) = self.getServerJar()
+    self.assertEquals(output.find("Warning: "), -1, output)
+    self.assertEquals(jar, self.jar_file)
+
+
+if __name__ == "__main__":
+  unittest.main()
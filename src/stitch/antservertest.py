@@ -0,0 +1,181 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Integration tests for the resident ant server (AntServer.java). These
+# need ant and a JDK; without them they pass with a note.
+
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+
+import stitch.testutil.anttools as anttools
+from   stitch.testutil.asserts import TestCaseWithAsserts
+
+BUILD_FILE = """<project name="servertest" default="hello">
+  <property name="greeting" value="%(GREETING)s" />
+  <target name="hello">
+    <echo message="${greeting}, ${who}" />
+  </target>
+  <target name="once">
+    <fail if="ran" message="ran is still set" />
+    <property name="ran" value="true" />
+    <echo message="ran once" />
+  </target>
+  <target name="marker">
+    <condition property="state" value="present" else="absent">
+      <available file="${basedir}/marker" />
+    </condition>
+    <echo message="marker is ${state}" />
+  </target>
+  <target name="broken">
+    <fail message="broken on purpose" />
+  </target>
+</project>
+"""
+
+class AntServerTest(TestCaseWithAsserts):
+
+  def setUp(self):
+    self.server = None
+    self.work_dir = None
+    if not anttools.have_jdk("AntServerTest"):
+      return
+
+    self.work_dir = tempfile.mkdtemp()
+    self.build_file = os.path.join(self.work_dir, "build.xml")
+    self.writeBuildFile("hello")
+    jar_file = os.path.join(self.work_dir, "stitch-ant.jar")
+    anttools.build_stitch_ant_jar(jar_file)
+
+    self.port_file = os.path.join(self.work_dir, "antserver.port")
+    log = open(os.path.join(self.work_dir, "antserver.log"), "w")
+    try:
+      self.server = subprocess.Popen([ "ant", "-lib", jar_file, "-main",
+          "com.cloudera.stitch.AntServer", self.port_file, "1" ],
+          stdout=log, stderr=subprocess.STDOUT)
+    finally:
+      log.close()
+
+    deadline = time.time() + 60
+    while not os.path.exists(self.port_file):
+      if time.time() > deadline or self.server.poll() != None:
+        self.tearDown()
+        self.fail("The ant server did not start")
+      time.sleep(0.1)
+
+
+  def tearDown(self):
+    if self.server != None:
+      # the server exits once its port file is gone.
+      if os.path.exists(self.port_file):
+        os.remove(self.port_file)
+      deadline = time.time() + 30
+      while self.server.poll() == None and time.time() < deadline:
+        time.sleep(0.1)
+      if self.server.poll() == None:
+        os.kill(self.server.pid, signal.SIGTERM)
+        self.server.wait()
+    if self.work_dir != None:
+      shutil.rmtree(self.work_dir)
+
+
+  def writeBuildFile(self, greeting):
+    handle = open(self.build_file, "w")
+    try:
+      handle.write(BUILD_FILE % { "GREETING" : greeting })
+    finally:
+      handle.close()
+
+
+  def runBuild(self, args):
+    """ Send a build to the server, the way the build script does. Returns
+        the exit status and the output. """
+    handle = open(self.port_file)
+    try:
+      (port, token) = handle.read().split()
+    finally:
+      handle.close()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(("127.0.0.1", int(port)))
+    try:
+      request = [ token, self.build_file ] + args + [ "" ]
+      sock.sendall("\n".join(request) + "\n")
+      response = sock.makefile("rb")
+      output = ""
+      while True:
+        header = response.readline()
+        if len(header) == 0:
+          self.fail("Lost the connection to the ant server")
+        elif header.startswith("="):
+          return (int(header[1:]), output)
+        output = output + response.read(int(header))
+    finally:
+      sock.close()
+
+
+  def test_two_builds(self):
+    if self.server == None:
+      return
+    (status, output) = self.runBuild([ "-Dwho=world", "hello" ])
+    self.assertEquals(status, 0)
+    self.assert_(output.find("hello, world") != -1, output)
+    self.assert_(output.find("BUILD SUCCESSFUL") != -1, output)
+
+    (status, output) = self.runBuild([ "-Dwho=again", "hello" ])
+    self.assertEquals(status, 0)
+    self.assert_(output.find("hello, again") != -1, output)
+
+
+  def test_failed_build(self):
+    if self.server == None:
+      return
+    (status, output) = self.runBuild([ "broken" ])
+    self.assertEquals(status, 1)
+    self.assert_(output.find("broken on purpose") != -1, output)
+
+    # the server still runs builds after one has failed.
+    (status, output) = self.runBuild([ "-Dwho=world", "hello" ])
+    self.assertEquals(status, 0)
+
+
+  def test_builds_are_independent(self):
+    if self.server == None:
+      return
+    # each build starts from the build file, not from the last build.
+    (status, output) = self.runBuild([ "once" ])
+    self.assertEquals(status, 0)
+    (status, output) = self.runBuild([ "once" ])
+    self.assertEquals(status, 0, output)
+    self.assert_(output.find("ran once") != -1, output)
+
+    (status, output) = self.runBuild([ "marker" ])
+    self.assert_(output.find("marker is absent") != -1, output)
+    handle = open(os.path.join(self.work_dir, "marker"), "w")
+    handle.close()
+    (status, output) = self.runBuild([ "marker" ])
+    self.assertEquals(status, 0)
+    self.assert_(output.find("marker is present") != -1, output)
+
+
+  def test_modified_build_file(self):
+    if self.server == None:
+      return
+    (status, output) = self.runBuild([ "-Dwho=world", "hello" ])
+    self.assert_(output.find("hello, world") != -1, output)
+
+    self.writeBuildFile("goodbye")
+    # make sure the modification time changes.
+    mtime = os.path.getmtime(self.build_file) + 2
+    os.utime(self.build_file, (mtime, mtime))
+    (status, output) = self.runBuild([ "-Dwho=world", "hello" ])
+    self.assertEquals(status, 0)
+    self.assert_(output.find("goodbye, world") != -1, output)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -6,6 +6,8 @@
 # An object that reads a build file and its information
 #
 
+import stitch.codecache as codecache
+import stitch.discovery as discovery
 import stitch.paths as paths
 import stitch.propstack as propstack
 
@@ -43,9 +45,17 @@ def setCurBuildFile(buildfile):
 __extension_objs = None
 
 
-def get_globals(with_exts=False):
-  """ Return a dictionary to use as the 'globals' environment dict for
-      importing a module or executing a script/targets file
+# Templates for the 'globals' dict of Targets files, with and without the
+# extensions. These are built once by get_globals() and copied for each
+# file; load_extensions() discards them.
+__globals_template = None
+__ext_globals_template = None
+
+
+def build_globals(with_exts=False):
+  """ Build a new dictionary to use as the 'globals' environment dict
+      for importing a module or executing a script/targets file. This
+      walks the whole alltargets module; use get_globals() instead.
   """
   import stitch.targets.alltargets as alltargets
 
@@ -63,15 +73,34 @@ def get_globals(with_exts=False):
   return globals
 
 
+def get_globals(with_exts=False):
+  """ Return a dictionary to use as the 'globals' environment dict for
+      importing a module or executing a script/targets file. Each call
+      returns a fresh copy of a template built on the first call, so
+      each Targets file gets its own namespace.
+  """
+  global __globals_template, __ext_globals_template
+
+  if with_exts:
+    if __ext_globals_template == None:
+      __ext_globals_template = build_globals(True)
+    return __ext_globals_template.copy()
+  else:
+    if __globals_template == None:
+      __globals_template = build_globals(False)
+    return __globals_template.copy()
+
+
 def load_extensions():
   """ If there's a stitch-ext/ dir in the root of the build tree, load any
       python files from there as modules and retain their environments to
       load into all targets files we process.
   """
-  global __extension_objs
+  global __extension_objs, __ext_globals_template
 
   # Clear existing extensions
   __extension_objs = {}
+  __ext_globals_template = None
 
   props = propstack.get_properties()
   ext_dir = props.getProperty("stitch-extensions")
@@ -94,13 +123,27 @@ def load_extensions():
         # Load and execute this module, and incorporate its env dictionary
         # into the master extension dictionary
         print "Loading module:", modname
-        mod = __import__(modname)
+        mod = codecache.import_file(modname, os.path.join(ext_dir, file))
         __extension_objs[modname] = mod
   finally:
     # restore the configured sys.path
     sys.path = old_sys_path
 
 
+def reset_extensions():
+  """ unload the extension modules; they are loaded again on next use. """
+  global __extension_objs, __ext_globals_template
+
+  if __extension_objs != None:
+    for modname in __extension_objs.keys():
+      try:
+        del sys.modules[modname]
+      except KeyError:
+        pass
+  __extension_objs = None
+  __ext_globals_template = None
+
+
 def get_extensions():
   """ return the environment dictionary constructed from the user extensions """
   global __extension_objs
@@ -110,24 +153,34 @@ def get_extensions():
   return __extension_objs
 
 
+def getBuildFileName(path):
+  """ return the absolute path to the Targets file for 'path', which
+      may name either the file itself or the directory containing it """
+  filename = os.path.abspath(path)
+  if os.path.isdir(filename) or filename.endswith(os.sep):
+    filename = os.path.abspath(filename + os.sep + DEFAULT_BUILD_FILENAME)
+  return filename
+
+
 class BuildFile(object):
   """ An object that represents the information stored in
       a single BUILD file """
 
-  def __init__(self, path):
+  def __init__(self, path, parseCache=None, cacheEntry=None):
     # the actual path to the file to open
-    self.path = os.path.abspath(path)
-    if os.path.isdir(self.path) or self.path.endswith(os.sep):
-      self.path = os.path.abspath(self.path
-          + os.sep + DEFAULT_BUILD_FILENAME)
+    self.path = getBuildFileName(path)
 
     # the pathname relative to the build root.
-    self.canonicalName = paths.getCanonicalName(path)
-    self.safeName = paths.getSafeName(path)
+    (relative, self.canonicalName, self.safeName) = paths.canonicalizePath(path)
 
     self.targets = []
+    self.namedTargets = []
     self.defaultTarget = None
-    self.execute()
+    self.requiredBuildFiles = None
+
+    # md5 of the Targets file contents; filled in by the parse cache.
+    self.contentHash = None
+    self.execute(parseCache, cacheEntry)
 
 
   def getBuildFileDirectory(self):
@@ -140,6 +193,11 @@ class BuildFile(object):
         targets in this buildfile """
     return self.canonicalName
 
+  def getSafeName(self):
+    """ returns the ant-safe form of the canonical name (empty for the
+        Targets file at the root of the tree) """
+    return self.safeName
+
   def getFileName(self):
     """ Returns the filename for this build file """
     return self.path
@@ -148,21 +206,12 @@ class BuildFile(object):
     """ Load a python file and execute it, returning a dictionary of all the public
         objects in their output environment.
     """
-    handle = None
     try:
-      try:
-        handle = open(filename)
-        scriptSource = handle.read()
-      except IOError, ioe:
-        print "Error: File " + filename + " could not be loaded."
-        print ioe
-        return {}
-    finally:
-      if handle != None:
-        handle.close()
-
-    try:
-      code = compile(scriptSource, filename, 'exec')
+      code = codecache.load_code(filename)
+    except (IOError, OSError), ioe:
+      print "Error: File " + filename + " could not be loaded."
+      print ioe
+      return {}
     except SyntaxError, se:
       print "Syntax error evaluating " + filename + ":"
       print se
@@ -183,16 +232,57 @@ class BuildFile(object):
     
     return public_objs
 
-  def execute(self):
+  def execute(self, parseCache=None, cacheEntry=None):
     """ Load the Targets file by running it in the context
-        of the current module. """
+        of the current module. If a parse cache is provided and it
+        holds an up-to-date copy of this file's targets, use those
+        instead. If the file was already evaluated elsewhere (e.g., in
+        a worker process), its results are passed in cacheEntry. """
 
-    import stitch.targets.alltargets as alltargets
+    import stitch.parsecache as parsecache
+    from stitch.targets.target import Target
 
     setCurBuildFile(self)
 
+    if cacheEntry != None:
+      try:
+        parsecache.restore_entry(self, cacheEntry)
+      except Exception:
+        # The worker's results can't be loaded here (e.g., a class it
+        # pickled has moved); evaluate the file in this process instead.
+        self.targets = []
+        self.namedTargets = []
+        self.defaultTarget = None
+        self.requiredBuildFiles = None
+      else:
+        if parseCache != None:
+          parseCache.misses = parseCache.misses + 1
+          parseCache.store(self, cacheEntry)
+        return
+
+    if parseCache != None and parseCache.restore(self):
+      return
+
     self.userObjects = self.exec_for_env(self.path, with_exts=True)
 
+    # find the user objects which are targets; these get named after
+    # the variable they were assigned to.
+    namedTargets = []
+    for obj in self.userObjects:
+      if isinstance(self.userObjects[obj], Target):
+        namedTargets.append((obj, self.userObjects[obj]))
+
+    self.nameTargets(namedTargets)
+
+    if parseCache != None:
+      parseCache.store(self)
+
+
+  def nameTargets(self, namedTargets):
+    """ Assign canonical and safe names to all the targets in this file.
+        namedTargets is a list of (name, target) pairs for the targets
+        the user bound to variables in the Targets file. """
+
     # objects currently have "__anonymous" names. put our own
     # canonical name ahead of these.
     for target in self.targets:
@@ -201,11 +291,10 @@ class BuildFile(object):
       target.setSafeName(self.safeName + SAFE_SEPARATOR + target.getSafeName())
 
     # assign the names of the named user objects back to themselves
-    for obj in self.userObjects:
-      if isinstance(self.userObjects[obj], alltargets.Target):
-        self.userObjects[obj].setCanonicalName(self.canonicalName
-            + SUBTARGET_SPECIFIER + obj, False)
-        self.userObjects[obj].setSafeName(self.safeName + SAFE_SEPARATOR + obj)
+    self.namedTargets = namedTargets
+    for (name, target) in namedTargets:
+      target.setCanonicalName(self.canonicalName + SUBTARGET_SPECIFIER + name, False)
+      target.setSafeName(self.safeName + SAFE_SEPARATOR + name)
 
     # and assign the build file's root name to the default target
     if None != self.defaultTarget:
@@ -216,11 +305,26 @@ class BuildFile(object):
         self.defaultTarget.setSafeName(self.safeName)
 
 
+  def restoreState(self, targets, defaultTarget, namedTargets, requiredBuildFiles):
+    """ Install targets restored from the parse cache in place of executing
+        the Targets file. """
+
+    self.targets = targets
+    self.defaultTarget = defaultTarget
+    self.requiredBuildFiles = requiredBuildFiles
+
+    # Each target takes a fresh anonymous name, in creation order, exactly as
+    # if it had just been constructed; then it is named as usual.
+    for target in self.targets:
+      target.resetAnonymousName()
+    self.nameTargets(namedTargets)
+
+
   def addTarget(self, someTarget):
     """ registers a target created in this build file. This
         is a callback function used by the Targets script"""
-    import stitch.targets.alltargets as alltargets
-    if not isinstance(someTarget, alltargets.Target):
+    from stitch.targets.target import Target
+    if not isinstance(someTarget, Target):
       raise Exception(str(someTarget) + " is not a Target")
 
     self.targets.append(someTarget)
@@ -232,6 +336,9 @@ class BuildFile(object):
     """ return a list of paths to BuildFiles which were
         referenced by targets in this BuildFile """
 
+    if self.requiredBuildFiles != None:
+      return self.requiredBuildFiles
+
     out = []
     for target in self.targets:
       reqs = target.required_targets
@@ -251,12 +358,13 @@ class BuildFile(object):
 
           # Test to see if the file exists; give an error if not.
           actual_file_name = os.path.join(req, DEFAULT_BUILD_FILENAME)
-          if not os.path.exists(actual_file_name):
+          if not discovery.has_build_file(req):
             raise Exception("Target " + target.getCanonicalName() \
                 + " references missing buildfile " + actual_file_name)
 
           out.append(req)
 
+    self.requiredBuildFiles = out
     return out
 
 
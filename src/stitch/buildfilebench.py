@@ -0,0 +1,44 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Micro-benchmark for the per-Targets-file cost of setting up the
+# environment a Targets file is evaluated in. Compares building the
+# globals dict from scratch (as stitch did for every file) against
+# copying the template kept by buildfile.get_globals().
+#
+# Usage: python -m stitch.buildfilebench [iterations]
+
+import sys
+import time
+
+import stitch.buildfile as buildfile
+
+
+def time_per_call(func, iterations):
+  """ Return the mean wall-clock time in microseconds of func() """
+  start = time.time()
+  for i in xrange(iterations):
+    func()
+  end = time.time()
+  return (end - start) * 1000000.0 / iterations
+
+
+def main(argv):
+  iterations = 10000
+  if len(argv) > 1:
+    iterations = int(argv[1])
+
+  # Warm up: import alltargets, load extensions and build the templates.
+  buildfile.get_globals(True)
+
+  before = time_per_call(lambda: buildfile.build_globals(True), iterations)
+  after = time_per_call(lambda: buildfile.get_globals(True), iterations)
+
+  print "Per-file globals setup over %d iterations:" % iterations
+  print "  build_globals() (from scratch): %8.2f us" % before
+  print "  get_globals()   (template copy): %8.2f us" % after
+  print "  speedup: %.1fx" % (before / after)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -10,8 +10,11 @@ import stat
 
 import stitch.antgenerator as antgenerator
 import stitch.generator as generator
+import stitch.parallelgenerator as parallelgenerator
 import stitch.paths as paths
 import stitch.propstack as propstack
+import stitch.server as server
+import stitch.util.fileutils as fileutils
 
 DEFAULT_BUILD_SCRIPT_NAME = "sbuild"
 
@@ -78,6 +81,8 @@ class BuildGenerator(generator.Generator):
       self.generators.index(antGen)
     except ValueError:
       self.generators.append(antGen)
+      # sbuild -j runs the ant rules as parallel jobs.
+      self.generators.append(parallelgenerator.ParallelGenerator())
 
 
   def generate(self, allTargets):
@@ -86,6 +91,7 @@ class BuildGenerator(generator.Generator):
 
     print "Creating build scripts..."
     canonical_names = []
+    self.tables = None
 
     # Clear generation flags
     for target in allTargets:
@@ -112,11 +118,19 @@ class BuildGenerator(generator.Generator):
     for gen in self.generators:
       gen.generate(allTargets)
 
+    # the tables the stitch server answers from, and their id, which
+    # the build script sends to the server. Without a server, the build
+    # script answers from the tables it holds itself.
+    tables_id = ""
+    if server.isServing():
+      self.tables = server.BuildTables(allTargets)
+      tables_id = self.tables.id
+
     # finally, write out the top-level build script
     handle = None
     try:
       try:
-        handle = open(self.BUILD_SCRIPT_NAME, "w")
+        handle = open(self.BUILD_SCRIPT_NAME + ".tmp", "w")
 
         # write out our script preamble
         handle.write(self.preamble())
@@ -127,12 +141,19 @@ class BuildGenerator(generator.Generator):
           handle.write(gen.getTopLevelScript(allTargets))
 
         # write out the list of target names.
-        handle.write(self.generate_target_list(canonical_names))
+        handle.write(self.generate_target_list(canonical_names,
+            tables_id))
 
         # write out anything that is in the script footer
         handle.write(self.epilogue())
 
-      except IOError, ioe:
+        handle.close()
+        handle = None
+
+        # Only replace the build script if it changed.
+        fileutils.replace_if_changed(self.BUILD_SCRIPT_NAME + ".tmp",
+            self.BUILD_SCRIPT_NAME)
+      except (IOError, OSError), ioe:
         print "Error: Could not write build script:", ioe
     finally:
       if None != handle:
@@ -148,17 +169,29 @@ class BuildGenerator(generator.Generator):
       print "Warning: Could not make build script executable"
 
 
-  def generate_target_list(self, canonical_names):
+  def generate_target_list(self, canonical_names, tables_id):
     """ Return the text which goes in the script to list all available
         target canonical names
     """
 
     canonical_names.sort()
     text = "canonical_names = %s\n" % repr(canonical_names)
+    text = text + "stitch_tables_id = \"" + tables_id + "\"\n"
     text = text + """
 
 def list_targets():
-  for name in canonical_names:
+  names = query_stitch_server("list")
+  if names == None:
+    names = canonical_names
+  for name in names:
+    print name
+
+def list_deps(target):
+  deps = query_stitch_server("alldeps", target)
+  if deps == None:
+    print "Error: --deps requires a running stitch server (stitch --serve)"
+    sys.exit(1)
+  for name in deps:
     print name
 
 """
@@ -184,6 +217,45 @@ cwd = os.path.abspath(os.getcwd())
 base = os.path.abspath(sys.argv[0])
 common_path = os.path.commonprefix([cwd, base])
 
+stitch_server_socket = \"""" + server.get_socket_filename() + """\"
+stitch_server_up = True
+
+def query_stitch_server(*request):
+  # Ask the stitch server (stitch --serve) about the targets. Returns the
+  # list of result lines, or None if the server cannot answer for this
+  # build script and the caller should use the tables in this script.
+  global stitch_server_up
+  if not stitch_server_up or len(stitch_tables_id) == 0:
+    return None
+  import socket
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    try:
+      sock.connect(stitch_server_socket)
+      sock.sendall("\\t".join((stitch_tables_id,) + request) + "\\n")
+      chunks = []
+      while True:
+        data = sock.recv(65536)
+        if not data:
+          break
+        chunks.append(data)
+    except socket.error:
+      stitch_server_up = False
+      return None
+  finally:
+    sock.close()
+
+  lines = "".join(chunks).split("\\n")
+  if lines[0] == "ok":
+    return lines[1:-1]
+  elif lines[0].startswith("error "):
+    print "Error:", lines[0][6:]
+    sys.exit(1)
+  else:
+    # the server holds the tables for some other build script.
+    stitch_server_up = False
+    return None
+
 def printUsage():
   print "Usage:", sys.argv[0], "[flags | target ...]"
   print ""
@@ -216,11 +288,16 @@ def printUsage():
   print "  -Dpropname=val      Defines a property which will be passed"
   print "                      to ant for any targets to the right of"
   print "                      the definition on the build command line"
+  print "  -j (n)              Run up to n ant jobs at once"
+  print "  -k                  With -j, carry on running the jobs that"
+  print "                      do not depend on one that failed"
   print ""
   print "  The following flags stop processing of further targets:"
   print ""
   print "  --help              Display this usage information"
   print "  --list              List all available targets"
+  print "  --deps (name)       List all the targets that the named target"
+  print "                      depends on (requires stitch --serve)"
   print "  --supports (name)   Return 'true' or 'false' if it can"
   print "                      build the named target, and exit with"
   print "                      status '0' or '1' respectively."
@@ -230,8 +307,16 @@ props=[]
 target_handlers = []
 phase_handlers = []
 
+# called once every target on the command line has been handled
+finish_handlers = []
+
 phase = "default"
 
+# the number of ant jobs to run at once (-j), and whether to carry on
+# after one fails (-k).
+jobs = 1
+keep_going = False
+
 runFlags = {}
 def run(key):
   global runFlags
@@ -269,9 +354,20 @@ while i < len(targets):
     sys.exit(1)
   elif target.startswith("-D"):
     props.append(target)
+  elif target == "-j":
+    i = i + 1
+    jobs = int(targets[i])
+  elif target.startswith("-j") and target[2:].isdigit():
+    jobs = int(target[2:])
+  elif target == "-k":
+    keep_going = True
   elif target == "--list":
     list_targets()
     sys.exit(1)
+  elif target == "--deps":
+    i = i + 1
+    list_deps(targets[i])
+    sys.exit(0)
   elif target == "--supports":
     lookup_only = True
   elif target == "--phase":
@@ -300,6 +396,9 @@ while i < len(targets):
       sys.exit(1)
   i = i + 1
 
+for handler in finish_handlers:
+  handler()
+
 if lookup_only:
   print "Error: requires target name"
   sys.exit(1)
@@ -0,0 +1,128 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Benchmark for computing recursive classpaths over a long chain of jars.
+# Each jar in the chain requires the one before it, as well as the first
+# jar (a common library). Compares the recursive walk stitch used to make
+# for every target and filter against the closures memoized by
+# AntTarget.getDependencyClassPaths().
+#
+# The old walk recursed once per level of the chain, so it needs a raised
+# recursion limit to run at all on a chain this deep, and its cost grows
+# with the square of the chain's length: at the default 5,000 jars it takes
+# a few minutes.
+#
+# Usage: python -m stitch.classpathbench [jars]
+
+import sys
+import time
+
+import stitch.targets.anttarget as anttarget
+from stitch.targets.anttarget import AllDependencies, StandaloneDepsOnly, \
+    ExcludeStandaloneChildren, ExcludeStandaloneDeps
+
+FILTERS = [ AllDependencies, StandaloneDepsOnly, ExcludeStandaloneChildren,
+    ExcludeStandaloneDeps ]
+
+
+class ChainJar(anttarget.AntTarget):
+  """ A jar in the synthetic chain; not backed by a Targets file. """
+
+  def __init__(self, index, deps):
+    self.index = index
+    self.deps = deps
+    self.safeName = "jar" + str(index)
+
+  def getDependencyTargets(self):
+    return self.deps
+
+  def generatesAntRules(self):
+    return True
+
+  def isStandalone(self):
+    return self.index % 100 == 99
+
+  def isStandaloneExempt(self):
+    return self.index % 10 == 0
+
+
+def make_chain(length):
+  jars = [ ChainJar(0, []) ]
+  for i in xrange(1, length):
+    deps = [ jars[-1] ]
+    if i > 1:
+      deps.append(jars[0])
+    jars.append(ChainJar(i, deps))
+  return jars
+
+
+def old_class_paths(target, filter, seen):
+  """ The recursive walk that getDependencyClassPaths() used to make """
+  classPaths = []
+  for dep in target.getDependencyTargets():
+    if not seen.has_key(dep):
+      seen[dep] = True
+      if anttarget.includeInClassPath(dep, filter):
+        classPaths.append(dep.getSafeName() + ".outputs")
+        classPaths.append(dep.getSafeName() + ".classpath")
+        if dep.isStandalone() and filter == ExcludeStandaloneChildren:
+          nextFilter = ExcludeStandaloneDeps
+        else:
+          nextFilter = filter
+        classPaths.extend(old_class_paths(dep, nextFilter, seen))
+  return classPaths
+
+
+def time_all(func, jars):
+  """ Return the wall-clock time in seconds to call func(jar, filter) for
+      every jar and filter, and the total number of entries returned. """
+  entries = 0
+  start = time.time()
+  for jar in jars:
+    for filter in FILTERS:
+      entries = entries + len(func(jar, filter))
+  end = time.time()
+  return (end - start, entries)
+
+
+def main(argv):
+  length = 5000
+  if len(argv) > 1:
+    length = int(argv[1])
+
+  oldLimit = sys.getrecursionlimit()
+  sys.setrecursionlimit(max(oldLimit, 2 * length + 100))
+  try:
+    (before, oldEntries) = time_all(
+        lambda jar, filter: old_class_paths(jar, filter, {}),
+        make_chain(length))
+  finally:
+    sys.setrecursionlimit(oldLimit)
+
+  # the memoized closures may not recurse at all.
+  sys.setrecursionlimit(100)
+  try:
+    jars = make_chain(length)
+    (after, newEntries) = time_all(
+        lambda jar, filter: jar.getDependencyClassPaths("build", True, filter),
+        jars)
+    (again, ignored) = time_all(
+        lambda jar, filter: jar.getDependencyClassPaths("build", True, filter),
+        jars)
+  finally:
+    sys.setrecursionlimit(oldLimit)
+
+  if oldEntries != newEntries:
+    print "Error: walks disagree (%d vs %d entries)" % (oldEntries, newEntries)
+    return 1
+
+  print "Recursive classpaths of %d chained jars, %d filters (%d entries):" \
+      % (length, len(FILTERS), newEntries)
+  print "  recursive walk:        %8.3f s" % before
+  print "  memoized closures:     %8.3f s" % after
+  print "  memoized, second call: %8.3f s" % again
+  print "  speedup: %.1fx" % (before / after)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
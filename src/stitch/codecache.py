@@ -0,0 +1,128 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# codecache: caches the compiled code objects for Targets files and
+# stitch-ext modules, in the style of python's own .pyc files.
+#
+# Each source file's code object is marshalled into a file in the
+# "code" subdirectory of ${stitch-cache-dir}. The cache file starts with
+# a header of (interpreter magic, source path, source mtime, source size);
+# if any of these differ from the current source file, it is recompiled
+# and the cache file is rewritten.
+
+import hashlib
+import imp
+import marshal
+import os
+import sys
+
+import stitch.parsecache as parsecache
+
+# subdirectory of the stitch cache dir that holds code objects
+CODE_CACHE_SUBDIR = "code"
+
+CODE_CACHE_SUFFIX = ".stc"
+
+# set to False to always compile from source (e.g., stitch --no-cache)
+__enabled = True
+
+
+def set_enabled(enabled):
+  global __enabled
+  __enabled = enabled
+
+
+def is_enabled():
+  global __enabled
+  return __enabled
+
+
+def get_cache_filename(filename):
+  """ Return the name of the file that caches the code for 'filename' """
+  cache_dir = os.path.join(parsecache.get_cache_dir(), CODE_CACHE_SUBDIR)
+  key = hashlib.md5(filename).hexdigest()
+  return os.path.join(cache_dir, key + CODE_CACHE_SUFFIX)
+
+
+def compile_file(filename):
+  """ Read and compile a python source file. Raises IOError if it
+      cannot be read and SyntaxError if it cannot be compiled. """
+  handle = open(filename)
+  try:
+    source = handle.read()
+  finally:
+    handle.close()
+  return compile(source, filename, 'exec')
+
+
+def load_code(filename):
+  """ Return the code object for the python source in 'filename', from
+      the cache if possible. Raises IOError if the file cannot be read
+      and SyntaxError if it cannot be compiled. """
+
+  filename = os.path.abspath(filename)
+  if not is_enabled():
+    return compile_file(filename)
+
+  st = os.stat(filename)
+  header = (imp.get_magic(), filename, st.st_mtime, st.st_size)
+  cache_filename = get_cache_filename(filename)
+
+  # Try to use the cached copy.
+  handle = None
+  try:
+    try:
+      handle = open(cache_filename, "rb")
+      if marshal.load(handle) == header:
+        return marshal.load(handle)
+    except (IOError, EOFError, ValueError, TypeError):
+      pass # Missing or unreadable; recompile below.
+  finally:
+    if handle != None:
+      handle.close()
+
+  code = compile_file(filename)
+
+  # Write through a temp file, so concurrent stitch workers never see
+  # a partial cache file.
+  tmp_filename = cache_filename + "." + str(os.getpid())
+  handle = None
+  try:
+    try:
+      cache_dir = os.path.dirname(cache_filename)
+      if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+      handle = open(tmp_filename, "wb")
+      marshal.dump(header, handle)
+      marshal.dump(code, handle)
+      handle.close()
+      handle = None
+      os.rename(tmp_filename, cache_filename)
+    except (IOError, OSError):
+      pass # Caching is an optimization only.
+  finally:
+    if handle != None:
+      handle.close()
+
+  return code
+
+
+def import_file(modname, filename):
+  """ Import the python source file 'filename' as the module 'modname',
+      using the code cache. As with __import__, a module that has already
+      been imported is returned as-is. """
+
+  try:
+    return sys.modules[modname]
+  except KeyError:
+    pass
+
+  code = load_code(filename)
+  mod = imp.new_module(modname)
+  mod.__file__ = filename
+  sys.modules[modname] = mod
+  try:
+    exec code in mod.__dict__
+  except:
+    del sys.modules[modname]
+    raise
+  return mod
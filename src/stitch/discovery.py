@@ -0,0 +1,331 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# discovery: finds every Targets file in the source tree in one walk, for
+# 'stitch --discover'.
+#
+# Normally stitch only learns about a Targets file when some other file
+# requires it, and checks for its existence (and resolves symlinks in its
+# path) with a few system calls each time it is mentioned. In discovery
+# mode, the whole tree under the build root is walked once by a pool of
+# threads, and the resulting index answers those questions instead.
+#
+# The walk honors .signore files as it goes: an ignored directory is not
+# descended into. Hidden directories (e.g., .git) and the build output
+# directory are skipped as well. Questions about directories the walk did
+# not visit fall back to the filesystem.
+#
+# The index is saved in ${stitch-cache-dir}/discovery.index. On the next
+# run, a directory whose mtime (and .signore file, if any) is unchanged is
+# not listed again; its entry from the saved index is reused, so a warm
+# walk costs one stat() per directory.
+
+import cPickle
+import os
+import Queue
+import threading
+
+import stitch.parsecache as parsecache
+import stitch.paths as paths
+import stitch.propstack as propstack
+import stitch.signore as signore
+
+# Increment this whenever the on-disk format of the index changes.
+INDEX_FORMAT_VERSION = 1
+
+INDEX_FILENAME = "discovery.index"
+
+# number of threads walking the tree
+DEFAULT_WALK_THREADS = 8
+
+# True if stitch --discover was given
+__enabled = False
+
+# the index built by the last call to discover()
+__index = None
+
+
+def set_enabled(enabled):
+  global __enabled
+  __enabled = enabled
+
+
+def is_enabled():
+  global __enabled
+  return __enabled
+
+
+def get_index():
+  """ Return the current DiscoveryIndex, or None if discovery is off """
+  global __index
+  return __index
+
+
+def get_index_filename():
+  return os.path.join(parsecache.get_cache_dir(), INDEX_FILENAME)
+
+
+def discover(threads=DEFAULT_WALK_THREADS):
+  """ Walk the build tree, reusing the previous index (from this process,
+      or from disk) where it is still valid, and make the result the
+      current index. Returns the new index. """
+  global __index
+
+  from stitch.buildfile import DEFAULT_BUILD_FILENAME
+
+  old_index = __index
+  if old_index == None:
+    old_index = DiscoveryIndex.load(get_index_filename())
+
+  walker = TreeWalker(DEFAULT_BUILD_FILENAME, old_index, threads)
+  __index = walker.walk(paths.getBuildRoot())
+  __index.save(get_index_filename())
+  return __index
+
+
+def has_build_file(path):
+  """ Return True if the directory 'path' (absolute, or relative to the
+      build root) contains a Targets file. """
+  index = get_index()
+  if index != None:
+    result = index.has_build_file(path)
+    if result != None:
+      return result
+
+  from stitch.buildfile import DEFAULT_BUILD_FILENAME
+  return os.path.exists(os.path.join(paths.getBuildRoot(), path,
+      DEFAULT_BUILD_FILENAME))
+
+
+def realpath(path):
+  """ os.path.realpath(), answered from the index when possible """
+  index = get_index()
+  if index != None:
+    result = index.realpath(path)
+    if result != None:
+      return result
+  return paths.realPath(path)
+
+
+class DirEntry(object):
+  """ What the walk learned about one directory """
+
+  def __init__(self, mtime, realpath, has_build_file, subdirs,
+      signore_mtime, ignore_paths):
+    self.mtime = mtime
+    self.realpath = realpath
+    self.has_build_file = has_build_file
+    self.subdirs = subdirs
+
+    # the mtime of this directory's .signore file (None if it has none),
+    # and the realpaths it ignores.
+    self.signore_mtime = signore_mtime
+    self.ignore_paths = ignore_paths
+
+
+class DiscoveryIndex(object):
+  """ Map from the absolute path of each directory the walk visited to
+      its DirEntry. """
+
+  def __init__(self, build_root, entries):
+    self.build_root = build_root
+    self.entries = entries
+
+    # number of directories listed (rather than reused) by the walk
+    # that made this index.
+    self.rescanned = len(entries)
+
+
+  def load(filename):
+    """ Read a saved index; returns an empty index if there is none """
+    handle = None
+    try:
+      try:
+        handle = open(filename, "rb")
+        data = cPickle.load(handle)
+        if data.get("version") == INDEX_FORMAT_VERSION \
+            and data.get("build_root") == paths.getBuildRoot():
+          return DiscoveryIndex(data["build_root"], data["entries"])
+      except (IOError, EOFError, cPickle.UnpicklingError, ValueError,
+          AttributeError, KeyError):
+        pass
+    finally:
+      if handle != None:
+        handle.close()
+    return DiscoveryIndex(paths.getBuildRoot(), {})
+
+  load = staticmethod(load)
+
+
+  def save(self, filename):
+    data = { "version"    : INDEX_FORMAT_VERSION,
+             "build_root" : self.build_root,
+             "entries"    : self.entries }
+
+    tmp_filename = filename + ".tmp"
+    handle = None
+    try:
+      try:
+        cache_dir = os.path.dirname(filename)
+        if not os.path.exists(cache_dir):
+          os.makedirs(cache_dir)
+        handle = open(tmp_filename, "wb")
+        cPickle.dump(data, handle, cPickle.HIGHEST_PROTOCOL)
+        handle.close()
+        handle = None
+        os.rename(tmp_filename, filename)
+      except (IOError, OSError), e:
+        print "Warning: Could not write discovery index " + filename + ":", e
+    finally:
+      if handle != None:
+        handle.close()
+
+
+  def get_entry(self, path):
+    path = os.path.normpath(os.path.join(self.build_root, path))
+    return self.entries.get(path)
+
+
+  def has_build_file(self, path):
+    """ Return True or False if the walk visited the directory 'path',
+        or None if it knows nothing about it. """
+    entry = self.get_entry(path)
+    if entry == None:
+      return None
+    return entry.has_build_file
+
+
+  def realpath(self, path):
+    """ Return the realpath of the directory 'path', or None """
+    entry = self.get_entry(path)
+    if entry == None:
+      return None
+    return entry.realpath
+
+
+  def get_build_file_dirs(self):
+    """ Return the sorted list of directories holding Targets files """
+    dirs = [ path for (path, entry) in self.entries.items()
+        if entry.has_build_file ]
+    dirs.sort()
+    return dirs
+
+
+class TreeWalker(object):
+  """ Walks a directory tree with a pool of threads, producing a
+      DiscoveryIndex. The listing of each directory is independent of the
+      others, so the threads overlap their (GIL-free) system calls. """
+
+  def __init__(self, build_filename, old_index, threads):
+    self.build_filename = build_filename
+    self.old_entries = old_index.entries
+    self.threads = threads
+
+    self.entries = {}
+    self.queue = Queue.Queue()
+
+    props = propstack.get_properties()
+    outdir = props.getProperty("outdir", props.getProperty("outsubdir", "build"))
+    self.outdir = os.path.realpath(os.path.join(paths.getBuildRoot(), outdir))
+
+
+  def walk(self, root):
+    root = os.path.abspath(root)
+    self.queue.put((root, os.path.realpath(root), [], {}))
+
+    workers = []
+    for i in range(self.threads):
+      worker = threading.Thread(target=self.run)
+      worker.setDaemon(True)
+      worker.start()
+      workers.append(worker)
+
+    self.queue.join()
+    for worker in workers:
+      self.queue.put(None)
+    for worker in workers:
+      worker.join()
+
+    index = DiscoveryIndex(paths.getBuildRoot(), self.entries)
+    index.rescanned = 0
+    for (path, entry) in self.entries.items():
+      if self.old_entries.get(path) is not entry:
+        index.rescanned = index.rescanned + 1
+    return index
+
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item == None:
+          return
+        self.visit(item)
+      finally:
+        self.queue.task_done()
+
+
+  def visit(self, item):
+    """ Index the directory 'path' (whose realpath is 'real'), and queue
+        its subdirectories. 'ignore_paths' are the realpaths ignored by
+        .signore files in its ancestors, and 'seen' holds the realpaths
+        of its ancestors, to avoid looping through symlinks. """
+    (path, real, ignore_paths, seen) = item
+
+    try:
+      mtime = os.stat(path).st_mtime
+      signore_filename = os.path.join(path, ".signore")
+      try:
+        signore_mtime = os.stat(signore_filename).st_mtime
+      except OSError:
+        signore_mtime = None
+
+      entry = self.old_entries.get(path)
+      if entry == None or entry.mtime != mtime or entry.realpath != real \
+          or entry.signore_mtime != signore_mtime:
+        entry = self.scan(path, real, mtime, signore_mtime)
+    except OSError:
+      return # vanished or unreadable; leave it to the filesystem.
+
+    self.entries[path] = entry
+
+    if len(entry.ignore_paths) > 0:
+      ignore_paths = ignore_paths + entry.ignore_paths
+    seen = seen.copy()
+    seen[real] = True
+
+    for name in entry.subdirs:
+      subdir = os.path.join(path, name)
+      if os.path.islink(subdir):
+        sub_real = os.path.realpath(subdir)
+      else:
+        sub_real = os.path.join(real, name)
+      if seen.has_key(sub_real) or sub_real == self.outdir:
+        continue
+      ignored = False
+      for ignore_path in ignore_paths:
+        if signore.isUnderPath(sub_real, ignore_path):
+          ignored = True
+          break
+      if not ignored:
+        self.queue.put((subdir, sub_real, ignore_paths, seen))
+
+
+  def scan(self, path, real, mtime, signore_mtime):
+    """ List a directory and return its new DirEntry """
+
+    has_build_file = False
+    subdirs = []
+    for name in os.listdir(path):
+      if name == self.build_filename:
+        has_build_file = os.path.isfile(os.path.join(path, name))
+      elif not name.startswith(".") and os.path.isdir(os.path.join(path, name)):
+        subdirs.append(name)
+    subdirs.sort()
+
+    if signore_mtime != None:
+      ignore_paths = signore.MMIgnore(path).ignorePaths
+    else:
+      ignore_paths = []
+
+    return DirEntry(mtime, real, has_build_file, subdirs, signore_mtime,
+        ignore_paths)
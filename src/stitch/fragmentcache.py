@@ -0,0 +1,225 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# fragmentcache: a persistent cache of the build.xml text generated for
+# each target.
+#
+# The ant generator asks each target for its preamble, its map from phase
+# to ant rule, and the text of its rules (together, its "fragment"). The
+# fragment cache records these for every target, along with:
+#
+#   - the target's fingerprint: a hash of the environment (as for the
+#     parse cache), the target's class and names, the contents of the
+#     Targets file that defined it, and the fingerprints of the targets
+#     it requires, in order. So a target's fingerprint changes whenever
+#     anything it transitively depends on does.
+#   - the fingerprints of any other targets looked up while its fragment
+#     was generated (e.g., by thunks such as CanonicalName("//foo")).
+#
+# On the next run, a target whose fingerprints all match is not asked to
+# generate its rules again; its cached fragment is used instead. Editing
+# one Targets file therefore regenerates the rules of the targets it
+# defines, and of those which depend on them.
+#
+# Like the parse cache, this assumes Targets files (and the rules their
+# targets generate) are deterministic functions of their contents; use
+# --no-cache otherwise.
+
+import cPickle
+import hashlib
+import os
+
+import stitch.graph as graph
+import stitch.parsecache as parsecache
+import stitch.targets.target as targetmodule
+
+# Increment this whenever the on-disk format of the cache changes.
+CACHE_FORMAT_VERSION = 1
+
+# name of the cache file within the stitch cache directory
+FRAGMENT_CACHE_FILENAME = "fragments.cache"
+
+
+class FragmentCache(object):
+  """ Persistent map from a target's canonical name to its fragment """
+
+  def __init__(self, filename=None, persistent=True):
+    """ If persistent is False, the cache is kept in memory only. """
+    if filename == None:
+      filename = os.path.join(parsecache.get_cache_dir(),
+          FRAGMENT_CACHE_FILENAME)
+    self.filename = filename
+    self.persistent = persistent
+    self.signature = self.get_signature()
+
+    # entries loaded from disk (or the last pass), and entries to be
+    # written back.
+    self.old_entries = {}
+    self.new_entries = {}
+
+    # map from Target to its fingerprint, for this pass.
+    self.fingerprints = {}
+
+    self.hits = 0
+    self.misses = 0
+    if self.persistent:
+      self.load()
+
+
+  def get_signature(self):
+    """ Return a string identifying everything besides the Targets files
+        that can influence the rules generated for a target """
+    extensions = parsecache.get_extension_signature().items()
+    extensions.sort()
+    return hashlib.md5(parsecache.get_environment_signature()
+        + repr(extensions)).hexdigest()
+
+
+  def refresh(self):
+    """ Prepare to generate the build again in this process: the entries
+        recorded by the last pass become the ones we reuse, unless the
+        environment has changed since. """
+    signature = self.get_signature()
+    if signature == self.signature:
+      self.old_entries = self.new_entries
+    else:
+      self.old_entries = {}
+    self.signature = signature
+    self.new_entries = {}
+    self.fingerprints = {}
+    self.hits = 0
+    self.misses = 0
+
+
+  def load(self):
+    """ Read the cache file, if present and still valid """
+    handle = None
+    try:
+      try:
+        handle = open(self.filename, "rb")
+        data = cPickle.load(handle)
+      except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+        return
+    finally:
+      if handle != None:
+        handle.close()
+
+    if not isinstance(data, dict):
+      return
+    if data.get("version") != CACHE_FORMAT_VERSION:
+      return
+    if data.get("signature") != self.signature:
+      return # environment changed; everything must be regenerated.
+
+    self.old_entries = data.get("entries", {})
+
+
+  def save(self):
+    """ Write the entries generated or reused in this run back to disk """
+    if not self.persistent:
+      return
+
+    data = { "version"   : CACHE_FORMAT_VERSION,
+             "signature" : self.signature,
+             "entries"   : self.new_entries }
+
+    cache_dir = os.path.dirname(self.filename)
+    tmp_filename = self.filename + ".tmp"
+    handle = None
+    try:
+      try:
+        if len(cache_dir) > 0 and not os.path.exists(cache_dir):
+          os.makedirs(cache_dir)
+        handle = open(tmp_filename, "wb")
+        cPickle.dump(data, handle, cPickle.HIGHEST_PROTOCOL)
+        handle.close()
+        handle = None
+        os.rename(tmp_filename, self.filename)
+      except (IOError, OSError), e:
+        print "Warning: Could not write fragment cache " + self.filename + ":", e
+    finally:
+      if handle != None:
+        handle.close()
+
+
+  def compute_fingerprints(self, targets):
+    """ Fingerprint 'targets' and everything they depend on. Dependencies
+        are done before the targets that require them, without recursion. """
+    buildGraph = graph.getBuildGraph()
+    for root in targets:
+      if self.fingerprints.has_key(root):
+        continue
+      work = [ (root, iter(self.get_dependencies(buildGraph, root))) ]
+      while len(work) > 0:
+        (target, deps) = work[-1]
+        for dep in deps:
+          if not self.fingerprints.has_key(dep):
+            work.append((dep, iter(self.get_dependencies(buildGraph, dep))))
+            break
+        else:
+          work.pop()
+          self.fingerprints[target] = self.make_fingerprint(target,
+              self.get_dependencies(buildGraph, target))
+
+
+  def get_dependencies(self, buildGraph, target):
+    if buildGraph != None and buildGraph.contains(target):
+      return buildGraph.getDependencies(target)
+    return target.getDependencyTargets()
+
+
+  def make_fingerprint(self, target, deps):
+    build_file = target.getBuildFile()
+    if build_file.contentHash == None:
+      build_file.contentHash = parsecache.hash_file(build_file.getFileName())
+
+    digest = hashlib.md5(self.signature)
+    digest.update("\0".join([ target.__class__.__module__,
+        target.__class__.__name__, target.getCanonicalName(),
+        target.getSafeName(), str(build_file.contentHash) ]))
+    for dep in deps:
+      digest.update("\0" + self.fingerprints[dep])
+    return digest.hexdigest()
+
+
+  def get_fingerprint(self, target):
+    try:
+      return self.fingerprints[target]
+    except KeyError:
+      self.compute_fingerprints([ target ])
+      return self.fingerprints[target]
+
+
+  def lookup(self, target):
+    """ Return the cached (preamble, rule map, rule texts) for 'target',
+        or None if it must be generated. """
+    name = target.getCanonicalName()
+    entry = self.old_entries.get(name)
+    if entry == None or entry["fingerprint"] != self.get_fingerprint(target):
+      self.misses = self.misses + 1
+      return None
+
+    for (refName, refFingerprint) in entry["references"]:
+      ref = targetmodule.targetMap.get(refName)
+      if ref == None or self.get_fingerprint(ref) != refFingerprint:
+        self.misses = self.misses + 1
+        return None
+
+    self.new_entries[name] = entry
+    self.hits = self.hits + 1
+    return entry["fragment"]
+
+
+  def store(self, target, fragment, references):
+    """ Record the fragment generated for 'target'. 'references' are the
+        canonical names of the targets looked up while generating it. """
+    refs = []
+    for refName in references:
+      ref = targetmodule.targetMap.get(refName)
+      if ref != None:
+        refs.append((refName, self.get_fingerprint(ref)))
+
+    self.new_entries[target.getCanonicalName()] = {
+      "fingerprint" : self.get_fingerprint(target),
+      "references"  : refs,
+      "fragment"    : fragment
+    }
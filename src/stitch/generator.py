@@ -40,6 +40,11 @@ class Generator(object):
         built-in targets """
     return ""
 
+  def getTopLevelRules(self):
+    """ return the names of the phases this generator adds to the
+        top-level script """
+    return []
+
   def getTopLevelScript(self, allTargets):
     """ return the text which should be included in the top-level
         script, as generated by this sub-generator. """
@@ -0,0 +1,262 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# graph: the dependency graph between all the targets in the build.
+#
+# The graph is built once, after all the Targets files are loaded, by
+# resolving every target's required_targets. Targets then ask it for their
+# dependencies (see Target.getDependencyTargets()) rather than resolving
+# and walking required_targets themselves.
+#
+# Dependencies are kept in the order they are listed in required_targets,
+# duplicates included, so that everything generated from the graph comes
+# out exactly as it did when targets walked their own dependencies.
+
+import sys
+
+# the graph for the current build; see setBuildGraph()
+__buildGraph = None
+
+
+def setBuildGraph(buildGraph):
+  global __buildGraph
+  __buildGraph = buildGraph
+
+
+def getBuildGraph():
+  """ return the BuildGraph for the current build, or None if it has
+      not been built yet """
+  global __buildGraph
+  return __buildGraph
+
+
+class BuildGraph(object):
+  """ Adjacency lists from each Target to the Targets it requires, and
+      back again. """
+
+  def __init__(self, allTargets):
+    self.targets = uniqueTargets(allTargets)
+
+    # Target -> list of required Targets, and the inverse.
+    self.edges = {}
+    self.reverseEdges = {}
+
+    for target in self.targets:
+      self.edges[target] = []
+      self.reverseEdges[target] = []
+
+    for target in self.targets:
+      deps = self.edges[target]
+      if getattr(target, "required_targets", None) == None:
+        continue
+      for name in target.get_required_targets():
+        dep = target.getTargetByName(name)
+        deps.append(dep)
+        if not self.reverseEdges.has_key(dep):
+          self.reverseEdges[dep] = []
+        self.reverseEdges[dep].append(target)
+
+
+  def contains(self, target):
+    return self.edges.has_key(target)
+
+
+  def getDependencies(self, target):
+    """ return the Targets 'target' requires directly, in the order they
+        are listed, including repeats. """
+    return self.edges[target]
+
+
+  def getReverseDependencies(self, target):
+    """ return the Targets which directly require 'target' """
+    return uniqueTargets(self.reverseEdges.get(target, []))
+
+
+  def getTransitiveDependencies(self, target, follow=None):
+    """ return every Target that 'target' depends on, directly or not, in
+        depth-first preorder. If 'follow' is given, only Targets for which
+        follow(t) is True are included and walked through. """
+    return self.__closure(target, self.edges, follow)
+
+
+  def getTransitiveDependents(self, target):
+    """ return every Target that depends on 'target', directly or not """
+    return self.__closure(target, self.reverseEdges, None)
+
+
+  def __closure(self, start, edges, follow):
+    seen = { start : True }
+    out = []
+    stack = [ iter(edges.get(start, [])) ]
+    while len(stack) > 0:
+      try:
+        node = stack[-1].next()
+      except StopIteration:
+        stack.pop()
+        continue
+      if seen.has_key(node) or (follow != None and not follow(node)):
+        continue
+      seen[node] = True
+      out.append(node)
+      stack.append(iter(edges.get(node, [])))
+    return out
+
+
+  def getRecursiveDependencies(self, target, follow):
+    """ return the Targets 'target' depends on recursively, walking only
+        through those for which follow(t) is True. Each Target's new direct
+        dependencies are listed together, followed by theirs in turn; this
+        is the order AntTarget.getRecursiveDependencyTargetObjs() has always
+        returned. """
+    seen = {}
+    out = []
+
+    # stack of iterators over the lists of newly-found targets to expand.
+    stack = [ iter([ target ]) ]
+    while len(stack) > 0:
+      try:
+        node = stack[-1].next()
+      except StopIteration:
+        stack.pop()
+        continue
+      newTargets = []
+      for dep in self.edges.get(node, []):
+        if follow(dep) and not seen.has_key(dep):
+          seen[dep] = True
+          out.append(dep)
+          newTargets.append(dep)
+      stack.append(iter(newTargets))
+    return out
+
+
+  def findCycles(self):
+    """ return a list of the dependency cycles in the graph. Each cycle is
+        a strongly-connected component: a list of Targets that all depend
+        on each other (or a single Target that depends on itself). """
+
+    # Tarjan's algorithm, with an explicit stack to avoid recursion limits.
+    index = {}
+    lowLink = {}
+    onStack = {}
+    sccStack = []
+    cycles = []
+    nextIndex = 0
+
+    for root in self.targets:
+      if index.has_key(root):
+        continue
+
+      work = [ (root, iter(self.edges[root])) ]
+      index[root] = lowLink[root] = nextIndex
+      nextIndex = nextIndex + 1
+      sccStack.append(root)
+      onStack[root] = True
+
+      while len(work) > 0:
+        (node, children) = work[-1]
+        try:
+          child = children.next()
+          if not index.has_key(child):
+            index[child] = lowLink[child] = nextIndex
+            nextIndex = nextIndex + 1
+            sccStack.append(child)
+            onStack[child] = True
+            work.append((child, iter(self.edges.get(child, []))))
+          elif onStack.get(child):
+            lowLink[node] = min(lowLink[node], index[child])
+          continue
+        except StopIteration:
+          pass
+
+        work.pop()
+        if len(work) > 0:
+          parent = work[-1][0]
+          lowLink[parent] = min(lowLink[parent], lowLink[node])
+
+        if lowLink[node] == index[node]:
+          scc = []
+          while True:
+            member = sccStack.pop()
+            onStack[member] = False
+            scc.append(member)
+            if member is node:
+              break
+          if len(scc) > 1 or node in self.edges.get(node, []):
+            scc.reverse()
+            cycles.append(scc)
+
+    return cycles
+
+
+  def formatCycle(self, cycle):
+    """ return a readable description of a cycle found by findCycles(),
+        following the shortest chain of dependencies from its first
+        Target back around to itself. """
+    members = {}
+    for target in cycle:
+      members[target] = True
+
+    start = cycle[0]
+    parents = { start : None }
+    queue = [ start ]
+    end = None
+    while end == None and len(queue) > 0:
+      node = queue.pop(0)
+      for dep in self.edges[node]:
+        if dep is start:
+          end = node
+          break
+        if members.has_key(dep) and not parents.has_key(dep):
+          parents[dep] = node
+          queue.append(dep)
+
+    path = [ start ]
+    while end != None:
+      path.insert(1, end)
+      end = parents[end]
+    path = path[1:] + [ start ]
+
+    return " -> ".join([ target.getCanonicalName() for target in path ])
+
+
+  def checkForCycles(self):
+    """ print every dependency cycle and exit if there are any """
+    cycles = self.findCycles()
+    if len(cycles) == 0:
+      return
+    for cycle in cycles:
+      print "Error: Circular dependency: " + self.formatCycle(cycle)
+    sys.exit(1)
+
+
+  def topologicalOrder(self):
+    """ return all the Targets, each one after everything it depends on.
+        The graph must not contain cycles. """
+    done = {}
+    out = []
+    for root in self.targets:
+      if done.has_key(root):
+        continue
+      done[root] = True
+      work = [ (root, iter(self.edges[root])) ]
+      while len(work) > 0:
+        (node, children) = work[-1]
+        try:
+          child = children.next()
+          if not done.has_key(child):
+            done[child] = True
+            work.append((child, iter(self.edges.get(child, []))))
+        except StopIteration:
+          work.pop()
+          out.append(node)
+    return out
+
+
+def uniqueTargets(targets):
+  """ return 'targets' without repeats, keeping the first of each """
+  seen = {}
+  out = []
+  for target in targets:
+    if not seen.has_key(target):
+      seen[target] = True
+      out.append(target)
+  return out
@@ -0,0 +1,77 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Unit test cases for BuildGraph
+
+import unittest
+
+import stitch.graph as graph
+from   stitch.testutil.asserts import TestCaseWithAsserts
+
+class FakeTarget(object):
+  """ Just enough of a Target to put in a BuildGraph """
+
+  def __init__(self, name, targets):
+    self.name = name
+    self.required_targets = []
+    self.targets = targets
+    targets[name] = self
+
+  def get_required_targets(self):
+    return self.required_targets
+
+  def getTargetByName(self, name):
+    return self.targets[name]
+
+  def getCanonicalName(self):
+    return "//" + self.name
+
+
+class BuildGraphTest(TestCaseWithAsserts):
+
+  def makeGraph(self, edges):
+    """ edges maps each target name to the names it requires """
+    targets = {}
+    names = edges.keys()
+    names.sort()
+    for name in names:
+      FakeTarget(name, targets)
+    for name in names:
+      targets[name].required_targets = edges[name]
+    self.targets = targets
+    return graph.BuildGraph([ targets[name] for name in names ])
+
+  def names(self, targets):
+    return [ target.name for target in targets ]
+
+  def test_topological_order(self):
+    g = self.makeGraph({ "a" : [ "b", "c" ], "b" : [ "c" ], "c" : [] })
+    self.assertEquals(self.names(g.topologicalOrder()), [ "c", "b", "a" ])
+
+  def test_closure_and_reverse(self):
+    g = self.makeGraph({ "a" : [ "b" ], "b" : [ "c" ], "c" : [], "d" : [ "c" ] })
+    self.assertEquals(self.names(g.getTransitiveDependencies(self.targets["a"])),
+        [ "b", "c" ])
+    self.assertEquals(self.names(g.getReverseDependencies(self.targets["c"])),
+        [ "b", "d" ])
+    self.assertEquals(self.names(g.getTransitiveDependents(self.targets["c"])),
+        [ "b", "a", "d" ])
+
+  def test_no_cycles(self):
+    g = self.makeGraph({ "a" : [ "b" ], "b" : [] })
+    self.assertEquals(g.findCycles(), [])
+
+  def test_cycle(self):
+    g = self.makeGraph({ "a" : [ "b" ], "b" : [ "c" ], "c" : [ "a" ], "d" : [ "a" ] })
+    cycles = g.findCycles()
+    self.assertEquals(len(cycles), 1)
+    self.assertEquals(g.formatCycle(cycles[0]), "//a -> //b -> //c -> //a")
+
+  def test_self_cycle(self):
+    g = self.makeGraph({ "a" : [ "a" ] })
+    cycles = g.findCycles()
+    self.assertEquals(len(cycles), 1)
+    self.assertEquals(g.formatCycle(cycles[0]), "//a -> //a")
+
+
+if __name__ == '__main__':
+  unittest.main()
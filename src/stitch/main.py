@@ -18,14 +18,27 @@
 #
 
 import os
+import socket
 import sys
 
+import stitch.antgenerator as antgenerator
 import stitch.buildfile as buildfile
+import stitch.codecache as codecache
+import stitch.discovery as discovery
+import stitch.fragmentcache as fragmentcache
+import stitch.graph as graph
+import stitch.manifest as manifest
 from stitch.buildgenerator import BuildGenerator
 import stitch.allgenerators as allgenerators
 import stitch.signore as signore
+import stitch.parallelload as parallelload
+import stitch.parsecache as parsecache
 import stitch.paths as paths
 import stitch.propstack as propstack
+import stitch.server as server
+import stitch.targets.target as target
+import stitch.targets.thunks as thunks
+import stitch.watch as watch
 
 ############## some helper functions ####################
 
@@ -56,6 +69,30 @@ def printUsage():
                                  qualified class name that implements
                                  stitch.generator.Generator.
                                  Only the last value of -g is used.
+    -j (n)                       Evaluate Targets files, and generate
+      (or --jobs)                their ant rules, using (n) worker
+                                 processes.
+    --discover                   Walk the whole source tree with several
+                                 threads to index every Targets file up
+                                 front, instead of checking for each one
+                                 as it is referenced. The index is kept
+                                 in the stitch cache dir for reuse.
+    --serve                      After generating the build, keep running
+                                 and answer the build script's queries
+                                 about targets over a UNIX socket in the
+                                 stitch cache dir. May be combined with
+                                 --watch.
+    --watch                      After generating the build, keep running
+                                 and regenerate it whenever a Targets,
+                                 .signore, properties or extension file
+                                 changes.
+    --no-locations               Don't record where in the Targets files
+                                 each target was defined. Faster, but
+                                 target errors cannot report locations.
+    --no-cache                   Evaluate every Targets file from source,
+                                 ignoring (and not updating) the parse,
+                                 code and build.xml fragment caches kept
+                                 in ${outdir}/stitch-cache.
 """
 
 def loadGenerator(generatorName):
@@ -87,58 +124,48 @@ def loadGenerator(generatorName):
 
 
 
-def main(argv):
-  # by default, use the BuildGenerator
-  userGenerator = BuildGenerator
-
-  if len(argv) > 0:
-    i = 1
-    while i < len(argv):
-      if argv[i] == "--list":
-        listGenerators()
-        return 0
-      elif argv[i] == "-C":
-        if i == len(argv) -1:
-          print "Error: directory name required. See --help for usage."
-          return 1
-        i = i + 1
-        os.chdir(argv[i])
-      elif argv[i] == "--help":
-        printUsage()
-        return 0
-      elif argv[i] == "--executable":
-        if i == len(argv) - 1:
-          print "Error: executable name required."
-          return 1
-        i = i + 1
-        propstack.set_bin_dir_by_executable(argv[i])
-      elif argv[i] == "-g" or argv[i] == "--generator":
-        if i == len(argv) - 1:
-          print "Error: generator name required. See --help for usage."
-          return 1
-        i = i + 1
-        userGenerator = loadGenerator(argv[i])
-      i = i + 1
+def loadBuildFiles(parseCache=None, loader=None):
+  """ Starting in the build root, evaluate all the reachable Targets
+      files and return the list of their BuildFile objects. """
 
-  paths.setBuildRoot(os.getcwd())
+  if discovery.is_enabled():
+    index = discovery.discover()
+    print "Discovery:", len(index.get_build_file_dirs()), "Targets file(s) in", \
+        len(index.entries), "directories,", index.rescanned, "listed"
 
   # start out by processing the current directory.
   filesToProcess = [os.getcwd()]
   initialBuildRoot = paths.getFullBuildFilePath(".")
-  realPathToBuildRoot = os.path.realpath(initialBuildRoot)
+  realPathToBuildRoot = discovery.realpath(initialBuildRoot)
   filesSeen = [ initialBuildRoot, realPathToBuildRoot]
 
   buildFileObjects = []
-  allTargets = []
 
   # read in all the BuildFile objects
 
   while len(filesToProcess) > 0:
     nextBatch = [] # next BFS frontier
+
+    # first check to make sure these aren't in an ignore list.
+    ignoreFilePaths = []
     for file in filesToProcess:
-      # first check to make sure this isn't in an ignore list.
       signore.loadThroughPath(file)
-      ignoreFilePath = signore.shouldIgnorePath(file)
+      ignoreFilePaths.append(signore.shouldIgnorePath(file))
+
+    # evaluate the files we aren't ignoring or restoring from cache
+    # in the worker processes, if we have them.
+    cacheEntries = {}
+    if loader != None:
+      toEvaluate = []
+      for (file, ignoreFilePath) in zip(filesToProcess, ignoreFilePaths):
+        if ignoreFilePath == None and (parseCache == None
+            or parseCache.lookup(buildfile.getBuildFileName(file)) == None):
+          toEvaluate.append(file)
+      entries = loader.evaluate(toEvaluate)
+      for (file, entry) in zip(toEvaluate, entries):
+        cacheEntries[file] = entry
+
+    for (file, ignoreFilePath) in zip(filesToProcess, ignoreFilePaths):
       if ignoreFilePath != None:
         # don't do anything more for this buildfile
         print "s-ignoring", file, "(" + ignoreFilePath + ")"
@@ -147,7 +174,7 @@ def main(argv):
       # process the file
       print "Processing", file
 
-      bf = buildfile.BuildFile(file)
+      bf = buildfile.BuildFile(file, parseCache, cacheEntries.get(file))
       buildFileObjects.append(bf)
 
       # now get the next list of targets to add
@@ -155,7 +182,7 @@ def main(argv):
       newTargets = bf.getRequiredBuildFiles()
       for newTarget in newTargets:
         newTarget = paths.getFullBuildFilePath(newTarget)
-        realPathToNewTarget = os.path.realpath(newTarget)
+        realPathToNewTarget = discovery.realpath(newTarget)
 
         # is the user-specified path one we've processed?
         try:
@@ -173,13 +200,182 @@ def main(argv):
           filesSeen.append(realPathToNewTarget)
     filesToProcess = nextBatch
 
+  return buildFileObjects
+
+
+def stitchBuild(userGenerator, parseCache=None, loader=None, stitchServer=None):
+  """ Load all the Targets files and run the generator over their
+      targets. If a stitch server is given, it is updated to serve the new
+      build tables. Returns the list of BuildFile objects that were loaded. """
+
+  buildFileObjects = loadBuildFiles(parseCache, loader)
+
+  if loader != None:
+    loader.close()
+
+  if parseCache != None:
+    print "Parse cache:", parseCache.hits, "file(s) reused,", \
+        parseCache.misses, "evaluated"
+    parseCache.save()
+
+  # the state of the files the build is generated from, for the manifest.
+  inputs = manifest.snapshot(manifest.get_input_files(buildFileObjects))
+
   # get the list of Target objects
+  allTargets = []
   for buildFile in buildFileObjects:
     allTargets.extend(buildFile.getTargets())
 
+  # every target is defined now, so forced thunks can be reused.
+  thunks.setThunkCacheEnabled(True)
+
+  # resolve all the references between targets up front, and make
+  # sure they don't go around in circles.
+  target.buildResolutionIndex(allTargets)
+  buildGraph = graph.BuildGraph(allTargets)
+  buildGraph.checkForCycles()
+  graph.setBuildGraph(buildGraph)
+
   gen = userGenerator()
   gen.generate(allTargets)
 
+  stats = paths.getPathCacheStats()
+  print "Path cache:", stats["hits"], "of", stats["lookups"], \
+      "lookups reused,", stats["syscalls_avoided"], "filesystem calls avoided"
+  stats = thunks.getThunkCacheStats()
+  print "Thunk cache:", stats["hits"], "of", stats["hits"] + stats["misses"], \
+      "forces reused"
+
+  fragmentCache = antgenerator.getFragmentCache()
+  if fragmentCache != None:
+    print "Fragment cache:", fragmentCache.hits, "of", \
+        fragmentCache.hits + fragmentCache.misses, "targets reused"
+    fragmentCache.save()
+
+  manifest.write_manifest(inputs)
+
+  if stitchServer != None:
+    tables = getattr(gen, "tables", None)
+    if tables == None:
+      tables = server.BuildTables(allTargets)
+    stitchServer.set_tables(tables)
+
+  return buildFileObjects
+
+
+def main(argv):
+  # by default, use the BuildGenerator
+  userGenerator = BuildGenerator
+  useParseCache = True
+  jobs = 1
+  watchMode = False
+  serveMode = False
+
+  if len(argv) > 0:
+    i = 1
+    while i < len(argv):
+      if argv[i] == "--list":
+        listGenerators()
+        return 0
+      elif argv[i] == "-C":
+        if i == len(argv) -1:
+          print "Error: directory name required. See --help for usage."
+          return 1
+        i = i + 1
+        os.chdir(argv[i])
+      elif argv[i] == "--help":
+        printUsage()
+        return 0
+      elif argv[i] == "--executable":
+        if i == len(argv) - 1:
+          print "Error: executable name required."
+          return 1
+        i = i + 1
+        propstack.set_bin_dir_by_executable(argv[i])
+      elif argv[i] == "-g" or argv[i] == "--generator":
+        if i == len(argv) - 1:
+          print "Error: generator name required. See --help for usage."
+          return 1
+        i = i + 1
+        userGenerator = loadGenerator(argv[i])
+      elif argv[i] == "-j" or argv[i] == "--jobs":
+        if i == len(argv) - 1:
+          print "Error: number of jobs required. See --help for usage."
+          return 1
+        i = i + 1
+        try:
+          jobs = int(argv[i])
+        except ValueError:
+          print "Error: invalid number of jobs:", argv[i]
+          return 1
+      elif argv[i] == "--watch":
+        watchMode = True
+      elif argv[i] == "--discover":
+        discovery.set_enabled(True)
+      elif argv[i] == "--serve":
+        serveMode = True
+      elif argv[i] == "--no-locations":
+        target.setCaptureDefinitionLocations(False)
+      elif argv[i] == "--no-cache":
+        useParseCache = False
+      i = i + 1
+
+  paths.setBuildRoot(os.getcwd())
+
+  if useParseCache:
+    parseCache = parsecache.ParseCache()
+    antgenerator.setFragmentCache(fragmentcache.FragmentCache())
+  else:
+    codecache.set_enabled(False)
+    if watchMode:
+      # Regeneration still needs the in-memory caches.
+      parseCache = parsecache.ParseCache(persistent=False)
+      antgenerator.setFragmentCache(
+          fragmentcache.FragmentCache(persistent=False))
+    else:
+      parseCache = None
+
+  if jobs > 1 and parallelload.is_available():
+    loader = parallelload.ParallelLoader(jobs)
+    antgenerator.setGenerationJobs(jobs)
+  else:
+    if jobs > 1:
+      print "Warning: parallel evaluation requires python 2.6; running serially"
+    loader = None
+
+  if serveMode:
+    stitchServer = server.StitchServer()
+    server.setServing(True)
+  else:
+    stitchServer = None
+
+  buildFileObjects = stitchBuild(userGenerator, parseCache, loader,
+      stitchServer)
+
+  if stitchServer != None:
+    try:
+      try:
+        if watchMode:
+          stitchServer.start()
+        else:
+          stitchServer.serve_forever()
+      except socket.error, e:
+        print "Error: Could not start the stitch server:", e
+        return 1
+    finally:
+      if not watchMode:
+        stitchServer.close()
+
+  if watchMode:
+    def regenerate():
+      return stitchBuild(userGenerator, parseCache, loader, stitchServer)
+    try:
+      return watch.watch(regenerate, parseCache,
+          manifest.get_input_files(buildFileObjects))
+    finally:
+      if stitchServer != None:
+        stitchServer.close()
+
   return 0
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# manifest: records the files a generated build was made from.
+#
+# After generating the build, stitch writes the mtime and size of every
+# file it read to do so (the Targets files, .signore files, properties
+# files and stitch-ext modules) to ${stitch-cache-dir}/inputs.manifest.
+# Files that were looked for but did not exist are listed too, so that
+# creating one is noticed.
+#
+# The build script stat()s the files in the manifest before it runs ant.
+# If none of them changed, it tells ant that the build is up to date, so
+# that the stitch-uptodate rule need not scan the tree for Targets files.
+# Otherwise it runs stitch first. 'stitch --watch' uses the same list of
+# files to decide what to watch.
+
+import os
+
+import stitch.parsecache as parsecache
+import stitch.propstack as propstack
+import stitch.signore as signore
+
+MANIFEST_FILENAME = "inputs.manifest"
+
+
+def get_manifest_filename():
+  return os.path.join(parsecache.get_cache_dir(), MANIFEST_FILENAME)
+
+
+def get_input_files(buildFileObjects):
+  """ Return the absolute paths of every file that the generated build
+      depends on, given the BuildFiles that were loaded. """
+
+  files = []
+  for bf in buildFileObjects:
+    files.append(bf.getFileName())
+  files.extend(signore.getLoadedIgnoreFiles())
+  files.extend(propstack.get_properties_files())
+
+  # The extension dir itself is included too, to notice new modules.
+  ext_dir = propstack.get_properties().getProperty("stitch-extensions")
+  if ext_dir != None and os.path.isdir(ext_dir):
+    files.append(ext_dir)
+    for file in os.listdir(ext_dir):
+      if file.endswith(".py"):
+        files.append(os.path.join(ext_dir, file))
+
+  return [ os.path.abspath(file) for file in files ]
+
+
+def snapshot(files):
+  """ Return a map from each filename to its (mtime, size), or None for
+      files which do not exist. """
+  out = {}
+  for file in files:
+    try:
+      st = os.stat(file)
+      out[file] = (st.st_mtime, st.st_size)
+    except OSError:
+      out[file] = None
+  return out
+
+
+def write_manifest(state):
+  """ Write the snapshot 'state' to the manifest file. Each line holds the
+      mtime, size and name of a file, separated by single spaces; the
+      mtime and size are both '-' if the file did not exist. """
+
+  files = state.keys()
+  files.sort()
+  lines = [ "# files read by stitch: mtime size filename\n" ]
+  for file in files:
+    if state[file] == None:
+      lines.append("- - " + file + "\n")
+    else:
+      (mtime, size) = state[file]
+      lines.append(repr(mtime) + " " + str(size) + " " + file + "\n")
+
+  filename = get_manifest_filename()
+  cache_dir = os.path.dirname(filename)
+  handle = None
+  try:
+    try:
+      if len(cache_dir) > 0 and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+      handle = open(filename + ".tmp", "w")
+      handle.write("".join(lines))
+      handle.close()
+      handle = None
+      os.rename(filename + ".tmp", filename)
+    except (IOError, OSError), e:
+      print "Warning: Could not write manifest " + filename + ":", e
+  finally:
+    if handle != None:
+      handle.close()
@@ -0,0 +1,350 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# parallelgenerator: lets the build script run ant rules as parallel jobs.
+#
+# Ant runs the rules a phase depends on one at a time. With 'sbuild -j N',
+# the build script instead divides the rules it needs into jobs, and runs
+# up to N of them at once, each in its own ant process. A job starts once
+# the jobs of the targets it depends on have succeeded.
+#
+# A job runs the rules of one target. Each target's rules depend on the
+# build rules of the targets it requires, so if a job needs those, the
+# jobs of the required targets run their build rules first. Ant runs
+# each job on a build file which imports build.xml and replaces the
+# rules that other jobs run with empty ones; everything else a job's
+# rules depend on, such as the target's own helper rules and shared
+# rules like init and release-version, runs in the job's ant process as
+# usual, so each job sees the properties those set. The top-level phase
+# rules run last, in a job of their own, after the rest.
+#
+# Properties set by one job are not seen by the others, so a job which
+# sets the "failed" property (as failing tests and findbugs do) fails
+# itself.
+#
+# This generator writes the plan the build script divides the work from
+# to ${outdir}/parallel.plan. It has a line for each phase:
+#   phase <TAB> name <TAB> the shared rules it depends on, comma-separated
+# and a line for each target that generates ant rules:
+#   target <TAB> name <TAB> required targets <TAB> phase=rule,phase=rule
+# The plan is made from the phases' rule lists kept by the AntGenerator
+# and the BuildGraph, so this must run after the AntGenerator.
+
+import os
+
+import stitch.antgenerator as antgenerator
+import stitch.generator as generator
+import stitch.graph as graph
+import stitch.paths as paths
+import stitch.propstack as propstack
+import stitch.util.fileutils as fileutils
+
+PLAN_FILENAME = "parallel.plan"
+
+# the rule each job runs last, to fail it if the "failed" property is set.
+CHECK_RULE = "parallel-job-check"
+
+
+def getPlanLines(allTargets, phaseRules):
+  """ Return the lines of the plan file, given all the targets and the
+      AntGenerator's map from each phase to its (target name, rule)
+      entries. Generates one line at a time. """
+
+  # each target's map from phase to rule; and each phase's shared rules.
+  targetRules = {}
+  phases = phaseRules.keys()
+  phases.sort()
+  for phase in phases:
+    shared = []
+    for (target_name, rule) in phaseRules[phase]:
+      if target_name.startswith(paths.ROOT_QUALIFIER):
+        if not targetRules.has_key(target_name):
+          targetRules[target_name] = []
+        targetRules[target_name].append(phase + "=" + rule)
+      else:
+        shared.append(rule)
+    yield "phase\t" + phase + "\t" + ",".join(shared) + "\n"
+
+  buildGraph = graph.getBuildGraph()
+  if buildGraph == None:
+    buildGraph = graph.BuildGraph(allTargets)
+
+  for target in buildGraph.topologicalOrder():
+    name = target.getCanonicalName()
+    if not targetRules.has_key(name):
+      continue
+    deps = []
+    for dep in graph.uniqueTargets(buildGraph.getDependencies(target)):
+      if targetRules.has_key(dep.getCanonicalName()):
+        deps.append(dep.getCanonicalName())
+    yield "target\t" + name + "\t" + ",".join(deps) + "\t" \
+        + ",".join(targetRules[name]) + "\n"
+
+
+class ParallelGenerator(generator.Generator):
+  """ Writes the plan that 'sbuild -j' uses to run the rules in the
+      build.xml written by the AntGenerator as parallel jobs. This is
+      created by the BuildGenerator along with the AntGenerator, and must
+      run after it. """
+
+  def __init__(self):
+    generator.Generator.__init__(self)
+
+
+  def getBuildDir(self):
+    antprops = propstack.get_properties()
+    return antprops.getProperty("outsubdir", "build")
+
+
+  def generate(self, allTargets):
+    build_dir = self.getBuildDir()
+    if not os.path.exists(build_dir):
+      os.mkdir(build_dir)
+
+    filename = os.path.join(build_dir, PLAN_FILENAME)
+    phaseRules = antgenerator.getAntGenerator().getPhaseRules()
+    handle = open(filename + ".tmp", "w")
+    try:
+      for line in getPlanLines(allTargets, phaseRules):
+        handle.write(line)
+    finally:
+      handle.close()
+    fileutils.replace_if_changed(filename + ".tmp", filename)
+
+
+  def getTopLevelScript(self, allTargets):
+    """ Return the build script's code to run ant rules as parallel jobs.
+        run_ant_targets() calls run_ant_jobs() if -j was given. """
+
+    antprops = propstack.get_properties()
+    build_dir = self.getBuildDir()
+
+    return """
+
+# Read the plan of the build's ant rules from %(PLAN)s. Returns the
+# shared rules of each phase, the targets in the order they must be
+# built, the targets each requires, and each target's map from phase to
+# rule; or None if there is no plan.
+def load_ant_plan():
+  try:
+    handle = open("%(PLAN)s")
+  except IOError:
+    return None
+  phase_rules = {}
+  order = []
+  target_deps = {}
+  target_rules = {}
+  try:
+    for line in handle:
+      fields = line.rstrip("\\n").split("\\t")
+      if fields[0] == "phase":
+        phase_rules[fields[1]] = [ r for r in fields[2].split(",") if r ]
+      elif fields[0] == "target":
+        target = fields[1]
+        order.append(target)
+        target_deps[target] = [ d for d in fields[2].split(",") if d ]
+        target_rules[target] = {}
+        for entry in fields[3].split(","):
+          (phase, rule) = entry.split("=", 1)
+          target_rules[target][phase] = rule
+  finally:
+    handle.close()
+  return (phase_rules, order, target_deps, target_rules)
+
+# Divide running ant_targets into jobs. Returns the lists of the jobs'
+# names, of the rules each runs, of the rules each must replace with
+# empty ones, and of the jobs each must wait for; or None if ant_targets
+# cannot be divided up.
+def plan_ant_jobs(ant_targets, plan):
+  (phase_rules, order, target_deps, target_rules) = plan
+
+  # the target and phase of each rule.
+  rule_owner = {}
+  for target in order:
+    for (phase, rule) in target_rules[target].items():
+      if phase != "default" or not rule_owner.has_key(rule):
+        rule_owner[rule] = (target, phase)
+
+  # the rules each target's job runs, and whether they need the build
+  # rules of the targets it requires.
+  job_rules = {}
+  needs_deps = {}
+  def add_rule(target, rule, phase):
+    if not job_rules.has_key(target):
+      job_rules[target] = []
+    if not rule in job_rules[target]:
+      job_rules[target].append(rule)
+    if phase.find("clean") == -1:
+      needs_deps[target] = True
+
+  # the phases to run, with the phases their shared rules run in turn.
+  expanded = {}
+  def add_phase(phase):
+    if expanded.has_key(phase):
+      return
+    expanded[phase] = True
+    if phase_rules.has_key(phase + "-inner"):
+      phase = phase + "-inner"
+    for target in order:
+      if target_rules[target].has_key(phase):
+        add_rule(target, target_rules[target][phase], phase)
+    for rule in phase_rules[phase]:
+      if phase_rules.has_key(rule):
+        add_phase(rule)
+
+  last_rules = []
+  for name in ant_targets:
+    if phase_rules.has_key(name):
+      add_phase(name)
+      last_rules.append(name)
+    elif rule_owner.has_key(name):
+      (target, phase) = rule_owner[name]
+      add_rule(target, name, phase)
+    else:
+      return None
+
+  # the targets required by those that need them get build jobs.
+  for target in reversed(order):
+    if not needs_deps.has_key(target):
+      continue
+    for dep in target_deps[target]:
+      if target_rules[dep].has_key("build"):
+        add_rule(dep, target_rules[dep]["build"], "build")
+
+  job_names = [ target for target in order if job_rules.has_key(target) ]
+  job_index = {}
+  for i in range(len(job_names)):
+    job_index[job_names[i]] = i
+  rules = []
+  stubs = []
+  job_deps = []
+  for target in job_names:
+    rules.append(job_rules[target])
+    deps = []
+    stub = []
+    if needs_deps.has_key(target):
+      for dep in target_deps[target]:
+        if job_index.has_key(dep):
+          deps.append(job_index[dep])
+          stub.extend(job_rules[dep])
+    stubs.append(stub)
+    job_deps.append(deps)
+
+  if len(last_rules) > 0:
+    # the phase rules themselves, after all of the targets' rules.
+    job_names.append(" ".join(last_rules))
+    rules.append(last_rules)
+    stub = []
+    for target_rule_list in rules[:-1]:
+      stub.extend(target_rule_list)
+    stubs.append(stub)
+    job_deps.append(range(len(job_names) - 1))
+
+  return (job_names, rules, stubs, job_deps)
+
+# Write the build file for a job, which imports build.xml and replaces
+# the rules in 'stubs' with empty ones. Returns its name.
+def write_ant_job_file(stubs):
+  import tempfile
+  (fd, filename) = tempfile.mkstemp(".xml", "parallel-", "%(BUILD_DIR)s")
+  handle = os.fdopen(fd, "w")
+  try:
+    handle.write("<project name=\\"parallel\\" basedir=\\"..\\">\\n")
+    handle.write("  <import file=\\"build.xml\\" />\\n")
+    for rule in stubs:
+      handle.write("  <target name=\\"" + rule + "\\" />\\n")
+    handle.write("  <target name=\\"%(CHECK_RULE)s\\">\\n")
+    handle.write("    <fail if=\\"failed\\" message=\\"Tests or checks failed\\" />\\n")
+    handle.write("  </target>\\n")
+    handle.write("</project>\\n")
+  finally:
+    handle.close()
+  return filename
+
+parallel_ant_opts = %(ANT_OPTS)s
+
+# Run ant_targets (with the arguments 'args') as parallel jobs, up to
+# 'jobs' at a time, printing each job's output when it finishes. Returns
+# the exit status, or None if they must be run by a single ant instead.
+def run_ant_jobs(ant_targets, args):
+  import subprocess
+  import tempfile
+  import time
+
+  plan = load_ant_plan()
+  if plan == None:
+    return None
+  job_plan = plan_ant_jobs(ant_targets, plan)
+  if job_plan == None:
+    return None
+  (job_names, job_rules, job_stubs, job_deps) = job_plan
+  if len(job_names) < 2:
+    return None
+
+  fix_ant_classpath()
+  env = os.environ.copy()
+  if len(parallel_ant_opts) > 0:
+    env["ANT_OPTS"] = parallel_ant_opts
+
+  waiting = [ len(deps) for deps in job_deps ]
+  dependents = [ [] for name in job_names ]
+  for i in range(len(job_names)):
+    for dep in job_deps[i]:
+      dependents[dep].append(i)
+  ready = [ i for i in range(len(job_names)) if waiting[i] == 0 ]
+  running = []
+  failures = []
+  finished = 0
+
+  print "Running", len(job_names), "ant jobs,", jobs, "at a time"
+  while True:
+    while len(ready) > 0 and len(running) < jobs \\
+        and (keep_going or len(failures) == 0):
+      i = ready.pop(0)
+      log = tempfile.TemporaryFile()
+      job_file = write_ant_job_file(job_stubs[i])
+      command = [ "ant", "-f", job_file, "-Dant.executor.class="
+          + "org.apache.tools.ant.helper.SingleCheckExecutor" ] \\
+          + args + job_rules[i] + [ "%(CHECK_RULE)s" ]
+      process = subprocess.Popen(command, stdout=log,
+          stderr=subprocess.STDOUT, env=env)
+      running.append((i, process, log, job_file))
+    if len(running) == 0:
+      break
+
+    still_running = []
+    for (i, process, log, job_file) in running:
+      status = process.poll()
+      if status == None:
+        still_running.append((i, process, log, job_file))
+        continue
+
+      finished = finished + 1
+      os.remove(job_file)
+      print "[%%d/%%d] %%s" %% (finished, len(job_names), job_names[i])
+      log.seek(0)
+      sys.stdout.write(log.read())
+      sys.stdout.flush()
+      log.close()
+      if status != 0:
+        failures.append(job_names[i])
+        continue
+      for j in dependents[i]:
+        waiting[j] = waiting[j] - 1
+        if waiting[j] == 0:
+          ready.append(j)
+    if len(still_running) == len(running):
+      time.sleep(0.05)
+    running = still_running
+
+  if len(failures) > 0:
+    print "Failed jobs:", ", ".join(failures)
+    if finished < len(job_names):
+      print len(job_names) - finished, "jobs were not run"
+    return 1
+  return 0
+
+""" % { "PLAN" : os.path.join(build_dir, PLAN_FILENAME),
+        "BUILD_DIR" : build_dir,
+        "CHECK_RULE" : CHECK_RULE,
+        "ANT_OPTS" : repr(antprops.getProperty("parallel-ant-opts", "")) }
+
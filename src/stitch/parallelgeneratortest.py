@@ -0,0 +1,186 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Unit test cases for the plan written by the parallel generator, and the
+# build script's division of it into jobs
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import stitch.graph as graph
+import stitch.parallelgenerator as parallelgenerator
+import stitch.propstack as propstack
+import stitch.testutil.anttools as anttools
+from   stitch.graphtest import FakeTarget
+from   stitch.testutil.asserts import TestCaseWithAsserts
+
+NO_TARGET = "___special_no_target"
+
+class RulePlanTest(TestCaseWithAsserts):
+
+  def setUp(self):
+    # //a requires //b; //c stands alone.
+    targets = {}
+    for name in [ "a", "b", "c" ]:
+      FakeTarget(name, targets)
+    targets["a"].required_targets = [ "b", "b" ]
+    self.allTargets = [ targets["a"], targets["b"], targets["c"] ]
+    graph.setBuildGraph(graph.BuildGraph(self.allTargets))
+
+    self.phaseRules = {
+      "build" : [ ("//a", ".a-build"), ("//b", ".b-build"),
+                  ("//c", ".c-build"), (NO_TARGET, "init") ],
+      "test" : [ ("//a", ".a-test"), (NO_TARGET, "init") ],
+      "clean" : [ ("//a", ".a-clean"), ("//b", ".b-clean") ],
+    }
+
+    # the build script's functions, made with the stitch properties in
+    # this source tree.
+    stitch_home = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "..", "..")
+    propstack.set_bin_dir_by_executable(os.path.join(stitch_home, "bin",
+        "stitch"))
+    self.script = {}
+    exec parallelgenerator.ParallelGenerator().getTopLevelScript(None) \
+        in self.script
+
+    # the plan file is read from ${outsubdir} in the current directory.
+    self.work_dir = tempfile.mkdtemp()
+    self.build_dir = os.path.join(self.work_dir,
+        parallelgenerator.ParallelGenerator().getBuildDir())
+    os.mkdir(self.build_dir)
+
+  def tearDown(self):
+    graph.setBuildGraph(None)
+    shutil.rmtree(self.work_dir)
+
+  def getPlan(self):
+    """ return the plan as the build script reads it """
+    anttools.write_file(os.path.join(self.build_dir,
+        parallelgenerator.PLAN_FILENAME),
+        "".join(parallelgenerator.getPlanLines(self.allTargets,
+        self.phaseRules)))
+    old_dir = os.getcwd()
+    os.chdir(self.work_dir)
+    try:
+      return self.script["load_ant_plan"]()
+    finally:
+      os.chdir(old_dir)
+
+  def test_plan_lines(self):
+    lines = list(parallelgenerator.getPlanLines(self.allTargets,
+        self.phaseRules))
+    self.assertEquals(lines, [
+        "phase\tbuild\tinit\n",
+        "phase\tclean\t\n",
+        "phase\ttest\tinit\n",
+        "target\t//b\t\tbuild=.b-build,clean=.b-clean\n",
+        "target\t//a\t//b\tbuild=.a-build,clean=.a-clean,test=.a-test\n",
+        "target\t//c\t\tbuild=.c-build\n" ])
+
+  def test_load_plan(self):
+    (phase_rules, order, target_deps, target_rules) = self.getPlan()
+    self.assertEquals(phase_rules, { "build" : [ "init" ], "clean" : [],
+        "test" : [ "init" ] })
+    self.assertEquals(order, [ "//b", "//a", "//c" ])
+    self.assertEquals(target_deps, { "//a" : [ "//b" ], "//b" : [],
+        "//c" : [] })
+    self.assertEquals(target_rules["//a"], { "build" : ".a-build",
+        "clean" : ".a-clean", "test" : ".a-test" })
+    self.assertEquals(target_rules["//c"], { "build" : ".c-build" })
+
+  def test_phase_jobs(self):
+    (names, rules, stubs, deps) = self.script["plan_ant_jobs"]([ "build" ],
+        self.getPlan())
+    self.assertEquals(names, [ "//b", "//a", "//c", "build" ])
+    self.assertEquals(rules, [ [ ".b-build" ], [ ".a-build" ],
+        [ ".c-build" ], [ "build" ] ])
+    # //a's job replaces the rule //b's job runs; the phase rule's job
+    # replaces all of them.
+    self.assertEquals(stubs, [ [], [ ".b-build" ], [],
+        [ ".b-build", ".a-build", ".c-build" ] ])
+    self.assertEquals(deps, [ [], [ 0 ], [], [ 0, 1, 2 ] ])
+
+  def test_rule_needs_required_builds(self):
+    (names, rules, stubs, deps) = self.script["plan_ant_jobs"]([ ".a-test" ],
+        self.getPlan())
+    self.assertEquals(names, [ "//b", "//a" ])
+    self.assertEquals(rules, [ [ ".b-build" ], [ ".a-test" ] ])
+    self.assertEquals(stubs, [ [], [ ".b-build" ] ])
+    self.assertEquals(deps, [ [], [ 0 ] ])
+
+  def test_clean_jobs_are_independent(self):
+    (names, rules, stubs, deps) = self.script["plan_ant_jobs"]([ "clean" ],
+        self.getPlan())
+    self.assertEquals(names, [ "//b", "//a", "clean" ])
+    self.assertEquals(stubs[:2], [ [], [] ])
+    self.assertEquals(deps, [ [], [], [ 0, 1 ] ])
+
+  def test_unknown_rule(self):
+    self.assertNone(self.script["plan_ant_jobs"]([ "clean-all" ],
+        self.getPlan()))
+
+
+class ParallelBuildTest(TestCaseWithAsserts):
+  """ Runs builds with sbuild -j. These need ant; without it they pass
+      with a note. """
+
+  def setUp(self):
+    self.project_dir = None
+    if not anttools.have_ant("ParallelBuildTest"):
+      return
+
+    self.project_dir = tempfile.mkdtemp()
+    # two version strings, built by separate jobs.
+    os.mkdir(os.path.join(self.project_dir, "one"))
+    os.mkdir(os.path.join(self.project_dir, "two"))
+    self.writeFile("targets",
+        "all = ProjectList(required_targets=[ '//one', '//two' ])\n")
+    self.writeFile("one/targets",
+        "ver = VerStringTarget(version='1.0', python_module='verone')\n")
+    self.writeFile("two/targets",
+        "ver = VerStringTarget(version='2.0', python_module='vertwo')\n")
+
+    # stands in for makeVer.py, recording the version strings it is given.
+    self.version_log = os.path.join(self.project_dir, "versions.log")
+    self.writeFile("makever.sh",
+        "#!/bin/sh\necho \"$@\" >> " + self.version_log + "\n")
+    os.chmod(os.path.join(self.project_dir, "makever.sh"), 0755)
+    self.writeFile("build.properties", "make-version-exec="
+        + os.path.join(self.project_dir, "makever.sh") + "\n")
+
+    (status, output) = anttools.run_stitch(self.project_dir)
+    self.assertEquals(status, 0, output)
+
+  def tearDown(self):
+    if self.project_dir != None:
+      shutil.rmtree(self.project_dir)
+
+  def writeFile(self, name, text):
+    anttools.write_file(os.path.join(self.project_dir, name), text)
+
+  def test_version_strings(self):
+    if self.project_dir == None:
+      return
+    (status, output) = anttools.run_sbuild(self.project_dir,
+        [ "-j", "2", "one", "two" ])
+    self.assertEquals(status, 0, output)
+    self.assert_(output.find("Running 2 ant jobs") != -1, output)
+
+    # each job ran release-version, which sets the suffix and subdir.
+    handle = open(self.version_log)
+    try:
+      versions = handle.read()
+    finally:
+      handle.close()
+    self.assert_(versions.find("--verstring 1.0-test") != -1, versions)
+    self.assert_(versions.find("--verstring 2.0-test") != -1, versions)
+    self.assertEquals(versions.find("${"), -1, versions)
+    genfiles = os.path.join(self.project_dir, "build", "genfiles")
+    self.assert_(os.path.isdir(os.path.join(genfiles, "one", "test")))
+    self.assert_(os.path.isdir(os.path.join(genfiles, "two", "test")))
+
+
+if __name__ == "__main__":
+  unittest.main()
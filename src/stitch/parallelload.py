@@ -0,0 +1,76 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# parallelload: evaluates the Targets files of one BFS frontier in a pool
+# of worker processes.
+#
+# Evaluating a Targets file registers targets with the global current
+# build file and the global targetMap, so it cannot be done on several
+# threads of one interpreter. Instead, each worker process executes the
+# Targets file and returns a parse cache entry (see stitch.parsecache)
+# describing the targets it created. The main process then restores the
+# entries into BuildFile objects in frontier order, which assigns
+# anonymous names and registers canonical names exactly as a serial run
+# would; the generated build files are therefore identical.
+#
+# Requires the multiprocessing module (python 2.6+); on older
+# interpreters stitch runs serially.
+
+import stitch.buildfile as buildfile
+import stitch.parsecache as parsecache
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
+
+
+def is_available():
+  """ Return True if this interpreter can evaluate files in parallel """
+  return multiprocessing != None
+
+
+def evaluate_build_file(path):
+  """ Worker function: evaluate the Targets file at 'path' and return its
+      parse cache entry. Returns None if the file could not be evaluated
+      or its targets cannot be pickled; the main process then evaluates
+      it itself, reporting any errors in the usual way. """
+  try:
+    bf = buildfile.BuildFile(path)
+    return parsecache.make_entry(bf)
+  except:
+    return None
+
+
+class ParallelLoader(object):
+  """ Evaluates lists of Targets files using a pool of 'jobs' worker
+      processes. The pool is started on first use, so that workers
+      inherit the extensions and properties loaded by then. """
+
+  def __init__(self, jobs):
+    self.jobs = jobs
+    self.pool = None
+
+
+  def evaluate(self, paths):
+    """ Evaluate the Targets files in 'paths'. Returns a list, parallel
+        to 'paths', of parse cache entries (or None for files that must
+        be evaluated by the caller). """
+
+    if len(paths) < 2:
+      # Not worth a round trip through the pool.
+      return [ None ] * len(paths)
+
+    if self.pool == None:
+      # Load the extensions before forking, so each worker doesn't.
+      buildfile.get_extensions()
+      self.pool = multiprocessing.Pool(self.jobs)
+
+    chunksize = max(1, len(paths) / (self.jobs * 4))
+    return self.pool.map(evaluate_build_file, paths, chunksize)
+
+
+  def close(self):
+    if self.pool != None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
@@ -0,0 +1,321 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# parsecache: a persistent cache of evaluated Targets files.
+#
+# Executing every Targets file in a large tree dominates the runtime of
+# stitch. The parse cache records, for each Targets file we evaluate:
+#
+#   - the md5 hash of the file's contents
+#   - the signature of the stitch-ext modules it was evaluated against
+#   - the (pickled) Target objects it created, including all of their
+#     arguments and required_targets
+#   - the names bound to those targets by the file
+#   - the list of build files it pulls in via getRequiredBuildFiles()
+#
+# On the next run, a Targets file whose contents and extension environment
+# are unchanged is restored from the cache instead of being executed.
+#
+# The whole cache is discarded if the properties files, the build root,
+# the python interpreter or stitch itself have changed since it was written.
+#
+# Targets files are assumed to be deterministic functions of their own
+# contents. A Targets file that inspects the filesystem or mutates global
+# state (e.g., CopyDir.always_exclude()) must be handled by running stitch
+# with --no-cache.
+
+import cPickle
+import hashlib
+import os
+import sys
+
+import stitch.propstack as propstack
+
+# Increment this whenever the on-disk format of the cache changes.
+CACHE_FORMAT_VERSION = 1
+
+# name of the cache file within the stitch cache directory
+PARSE_CACHE_FILENAME = "parse.cache"
+
+# persistent id used to refer to the BuildFile that owns the pickled targets
+BUILD_FILE_PID = "buildfile"
+
+
+def get_cache_dir():
+  """ Return the directory where stitch keeps its on-disk caches """
+  props = propstack.get_properties()
+  outdir = props.getProperty("outdir", props.getProperty("outsubdir", "build"))
+  return props.getProperty("stitch-cache-dir",
+      os.path.join(outdir, "stitch-cache"))
+
+
+def hash_file(filename):
+  """ Return the md5 hex digest of a file's contents, or None if the file
+      cannot be read. """
+  handle = None
+  try:
+    try:
+      handle = open(filename, "rb")
+      return hashlib.md5(handle.read()).hexdigest()
+    except IOError:
+      return None
+  finally:
+    if handle != None:
+      handle.close()
+
+
+def get_extension_signature():
+  """ Return a map from extension module name to the hash of its source,
+      for every module in the stitch-ext directory. """
+  props = propstack.get_properties()
+  ext_dir = props.getProperty("stitch-extensions")
+  signature = {}
+  if ext_dir == None or not os.path.isdir(ext_dir):
+    return signature
+
+  for file in os.listdir(ext_dir):
+    if file.endswith(".py"):
+      signature[file[:-3]] = hash_file(os.path.join(ext_dir, file))
+  return signature
+
+
+def get_environment_signature():
+  """ Return a string identifying everything besides a Targets file and
+      the extensions that can influence the results of evaluating it. """
+  import stitch.paths as paths
+  import stitch.targets.target as target
+
+  digest = hashlib.md5()
+  digest.update(str(CACHE_FORMAT_VERSION))
+  digest.update(sys.version)
+  digest.update(paths.getBuildRoot())
+  digest.update(str(target.getCaptureDefinitionLocations()))
+
+  # The properties files loaded by propstack.
+  for props_file in propstack.get_properties_files():
+    digest.update(props_file + "=" + str(hash_file(props_file)))
+
+  # stitch's own sources; the pickled targets depend on their class layout.
+  stitch_dir = os.path.dirname(os.path.abspath(__file__))
+  for (dirpath, dirnames, filenames) in os.walk(stitch_dir):
+    dirnames.sort()
+    filenames.sort()
+    for file in filenames:
+      if file.endswith(".py"):
+        st = os.stat(os.path.join(dirpath, file))
+        digest.update("%s:%d:%d" % (os.path.join(dirpath, file),
+            st.st_mtime, st.st_size))
+
+  return digest.hexdigest()
+
+
+class ParseCache(object):
+  """ Persistent map from Targets file path to the results of evaluating
+      that file. BuildFile consults this via restore() and store(). """
+
+  def __init__(self, filename=None, persistent=True):
+    """ If persistent is False, the cache is kept in memory only. """
+    if filename == None:
+      filename = os.path.join(get_cache_dir(), PARSE_CACHE_FILENAME)
+    self.filename = filename
+    self.persistent = persistent
+    self.signature = get_environment_signature()
+    self.extensions = get_extension_signature()
+
+    # entries loaded from disk, and entries to be written back.
+    self.old_entries = {}
+    self.new_entries = {}
+
+    self.hits = 0
+    self.misses = 0
+    if self.persistent:
+      self.load()
+
+
+  def refresh(self):
+    """ Prepare to load the Targets files again in this process: the
+        entries recorded by the last pass become the ones we restore
+        from, unless the environment has changed since. """
+    signature = get_environment_signature()
+    if signature == self.signature:
+      self.old_entries = self.new_entries
+    else:
+      self.old_entries = {}
+    self.signature = signature
+    self.extensions = get_extension_signature()
+    self.new_entries = {}
+    self.hits = 0
+    self.misses = 0
+
+
+  def load(self):
+    """ Read the cache file, if present and still valid """
+    handle = None
+    try:
+      try:
+        handle = open(self.filename, "rb")
+        data = cPickle.load(handle)
+      except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+        return
+    finally:
+      if handle != None:
+        handle.close()
+
+    if not isinstance(data, dict):
+      return
+    if data.get("version") != CACHE_FORMAT_VERSION:
+      return
+    if data.get("signature") != self.signature:
+      return # environment changed; everything must be re-evaluated.
+
+    self.old_entries = data.get("entries", {})
+
+
+  def save(self):
+    """ Write all the entries recorded or reused in this run back to disk.
+        Entries for Targets files we did not visit are dropped. """
+    if not self.persistent:
+      return
+
+    data = { "version"   : CACHE_FORMAT_VERSION,
+             "signature" : self.signature,
+             "entries"   : self.new_entries }
+
+    cache_dir = os.path.dirname(self.filename)
+    tmp_filename = self.filename + ".tmp"
+    handle = None
+    try:
+      try:
+        if len(cache_dir) > 0 and not os.path.exists(cache_dir):
+          os.makedirs(cache_dir)
+        handle = open(tmp_filename, "wb")
+        cPickle.dump(data, handle, cPickle.HIGHEST_PROTOCOL)
+        handle.close()
+        handle = None
+        os.rename(tmp_filename, self.filename)
+      except (IOError, OSError), e:
+        print "Warning: Could not write parse cache " + self.filename + ":", e
+    finally:
+      if handle != None:
+        handle.close()
+
+
+  def lookup(self, filename, file_hash=None):
+    """ Return the cache entry for the Targets file 'filename' if it is
+        still valid, or None if the file must be evaluated. """
+
+    try:
+      entry = self.old_entries[filename]
+    except KeyError:
+      return None
+
+    if file_hash == None:
+      file_hash = hash_file(filename)
+    if entry["hash"] != file_hash \
+        or entry["extensions"] != self.extensions:
+      return None
+
+    # Make sure everything this file depends on is still there. If not,
+    # evaluate the file normally so that the usual error is reported.
+    import stitch.discovery as discovery
+    for req in entry["required"]:
+      if not discovery.has_build_file(req):
+        return None
+
+    return entry
+
+
+  def restore(self, build_file):
+    """ If the cache holds a valid entry for build_file, load its targets
+        into the BuildFile and return True. Otherwise return False, and the
+        caller must execute the Targets file itself. """
+
+    build_file.contentHash = hash_file(build_file.getFileName())
+    entry = self.lookup(build_file.getFileName(), build_file.contentHash)
+    if entry == None:
+      self.misses = self.misses + 1
+      return False
+
+    try:
+      restore_entry(build_file, entry)
+    except Exception:
+      # Classes may have moved or been removed; treat this as a miss.
+      self.misses = self.misses + 1
+      return False
+
+    self.new_entries[build_file.getFileName()] = entry
+    self.hits = self.hits + 1
+    return True
+
+
+  def store(self, build_file, entry=None):
+    """ Record the results of evaluating build_file. If the entry was
+        already made (e.g., by a worker process) it is passed in 'entry'.
+        Files whose targets cannot be pickled are silently left uncached. """
+
+    if entry == None:
+      try:
+        entry = make_entry(build_file)
+      except Exception:
+        return
+
+    entry["extensions"] = self.extensions
+    self.new_entries[build_file.getFileName()] = entry
+
+
+def make_entry(build_file):
+  """ Return a cache entry describing an evaluated BuildFile. Raises an
+      exception if its targets cannot be pickled. """
+
+  if build_file.contentHash == None:
+    build_file.contentHash = hash_file(build_file.getFileName())
+
+  return { "hash"     : build_file.contentHash,
+           "state"    : pickle_state(build_file),
+           "required" : build_file.getRequiredBuildFiles() }
+
+
+def restore_entry(build_file, entry):
+  """ Load the targets described by a cache entry into build_file, in place
+      of executing its Targets file. """
+
+  # Targets may be instances of classes defined in the extension modules;
+  # these must be importable before we unpickle.
+  from stitch.buildfile import get_extensions
+  get_extensions()
+
+  (targets, default_target, named_targets) = \
+      unpickle_state(entry["state"], build_file)
+  build_file.restoreState(targets, default_target, named_targets,
+      entry["required"])
+
+
+def pickle_state(build_file):
+  """ Pickle the targets of a BuildFile. References to the BuildFile itself
+      are stored by id, so that on restore they point at the new object. """
+  from cStringIO import StringIO
+
+  def persistent_id(obj):
+    if obj is build_file:
+      return BUILD_FILE_PID
+    return None
+
+  buf = StringIO()
+  pickler = cPickle.Pickler(buf, cPickle.HIGHEST_PROTOCOL)
+  pickler.persistent_id = persistent_id
+  pickler.dump((build_file.getTargets(), build_file.defaultTarget,
+      build_file.namedTargets))
+  return buf.getvalue()
+
+
+def unpickle_state(state, build_file):
+  """ Inverse of pickle_state(); binds the targets to build_file. """
+  from cStringIO import StringIO
+
+  def persistent_load(pid):
+    if pid == BUILD_FILE_PID:
+      return build_file
+    raise cPickle.UnpicklingError("Unknown persistent id: " + str(pid))
+
+  unpickler = cPickle.Unpickler(StringIO(state))
+  unpickler.persistent_load = persistent_load
+  return unpickler.load()
@@ -34,6 +34,7 @@ buildRoot = os.path.abspath(os.getcwd())
 def setBuildRoot(root):
   global buildRoot
   buildRoot = os.path.abspath(root)
+  invalidatePathCache()
 
 def getBuildRoot():
   global buildRoot
@@ -46,15 +47,125 @@ def getFullBuildFilePath(partialPath):
       buildroot, in an absolute, canonicalized form """
   return os.path.abspath(os.path.join(getBuildRoot(), partialPath))
 
-def getRelativeBuildFilePath(path):
-  """ return the directory containing the current build file,
-      relative to the BuildRoot. If the target is not a subdirectory
-      of the buildroot, returns the whole path.
-      targets that are not subdirectories of the buildroot. """
+
+# The results of canonicalizing paths, and of the filesystem calls that
+# takes, are cached for the rest of the run. The same few paths are
+# canonicalized over and over (once per reference to a target), and each
+# uncached realpath() costs an lstat() per path component -- noticeable on
+# NFS. Relative paths are taken relative to the current directory, which
+# stitch does not change after setting the build root.
+#
+# Anything that lets the filesystem change underneath a running stitch
+# (e.g., stitch --watch) must call invalidatePathCache() before reusing
+# these results.
+
+# maximum number of entries in each cache before it is emptied
+MAX_PATH_CACHE_SIZE = 100000
+
+# path -> ((relative, canonical name, safe name), syscalls it took)
+__canonicalCache = {}
+
+# path -> (os.path.realpath(path), lstat() calls it took)
+__realPathCache = {}
+
+# path -> os.path.isfile(path)
+__isFileCache = {}
+
+# instrumentation; see getPathCacheStats()
+__pathCacheStats = {}
+
+
+def invalidatePathCache():
+  """ forget all cached path information """
+  global __canonicalCache, __realPathCache, __isFileCache, __pathCacheStats
+  __canonicalCache = {}
+  __realPathCache = {}
+  __isFileCache = {}
+  __pathCacheStats = { "lookups"          : 0,
+                       "hits"             : 0,
+                       "realpath_calls"   : 0,
+                       "isfile_calls"     : 0,
+                       "syscalls_avoided" : 0 }
+
+invalidatePathCache()
+
+
+def getPathCacheStats():
+  """ return a dict of counters describing the path caches:
+        lookups           calls to canonicalizePath()
+        hits              of those, how many were already cached
+        realpath_calls    os.path.realpath() calls actually made
+        isfile_calls      os.path.isfile() calls actually made
+        syscalls_avoided  estimated stat()/lstat() calls saved by caching
+  """
+  global __pathCacheStats
+  return __pathCacheStats.copy()
+
+
+def __countAvoided(num):
+  global __pathCacheStats
+  __pathCacheStats["syscalls_avoided"] = \
+      __pathCacheStats["syscalls_avoided"] + num
+
+
+def __realPathCost(path):
+  """ the number of lstat() calls realpath() makes for 'path'. This is
+      only worked out when a path is added to a cache; hits count the
+      cost stored with the entry. """
+  return len([ part for part in os.path.abspath(path).split(os.sep)
+      if len(part) > 0 ])
+
+
+def realPath(path):
+  """ os.path.realpath(), cached """
+  global __realPathCache, __pathCacheStats
+  try:
+    (result, cost) = __realPathCache[path]
+    __countAvoided(cost)
+    return result
+  except KeyError:
+    if len(__realPathCache) >= MAX_PATH_CACHE_SIZE:
+      __realPathCache = {}
+    __pathCacheStats["realpath_calls"] = __pathCacheStats["realpath_calls"] + 1
+    result = os.path.realpath(path)
+    __realPathCache[path] = (result, __realPathCost(path))
+    return result
+
+
+def isFile(path):
+  """ os.path.isfile(), cached """
+  global __isFileCache, __pathCacheStats
+  try:
+    result = __isFileCache[path]
+    __countAvoided(1)
+    return result
+  except KeyError:
+    if len(__isFileCache) >= MAX_PATH_CACHE_SIZE:
+      __isFileCache = {}
+    __pathCacheStats["isfile_calls"] = __pathCacheStats["isfile_calls"] + 1
+    result = os.path.isfile(path)
+    __isFileCache[path] = result
+    return result
+
+
+def canonicalizePath(path):
+  """ return the tuple (relative path, canonical name, safe name) for a
+      path to a build file or its directory; see getRelativeBuildFilePath(),
+      getCanonicalName() and getSafeName(). """
+  global __canonicalCache, __pathCacheStats
+
+  __pathCacheStats["lookups"] = __pathCacheStats["lookups"] + 1
+  try:
+    (result, cost) = __canonicalCache[path]
+    __pathCacheStats["hits"] = __pathCacheStats["hits"] + 1
+    __countAvoided(cost)
+    return result
+  except KeyError:
+    pass
 
   # normalize everything
   buildRoot = getBuildRoot()
-  fullPath = os.path.realpath(path) # changed from abspath; resolves symlinks
+  fullPath = realPath(path) # changed from abspath; resolves symlinks
 
   # if there's a common prefix with the buildroot, chop it off.
   common = os.path.commonprefix([buildRoot, fullPath])
@@ -68,26 +179,33 @@ def getRelativeBuildFilePath(path):
   relative = fullPath[len(common):]
 
   # remove the name of the Targets file if it was added
-  if os.path.isfile(relative):
+  if isFile(relative):
     relative = os.path.dirname(relative)
 
-  return relative
+  result = (relative, ROOT_QUALIFIER + relative, relative.replace(os.sep, "."))
+  if len(__canonicalCache) >= MAX_PATH_CACHE_SIZE:
+    __canonicalCache = {}
+  __canonicalCache[path] = (result, __realPathCost(path) + 1)
+  return result
+
+
+def getRelativeBuildFilePath(path):
+  """ return the directory containing the current build file,
+      relative to the BuildRoot. If the target is not a subdirectory
+      of the buildroot, returns the whole path.
+      targets that are not subdirectories of the buildroot. """
+  return canonicalizePath(path)[0]
 
 
 def getCanonicalName(path):
   """ Return the translated name from path elements to the
       canonicalized target name which appears in other
       Targets files """
-  relative = getRelativeBuildFilePath(path)
-  return ROOT_QUALIFIER + relative
+  return canonicalizePath(path)[1]
 
 
 def getSafeName(path):
   """ Return the translated name from path elements to
       a canonicalized target name which can be put into
       ant build files, etc. """
-
-  relative = getRelativeBuildFilePath(path)
-  return relative.replace(os.sep, ".")
-
-
+  return canonicalizePath(path)[2]
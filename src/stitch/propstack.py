@@ -41,6 +41,18 @@ def get_stitch_home():
   return os.path.abspath(stitch_home)
 
 
+def get_properties_files():
+  """ return the list of properties files that get_properties() reads """
+  return [ "my.properties", "build.properties",
+      os.path.join(get_stitch_home(), "etc/stitch-config.properties") ]
+
+
+def reset_properties():
+  """ discard the loaded properties; they are re-read on next use. """
+  global __internal_properties
+  __internal_properties = None
+
+
 def get_properties():
   global __internal_properties
 
@@ -50,7 +62,9 @@ def get_properties():
     # Set the basedir first.
     __internal_properties.setProperty("basedir", os.path.abspath(os.getcwd()))
 
+    # build.xml sets stitch-home before it reads the properties files.
     stitch_home = get_stitch_home()
+    __internal_properties.setProperty("stitch-home", stitch_home)
 
     try:
       h = open("my.properties")
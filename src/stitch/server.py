@@ -0,0 +1,286 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# server: implements 'stitch --serve'. A resident stitch process holds the
+# tables that the generated build script consults -- the list of target
+# names, the map from (phase, target) to ant rule, and the dependencies
+# between targets -- and answers queries about them over a UNIX domain
+# socket in the stitch cache directory.
+#
+# The build script asks the server first, and falls back to the tables
+# embedded in itself if no server is running. Each build script carries the
+# id of the tables it was generated with; a server holding different tables
+# (e.g., the build was regenerated by another stitch process) answers
+# "stale" and the script uses its own tables.
+#
+# Protocol: the client sends one line of tab-separated fields,
+#
+#   tables_id <tab> command [<tab> argument ...]
+#
+# and the server replies with "ok" followed by zero or more result lines,
+# or with a single "stale" or "error <message>" line, then closes the
+# connection. Commands are:
+#
+#   list                     all target names
+#   lookup <phase> <target>  the ant rule for a target (none if unknown)
+#   deps <target>            the targets required by a target
+#   alldeps <target>         all targets a target transitively depends on
+#   rdeps <target>           the targets which require a target
+#   ping                     nothing; checks that the server is up
+
+import hashlib
+import os
+import select
+import SocketServer
+import socket
+import threading
+
+import stitch.antgenerator as antgenerator
+import stitch.graph as graph
+import stitch.parsecache as parsecache
+import stitch.paths as paths
+
+SOCKET_FILENAME = "stitch.sock"
+
+# how often (in seconds) a server started with start() checks whether it
+# has been closed.
+POLL_INTERVAL = 0.2
+
+
+# Set by stitch --serve, when a stitch server will answer the build
+# script's queries; the build tables are only computed if so.
+serving = False
+
+def setServing(enabled):
+  global serving
+  serving = enabled
+
+def isServing():
+  global serving
+  return serving
+
+
+def get_socket_filename():
+  """ Return the absolute path of the stitch server's socket """
+  return os.path.join(paths.getBuildRoot(), parsecache.get_cache_dir(),
+      SOCKET_FILENAME)
+
+
+class BuildTables(object):
+  """ The answers to everything the build script may ask about the
+      targets, computed once from the list of all Target objects. """
+
+  def __init__(self, allTargets):
+    self.canonical_names = []
+    self.ant_map = {}
+    self.deps = {}
+    self.rdeps = {}
+    self.aliases = {}
+
+    for target in allTargets:
+      if target.generatesAntRules() and not target.is_anonymous():
+        self.canonical_names.append(target.getCanonicalName())
+    self.canonical_names.sort()
+
+    for (phase, name, ant_rule) in \
+        antgenerator.getAntGenerator().getAntMapEntries(allTargets):
+      self.ant_map[(phase, name)] = ant_rule
+
+    buildGraph = graph.getBuildGraph()
+    if buildGraph == None:
+      buildGraph = graph.BuildGraph(allTargets)
+
+    for target in allTargets:
+      name = target.getCanonicalName()
+      self.add_aliases(name)
+      self.deps[name] = [ dep.getCanonicalName() for dep in
+          graph.uniqueTargets(buildGraph.getDependencies(target)) ]
+      self.rdeps[name] = [ dep.getCanonicalName() for dep in
+          buildGraph.getReverseDependencies(target) ]
+
+    self.id = self.compute_id()
+
+
+  def add_aliases(self, name):
+    """ Map all the names the user may use for a target to its canonical
+        name, as for the ant rule map. """
+    dequalified = paths.dequalify(name)
+    if dequalified.find(":") != -1:
+      trail_slash = dequalified.replace(":", os.sep + ":")
+    else:
+      trail_slash = dequalified + os.sep
+    for alias in [ dequalified, trail_slash ]:
+      self.aliases[alias] = name
+      self.aliases["//" + alias] = name
+
+
+  def compute_id(self):
+    """ Return a string identifying the contents of these tables """
+    ant_map = self.ant_map.items()
+    ant_map.sort()
+    deps = self.deps.items()
+    deps.sort()
+    return hashlib.md5(repr((self.canonical_names, ant_map, deps))).hexdigest()
+
+
+  def resolve(self, name):
+    """ Return the canonical name for a target name, or None """
+    return self.aliases.get(name)
+
+
+  def get_all_deps(self, name):
+    """ Return the sorted names of everything 'name' depends on """
+    seen = {}
+    stack = [ name ]
+    while len(stack) > 0:
+      for dep in self.deps.get(stack.pop(), []):
+        if not seen.has_key(dep):
+          seen[dep] = True
+          stack.append(dep)
+    out = seen.keys()
+    out.sort()
+    return out
+
+
+  def query(self, command, args):
+    """ Answer one query; returns the list of result lines. Raises
+        ValueError if the query is malformed. """
+
+    if command == "ping":
+      return []
+    elif command == "list":
+      return self.canonical_names
+    elif command == "lookup" and len(args) == 2:
+      try:
+        return [ self.ant_map[(args[0], args[1])] ]
+      except KeyError:
+        return []
+    elif (command == "deps" or command == "alldeps" or command == "rdeps") \
+        and len(args) == 1:
+      name = self.resolve(args[0])
+      if name == None:
+        raise ValueError("No such target: " + args[0])
+      if command == "deps":
+        return self.deps[name]
+      elif command == "rdeps":
+        return self.rdeps[name]
+      else:
+        return self.get_all_deps(name)
+    else:
+      raise ValueError("Bad request: " + " ".join([command] + args))
+
+
+class StitchRequestHandler(SocketServer.StreamRequestHandler):
+  """ Answers a single request on a connection to the stitch server """
+
+  def handle(self):
+    fields = self.rfile.readline().rstrip("\n").split("\t")
+    tables = self.server.stitch_server.tables
+    if len(fields) < 2:
+      self.wfile.write("error Bad request\n")
+    elif tables == None or fields[0] != tables.id:
+      self.wfile.write("stale\n")
+    else:
+      try:
+        lines = tables.query(fields[1], fields[2:])
+        self.wfile.write("ok\n")
+        for line in lines:
+          self.wfile.write(line + "\n")
+      except ValueError, e:
+        self.wfile.write("error " + str(e) + "\n")
+
+
+class StitchServer(object):
+  """ Serves a BuildTables object on the stitch socket. The tables may be
+      replaced at any time with set_tables(). """
+
+  def __init__(self, socket_filename=None):
+    if socket_filename == None:
+      socket_filename = get_socket_filename()
+    self.socket_filename = socket_filename
+    self.tables = None
+    self.server = None
+    self.thread = None
+
+    # set by close() to stop the background thread (see start()).
+    self.stopping = False
+
+
+  def set_tables(self, tables):
+    # replacing the reference is atomic; handlers see the old or new tables.
+    self.tables = tables
+
+
+  def is_running(self):
+    """ Return True if another server is already answering on our socket """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      try:
+        sock.connect(self.socket_filename)
+        return True
+      except socket.error:
+        return False
+    finally:
+      sock.close()
+
+
+  def open(self):
+    """ Bind the socket. Raises socket.error if it cannot be bound. """
+    if self.is_running():
+      raise socket.error("A stitch server is already running on "
+          + self.socket_filename)
+
+    # remove the socket left behind by a server that died.
+    if os.path.exists(self.socket_filename):
+      os.remove(self.socket_filename)
+
+    socket_dir = os.path.dirname(self.socket_filename)
+    if not os.path.exists(socket_dir):
+      os.makedirs(socket_dir)
+
+    self.server = SocketServer.ThreadingUnixStreamServer(self.socket_filename,
+        StitchRequestHandler)
+    self.server.daemon_threads = True
+    self.server.stitch_server = self
+
+
+  def start(self):
+    """ Open the socket and serve requests in a background thread """
+    self.open()
+    self.stopping = False
+    self.thread = threading.Thread(target=self.serve_until_stopped)
+    self.thread.setDaemon(True)
+    self.thread.start()
+
+
+  def serve_until_stopped(self):
+    """ Serve requests until close() sets self.stopping. (SocketServer's
+        serve_forever() cannot be stopped before python 2.6.) """
+    while not self.stopping:
+      (readable, writable, errors) = select.select([ self.server.socket ],
+          [], [], POLL_INTERVAL)
+      if len(readable) > 0 and not self.stopping:
+        self.server.handle_request()
+
+
+  def serve_forever(self):
+    """ Open the socket and serve requests until interrupted """
+    self.open()
+    try:
+      print "Serving build tables on", self.socket_filename + ". Press ^C to stop."
+      self.server.serve_forever()
+    except KeyboardInterrupt:
+      print "Stopped serving."
+
+
+  def close(self):
+    if self.server != None:
+      if self.thread != None:
+        self.stopping = True
+        self.thread.join()
+        self.thread = None
+      self.server.server_close()
+      self.server = None
+      try:
+        os.remove(self.socket_filename)
+      except OSError:
+        pass
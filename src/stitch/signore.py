@@ -35,6 +35,60 @@ import stitch.paths as paths
 
 allIgnoreFiles = {}
 
+# trie of every path ignored by the loaded .signore files.
+ignoreTrie = None
+
+
+def isUnderPath(path, prefix):
+  """ return True if 'path' is 'prefix' or inside the directory 'prefix' """
+  if not path.startswith(prefix):
+    return False
+  return len(path) == len(prefix) or prefix.endswith(os.sep) \
+      or path[len(prefix)] == os.sep
+
+
+class IgnoreTrie(object):
+  """ Map from the components of each ignored path to the name of the
+      .signore file that ignores it. Finding the file that ignores a path
+      takes one step per component of the path. """
+
+  def __init__(self):
+    # each node is a dict from path component to child node; the key
+    # None holds the .signore filename for a path ending at that node.
+    self.root = {}
+
+  def add(self, path, filename):
+    node = self.root
+    for part in path.split(os.sep):
+      if len(part) > 0:
+        node = node.setdefault(part, {})
+    if not node.has_key(None):
+      node[None] = filename
+
+  def lookup(self, path):
+    """ return the filename of the .signore file that ignores the real
+        path 'path' or one of its parents, or None. """
+    node = self.root
+    if node.has_key(None):
+      return node[None]
+    for part in path.split(os.sep):
+      if len(part) > 0:
+        node = node.get(part)
+        if node == None:
+          return None
+        if node.has_key(None):
+          return node[None]
+    return None
+
+
+def getIgnoreTrie():
+  global ignoreTrie
+
+  if ignoreTrie == None:
+    ignoreTrie = IgnoreTrie()
+  return ignoreTrie
+
+
 def loadThroughPath(path):
   """ recursively loads signore files in 'path' and all parent
       directories of 'path' up to (and including) the build root.
@@ -49,29 +103,40 @@ def loadThroughPath(path):
   thisPath = os.path.abspath(path)
   while os.path.commonprefix([thisPath, absBuildRoot]) == absBuildRoot:
 
-    try:
-      # test: did we already parse this one?
-      allIgnoreFiles[thisPath]
-    except KeyError:
-      # nope; parse it and add to the map.
-      allIgnoreFiles[thisPath] = MMIgnore(thisPath)
+    if allIgnoreFiles.has_key(thisPath):
+      # we've already been here, so all the parents are loaded too.
+      break
+
+    mmi = MMIgnore(thisPath)
+    allIgnoreFiles[thisPath] = mmi
+    for ignorePath in mmi.ignorePaths:
+      getIgnoreTrie().add(ignorePath, mmi.getFilename())
 
     # go up one level.
     thisPath = os.path.abspath(thisPath + os.sep + "..")
 
 
+def getLoadedIgnoreFiles():
+  """ return the filenames of all the .signore files (present or not)
+      consulted so far """
+  global allIgnoreFiles
+
+  return [ mmi.getFilename() for mmi in allIgnoreFiles.values() ]
+
+
+def reset():
+  """ forget all loaded .signore files """
+  global allIgnoreFiles, ignoreTrie
+
+  allIgnoreFiles = {}
+  ignoreTrie = None
+
+
 def shouldIgnorePath(path):
   """ return the path to the signore file that contains
       'path', or None if we don't ignore the input path. """
 
-  global allIgnoreFiles
-
-  for key in allIgnoreFiles.keys():
-    mmi = allIgnoreFiles[key]
-    if mmi.ignorePath(path):
-      return mmi.getFilename()
-
-  return None
+  return getIgnoreTrie().lookup(paths.realPath(path))
 
 
 class MMIgnore(object):
@@ -120,9 +185,9 @@ class MMIgnore(object):
     """ return True if pathName is a directory that should be ignored
         because of this .signore file. """
 
-    realTestPath = os.path.realpath(testPath)
+    realTestPath = paths.realPath(testPath)
     for path in self.ignorePaths:
-      if realTestPath.startswith(path):
+      if isUnderPath(realTestPath, path):
         return True
 
     return False
@@ -0,0 +1,43 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Unit test cases for the .signore path index
+
+import unittest
+
+import stitch.signore as signore
+from   stitch.testutil.asserts import TestCaseWithAsserts
+
+class IgnoreTrieTest(TestCaseWithAsserts):
+
+  def setUp(self):
+    self.trie = signore.IgnoreTrie()
+    self.trie.add("/src/foo", "/src/.signore")
+    self.trie.add("/src/bar/baz", "/src/bar/.signore")
+
+  def test_exact_path(self):
+    self.assertEquals(self.trie.lookup("/src/foo"), "/src/.signore")
+
+  def test_subpath(self):
+    self.assertEquals(self.trie.lookup("/src/bar/baz/quux"), "/src/bar/.signore")
+
+  def test_parent_not_ignored(self):
+    self.assertEquals(self.trie.lookup("/src"), None)
+    self.assertEquals(self.trie.lookup("/src/bar"), None)
+
+  def test_sibling_prefix_not_ignored(self):
+    # component-wise match: /src/foobar is not inside /src/foo
+    self.assertEquals(self.trie.lookup("/src/foobar"), None)
+
+  def test_shallowest_match_wins(self):
+    self.trie.add("/src/foo/deeper", "/src/foo/.signore")
+    self.assertEquals(self.trie.lookup("/src/foo/deeper/x"), "/src/.signore")
+
+  def test_is_under_path(self):
+    self.assert_(signore.isUnderPath("/a/b", "/a"))
+    self.assert_(signore.isUnderPath("/a", "/a"))
+    self.assert_(signore.isUnderPath("/a", "/"))
+    self.assert_(not signore.isUnderPath("/ab", "/a"))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -495,8 +495,7 @@ class EmptyTarget(AntTarget):
 
     paths = []
 
-    for dep in self.required_targets:
-      target = self.getTargetByName(dep)
+    for target in self.getDependencyTargets():
       if hasattr(target, "intermediatePathsForLang"):
         paths.extend(target.intermediatePathsForLang(lang))
 
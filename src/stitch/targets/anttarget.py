@@ -7,6 +7,7 @@
 
 import os
 
+import stitch.graph as graph
 import stitch.paths as paths
 from   stitch.targets.targeterror import TargetError
 from   stitch.targets.target import Target
@@ -17,6 +18,15 @@ StandaloneDepsOnly = 1
 ExcludeStandaloneChildren = 2
 ExcludeStandaloneDeps = 3
 
+def includeInClassPath(target, filter):
+  """ return True if the dependency 'target' belongs in a recursive
+      classpath built with 'filter' """
+  return filter == AllDependencies \
+      or filter == ExcludeStandaloneChildren \
+      or (filter == StandaloneDepsOnly and not target.isStandaloneExempt()) \
+      or (filter == ExcludeStandaloneDeps and target.isStandaloneExempt())
+
+
 class AntTarget(Target):
   """ Abstract class that provides functions that most
       targets generating ant rules will use. Subclassing AntTarget
@@ -78,6 +88,12 @@ class AntTarget(Target):
   def antRule(self, rule):
     raise TargetError(self, "AntTarget is an abstract class")
 
+  def writeAntRule(self, writer, rule):
+    """ write the text of antRule(rule) to the XmlWriter 'writer'.
+        Targets with large rules may override this to write their rules
+        out a piece at a time. """
+    writer.write(self.antRule(rule))
+
   def getClassPathElements(self):
     """ all AntTarget subclasses have a classpath_elements field """
     if self.classpath_elements == None:
@@ -86,15 +102,11 @@ class AntTarget(Target):
 
   def getDependencyClassPaths(self, ruleType, recursive=False,
       filter=AllDependencies):
-    return self.getDependencyClassPathsAux(ruleType, recursive, filter, [])
-
-  def getDependencyClassPathsAux(self, ruleType, recursive, filter, seen):
     """ return the list of outputs generated by our dependencies
         for including in our classpath. If recursive is set
         to true, then also include all classpath elements
         required by those targets, as well as any targets
-        they depend on and so forth. The 'seen' list is used
-        by the recursive finder; do not manipulate it directly.
+        they depend on and so forth.
 
         If filter is AllDependencies, grab everything.
                   StandaloneDepsOnly, then stop if we hit a jar that has
@@ -109,75 +121,179 @@ class AntTarget(Target):
                ExcludeStandaloneDeps, then stop if we hit a jar with
                                       standalone_exempt = False
 
-
+        Each target is listed once, the first place it is reached in a
+        depth-first walk of the dependencies; a target that is skipped by
+        the filter is not walked through. Recursive results are memoized
+        per target (see getClassPathClosure()).
     """
 
     classPaths = []
-    reqs = self.get_required_targets()
-    if ruleType == "build" or ruleType == "test":
-      # for any ant-based deps, depend on their -build outputs
-      if reqs != None:
-        for target_name in reqs:
-          target = self.getTargetByName(target_name)
-          if None == target:
-            raise TargetError(self, "Could not find dependency: " + target_name)
-          elif target.generatesAntRules():
-            try:
-              seen.index(target)
-            except ValueError:
-              # haven't seen this target before. recurse on it.
-              seen.append(target)
-              include = (filter == AllDependencies \
-                  or filter == ExcludeStandaloneChildren \
-                  or (filter == StandaloneDepsOnly and not
-                      target.isStandaloneExempt()) \
-                  or (filter == ExcludeStandaloneDeps and
-                      target.isStandaloneExempt()))
-              if include:
-                classPaths.append(target.getSafeName() + ".outputs")
-                if recursive:
-                  # grab their straight-up classpath elements too
-                  classPaths.append(target.getSafeName() + ".classpath")
-                  if hasattr(target, "getDependencyClassPaths"):
-                    if target.isStandalone() \
-                        and filter == ExcludeStandaloneChildren:
-                      nextFilter = ExcludeStandaloneDeps
-                    else:
-                      nextFilter = filter
-                    classPaths.extend( \
-                        target.getDependencyClassPathsAux(ruleType, True,
-                        nextFilter, seen))
+    if ruleType != "build" and ruleType != "test":
+      return classPaths
+
+    if recursive:
+      closures = self.__getClassPathClosures()
+      try:
+        classPaths = closures[("classpath", filter)]
+      except KeyError:
+        for target in self.getClassPathClosure(filter):
+          classPaths.append(target.getSafeName() + ".outputs")
+          classPaths.append(target.getSafeName() + ".classpath")
+        closures[("classpath", filter)] = classPaths
+      # callers extend the list they get back.
+      classPaths = classPaths[:]
+    else:
+      seen = {}
+      for target in self.getDependencyTargets():
+        if target.generatesAntRules() and not seen.has_key(target):
+          seen[target] = True
+          if includeInClassPath(target, filter):
+            classPaths.append(target.getSafeName() + ".outputs")
 
     return classPaths
 
+
+  def getClassPathClosure(self, filter):
+    """ return the ordered list of targets whose outputs and classpaths
+        go into our recursive classpath under 'filter'. """
+
+    closures = self.__getClassPathClosures()
+    try:
+      return closures[filter]
+    except KeyError:
+      pass
+
+    if filter == ExcludeStandaloneChildren:
+      # The filter changes partway down, so this can't be assembled from
+      # our dependencies' closures; walk it, reusing their
+      # ExcludeStandaloneDeps closures below each standalone jar.
+      closures[filter] = self.__walkExcludeStandaloneChildren()
+    else:
+      closures[filter] = [ target for target in
+          self.__getVisitedClosure(filter)
+          if includeInClassPath(target, filter) ]
+    return closures[filter]
+
+
+  def __getClassPathClosures(self):
+    # created on demand; targets restored from the parse cache don't
+    # run __init__.
+    try:
+      return self.__classPathClosures
+    except AttributeError:
+      self.__classPathClosures = {}
+      return self.__classPathClosures
+
+
+  def __getVisitedClosure(self, filter):
+    """ return every target our recursive classpath walk visits under
+        'filter', which must not be ExcludeStandaloneChildren, in the
+        order it visits them. This includes targets the filter rejects;
+        they stop the walk from reaching them again by another route.
+
+        The filter is the same at every level, so each dependency's walk
+        is a prefix-closed part of ours: our closure is each dependency,
+        followed by its own closure, less anything already listed. The
+        closures are computed deepest-first, without recursion. """
+
+    closures = self.__getClassPathClosures()
+    try:
+      return closures[("visited", filter)]
+    except KeyError:
+      pass
+
+    stack = [ (self, iter(self.getDependencyTargets())) ]
+    pending = { self : True }
+    while len(stack) > 0:
+      (node, deps) = stack[-1]
+      for dep in deps:
+        if dep.generatesAntRules() and includeInClassPath(dep, filter) \
+            and hasattr(dep, "getClassPathClosure") \
+            and not dep.__hasClosure(("visited", filter)) \
+            and not pending.has_key(dep):
+          # work out dep's closure before node's.
+          pending[dep] = True
+          stack.append((dep, iter(dep.getDependencyTargets())))
+          break
+      else:
+        stack.pop()
+        node.__getClassPathClosures()[("visited", filter)] = \
+            node.__assembleVisitedClosure(filter)
+
+    return closures[("visited", filter)]
+
+
+  def __hasClosure(self, key):
+    return self.__getClassPathClosures().has_key(key)
+
+
+  def __assembleVisitedClosure(self, filter):
+    """ build our visited closure from our dependencies' closures, which
+        must already be computed. """
+    seen = {}
+    visited = []
+    for target in self.getDependencyTargets():
+      if not target.generatesAntRules() or seen.has_key(target):
+        continue
+      seen[target] = True
+      visited.append(target)
+      if includeInClassPath(target, filter) \
+          and hasattr(target, "getClassPathClosure"):
+        for sub in target.__getClassPathClosures()[("visited", filter)]:
+          if not seen.has_key(sub):
+            seen[sub] = True
+            visited.append(sub)
+    return visited
+
+
+  def __walkExcludeStandaloneChildren(self):
+    """ return our recursive classpath for ExcludeStandaloneChildren """
+    seen = {}
+    out = []
+    stack = [ iter(self.getDependencyTargets()) ]
+    while len(stack) > 0:
+      try:
+        target = stack[-1].next()
+      except StopIteration:
+        stack.pop()
+        continue
+      if not target.generatesAntRules() or seen.has_key(target):
+        continue
+
+      # everything is included until we pass a standalone jar.
+      seen[target] = True
+      out.append(target)
+      if not hasattr(target, "getClassPathClosure"):
+        continue
+      if not target.isStandalone():
+        stack.append(iter(target.getDependencyTargets()))
+        continue
+
+      # Below a standalone jar, only take what it excludes. Anything in
+      # its closure that we've already seen had its own dependencies
+      # walked when we saw it, so skipping just that target is enough.
+      for sub in target.__getVisitedClosure(ExcludeStandaloneDeps):
+        if not seen.has_key(sub):
+          seen[sub] = True
+          if includeInClassPath(sub, ExcludeStandaloneDeps):
+            out.append(sub)
+
+    return out
+
+
   def getRecursiveDependencyTargetObjs(self):
     """ return a list containing the complete set of Target objects we
         depend on recursively. """
 
 
-    def dfsTargetFinder(targetObj, deps):
-      newTargets = []
-      reqs = targetObj.get_required_targets()
-      if reqs != None:
-        for target_name in reqs:
-          target = targetObj.getTargetByName(target_name)
-          if None == target:
-            raise TargetError(self, "Could not find dependency " + target_name \
-                + " from " + self.getCanonicalName())
-          elif target.generatesAntRules():
-            try:
-              deps.index(target)
-            except ValueError:
-              # haven't seen this target before.
-              deps.append(target)
-              newTargets.append(target)
-      for newTarget in newTargets:
-        dfsTargetFinder(newTarget, deps)
-
-    deps = []
-    dfsTargetFinder(self, deps)
+    def follow(target):
+      return target.generatesAntRules()
 
-    return deps
+    buildGraph = graph.getBuildGraph()
+    if buildGraph == None or not buildGraph.contains(self):
+      import stitch.targets.target as target
+      buildGraph = graph.BuildGraph(target.targetMap.values())
+    return buildGraph.getRecursiveDependencies(self, follow)
 
 
 
@@ -210,20 +326,16 @@ class AntTarget(Target):
 
     if containsAny(allRuleTypes, ["build"]):
       # for any ant-based deps, depend on their -build
-      if self.required_targets != None:
-        for target_name in self.get_required_targets():
-          target = self.getTargetByName(target_name)
-          if None == target:
-            raise TargetError(self, "Could not find dependency: " + target_name)
-          elif target.generatesAntRules():
-            target_map = target.get_ant_rule_map();
-            try:
-              deps.append(target_map["build"])
-            except KeyError:
-              pass
-          else:
-            print "Warning: ant target " + self.getCanonicalName() \
-                + " depends on non-ant target: " + target_name
+      for target in self.getDependencyTargets():
+        if target.generatesAntRules():
+          target_map = target.get_ant_rule_map();
+          try:
+            deps.append(target_map["build"])
+          except KeyError:
+            pass
+        else:
+          print "Warning: ant target " + self.getCanonicalName() \
+              + " depends on non-ant target: " + target.getCanonicalName()
 
     if len(deps) == 0:
       return ""
@@ -244,13 +356,9 @@ class AntTarget(Target):
         entries when compiling. These are genfiles outputs from
         other targets. """
     deps = []
-    if self.required_targets != None:
-      for target_name in self.get_required_targets():
-        target = self.getTargetByName(target_name)
-        if None == target:
-          raise TargetError(self, "Could not find dependency: " + target_name)
-        elif target.generatesAntRules():
-          deps.extend(target.intermediatePaths())
+    for target in self.getDependencyTargets():
+      if target.generatesAntRules():
+        deps.extend(target.intermediatePaths())
 
     return deps
 
@@ -261,13 +369,9 @@ class AntTarget(Target):
         dependency sources approporiate to a particular language."""
 
     deps = []
-    if self.required_targets != None:
-      for target_name in self.get_required_targets():
-        target = self.getTargetByName(target_name)
-        if None == target:
-          raise TargetError(self, "Could not find dependency: " + target_name)
-        elif target.generatesAntRules():
-          deps.extend(target.intermediatePathsForLang(lang))
+    for target in self.getDependencyTargets():
+      if target.generatesAntRules():
+        deps.extend(target.intermediatePathsForLang(lang))
 
     return deps
 
@@ -366,8 +366,7 @@ class PythonRedistTarget(pythontarget.PythonBaseTarget):
     if self.required_targets != None:
       # For all the sources that we incorporate directly, put their module/package
       # names on the list to create documentation for.
-      for req_name in self.get_required_targets():
-        target = self.getTargetByName(req_name)
+      for target in self.getDependencyTargets():
         try:
           src_list = target.get_sources()
         except AttributeError:
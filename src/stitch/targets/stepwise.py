@@ -7,12 +7,14 @@
 
 from collections import defaultdict
 import os
+from cStringIO import StringIO
 
 import stitch.paths as paths
 import stitch.steps.step as step
 from   stitch.targets.anttarget import AntTarget
 from   stitch.targets.target import Target
 from   stitch.targets.targeterror import TargetError
+import stitch.util.xmlwriter as xmlwriter
 
 class StepBasedTarget(AntTarget):
   def __init__(self, steps, version=None, manifest_file=None, required_targets=None, \
@@ -150,6 +152,15 @@ class StepBasedTarget(AntTarget):
 
   def packageRule(self, rule):
     """ emit the ant rule to create the package """
+    buf = StringIO()
+    writer = xmlwriter.XmlWriter(buf)
+    self.writePackageRule(writer, rule)
+    writer.flush()
+    return buf.getvalue()
+
+
+  def writePackageRule(self, writer, rule):
+    """ write the ant rule to create the package to 'writer' """
 
     (mainName, ruleType) = self.splitRuleName(rule)
 
@@ -159,16 +170,14 @@ class StepBasedTarget(AntTarget):
     for step in self.steps:
       step.resolve(self)
 
-    text = ""
-
     if not self.force_build:
       # Figure out everything that we depend on. If it hasn't changed, then
       # don't build this. We measure the timestamps of all direct inputs vs.
       # our tarball output.
       # We exclude any inputs that are actually other files within our own build dir.
       uptodate_prop = self.getSafeName() + "-is-uptodate"
-      text = text + "<target name=\"" + rule + "-uptodate\"\n"
-      text = text + depAntRules + ">\n"
+      writer.write("<target name=\"" + rule + "-uptodate\"\n")
+      writer.write(depAntRules + ">\n")
 
       # Ant's uptodate task is somewhat stupid and can't deal with absolute paths
       # inside the srcfiles elements. Therefore we have to split up the input
@@ -194,45 +203,45 @@ class StepBasedTarget(AntTarget):
       # (like a Makefile PHONY target).
       do_uptodate = len(grouped_paths.items()) > 0
       if do_uptodate:
-        text = text + "  <uptodate property=\"" + uptodate_prop + "\">\n"
+        writer.write("  <uptodate property=\"" + uptodate_prop + "\">\n")
 
         for dir, filenames in grouped_paths.iteritems():
-          text += "    <srcfiles dir=\"%s\">\n" % dir
+          writer.write("    <srcfiles dir=\"%s\">\n" % dir)
           for filename in filenames:
-            text += "        <include name=\"%s\" />\n" % filename
-          text += "    </srcfiles>\n"
+            writer.write("        <include name=\"%s\" />\n" % filename)
+          writer.write("    </srcfiles>\n")
 
         if self.create_tarball:
-          text = text + "    <mapper type=\"merge\" to=\"" + self.getPackageZip() + "\" />\n"
+          writer.write("    <mapper type=\"merge\" to=\"" + self.getPackageZip() + "\" />\n")
         else:
-          text = text + "    <mapper type=\"merge\" to=\"" + self.getStampPath() + "\" />\n"
+          writer.write("    <mapper type=\"merge\" to=\"" + self.getStampPath() + "\" />\n")
 
-        text = text + "  </uptodate>\n"
-        text = text + "  <echo message=\"" + self.getCanonicalName() + " uptodate: ${" \
-            + uptodate_prop + "}\"/>\n"
-      text = text + "</target>\n"
+        writer.write("  </uptodate>\n")
+        writer.write("  <echo message=\"" + self.getCanonicalName() + " uptodate: ${" \
+            + uptodate_prop + "}\"/>\n")
+      writer.write("</target>\n")
 
-      text = text + "<target name=\"" + rule + "\" depends=\"" \
-        + self.getSafeName() + "-build-uptodate\" unless=\"" + uptodate_prop + "\">\n"
+      writer.write("<target name=\"" + rule + "\" depends=\"" \
+        + self.getSafeName() + "-build-uptodate\" unless=\"" + uptodate_prop + "\">\n")
     else:
       # build is forced.
-      text = text + "<target name=\"" + rule + "\" "
-      text = text + depAntRules + ">\n"
+      writer.write("<target name=\"" + rule + "\" ")
+      writer.write(depAntRules + ">\n")
 
     if self.clean_first:
-      text += "  <deletermf dir=\"" + self.get_assembly_dir() + "\"/>\n"
+      writer.write("  <deletermf dir=\"" + self.get_assembly_dir() + "\"/>\n")
 
     # The actual package target work
-    text = text + "  <mkdir dir=\"" + self.get_assembly_dir() + "\"/>\n"
+    writer.write("  <mkdir dir=\"" + self.get_assembly_dir() + "\"/>\n")
 
     # Bring in all the steps
     for step in self.steps:
-      text = text + step.emitPackageOps(self)
+      writer.write(step.emitPackageOps(self))
 
     if self.manifest_file != None:
       # check that our file list here equals the one we expect.
       # Give checkmanifest the --release flag if we're in release mode
-      text = text + """
+      writer.write("""
   <exec executable="${checkmanifest-exec}" failonerror="true">
     <arg value="%(manifest)s" />
     <arg value="%(pkgpath)s" />
@@ -242,17 +251,16 @@ class StepBasedTarget(AntTarget):
       "manifest" : os.path.join("${basedir}", self.getInputDirectory(), \
           self.force(self.manifest_file)),
       "pkgpath"  : self.get_assembly_dir()
-    }
+    })
 
     if self.registered_zip_step == None and self.create_tarball:
-      text = text + self.emit_tarball_text()
+      writer.write(self.emit_tarball_text())
     elif not self.create_tarball:
-      text = text + """
+      writer.write("""
     <touch file="%s" />
-    """ % self.getStampPath()
+    """ % self.getStampPath())
 
-    text = text + "</target>\n"
-    return text
+    writer.write("</target>\n")
 
 
   def emit_tarball_text(self):
@@ -285,6 +293,18 @@ class StepBasedTarget(AntTarget):
       return self.cleanRule(rule)
 
 
+  def writeAntRule(self, writer, rule):
+    # Stream the package rule, unless a subclass has changed how antRule()
+    # produces it.
+    cls = self.__class__
+    if rule != "preamble" and self.splitRuleName(rule)[1] == "build" \
+        and cls.antRule.im_func is StepBasedTarget.antRule.im_func \
+        and cls.packageRule.im_func is StepBasedTarget.packageRule.im_func:
+      self.writePackageRule(writer, rule)
+    else:
+      AntTarget.writeAntRule(self, writer, rule)
+
+
   def outputPaths(self):
     """ Return the list of user-controlled output paths. The list provided
         by the user will be files/dirs relative to the package base path;
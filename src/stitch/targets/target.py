@@ -5,14 +5,13 @@
 # not to be instantiated directly. Also contains the lookup map from
 # target name to object
 
-import inspect
-import itertools
 import os
-import re
 import sys
 
 import stitch.buildfile as buildfile
+import stitch.graph as graph
 import stitch.paths as paths
+import stitch.targets.thunks as thunks
 from   stitch.targets.targeterror import TargetError
 
 
@@ -31,9 +30,88 @@ def getAnonymousName():
 
 targetMap = {}
 
+# If False, targets do not record where they were defined. Saves a stack walk
+# per target; error messages then report an unknown location.
+__captureDefinitionLocations = True
+
+def setCaptureDefinitionLocations(capture):
+  global __captureDefinitionLocations
+  __captureDefinitionLocations = capture
+
+def getCaptureDefinitionLocations():
+  global __captureDefinitionLocations
+  return __captureDefinitionLocations
+
 def mapNameToTarget(target_name, targetObj):
   global targetMap
   targetMap[target_name] = targetObj
+  thunks.invalidateTarget(target_name)
+
+def resetTargetMap():
+  """ forget all targets and restart anonymous naming. Used to load the
+      Targets files again within one process (stitch --watch) """
+  global targetMap, resolutionIndex, __anonCounter
+  targetMap.clear()
+  resolutionIndex = None
+  thunks.resetThunkCache()
+  __anonCounter = 0
+
+
+# Map from the name of each macro recognized by Target.substitute_macros()
+# to a function which returns its value for a given target.
+macroMap = {}
+
+def registerMacro(name, func):
+  """ make "%(name)" in user strings expand to func(target), where target
+      is the Target whose string it is. Extension modules may call this to
+      add their own macros. """
+  global macroMap
+  macroMap[name] = func
+
+def resetMacros():
+  """ forget the macros registered by extension modules """
+  global macroMap
+  macroMap.clear()
+  registerMacro("assemblydir", lambda target: target.get_assembly_dir())
+  registerMacro("assemblytopdir", lambda target: target.get_assembly_top_dir())
+  registerMacro("srcdir", lambda target:
+      os.path.join("${basedir}", target.getInputDirectory()))
+  registerMacro("basedir", lambda target: "${basedir}")
+
+resetMacros()
+
+
+# Map from (canonical name of the referring build file, target reference)
+# to the Target it names (or None). Built by buildResolutionIndex() once all
+# the Targets files are loaded, after which getTargetByName() only has to
+# canonicalize each distinct reference once.
+resolutionIndex = None
+
+def buildResolutionIndex(allTargets):
+  """ resolve the required_targets of every target, and cache the results
+      for getTargetByName(). References that cannot be resolved are all
+      reported together, and then stitch exits. """
+  global resolutionIndex
+
+  resolutionIndex = {}
+  numMissing = 0
+  for target in allTargets:
+    reqs = getattr(target, "required_targets", None)
+    if reqs == None:
+      continue
+    for req in reqs:
+      if not isinstance(req, str):
+        continue # thunks are resolved when they are forced.
+      (canonicalName, targetObj) = target.resolveTargetName(req)
+      resolutionIndex[(target.getBuildFile().getCanonicalName(), req)] = \
+          (canonicalName, targetObj)
+      if targetObj == None:
+        target.missingTarget(canonicalName, False)
+        numMissing = numMissing + 1
+
+  if numMissing > 0:
+    print "Error:", numMissing, "reference(s) to missing targets"
+    sys.exit(1)
 
 
 class Target(object):
@@ -74,10 +152,8 @@ class Target(object):
     # can provide useful traces in TargetError
     self.definition_location = self._get_definition_location()
 
-    self.canonicalName = getAnonymousName()
-    self.safeName = self.canonicalName
+    self.resetAnonymousName()
     self.generated = False
-    self.is_anon = True
 
     # upon construction, register with the build file.
     from stitch.buildfile import getCurBuildFile
@@ -86,28 +162,47 @@ class Target(object):
 
     self.build_file = curBuildFile
 
+  def resetAnonymousName(self):
+    """ give this target a fresh anonymous name. This happens on
+        construction, and again when a target is restored from the
+        parse cache rather than constructed by its Targets file. """
+    self.canonicalName = getAnonymousName()
+    self.safeName = self.canonicalName
+    self.is_anon = True
+    self.macroCache = {}
+
   def _get_definition_location(self):
     """
     Return a tuple (filename, line) by searching up the current
     call stack to find the line in a targets file where this
-    target was defined.
+    target was defined. Returns None if there is no such frame, or
+    if location capture is disabled.
+
+    This only looks at the raw frames; it does not read any source.
     """
-    for i in itertools.count(1):
-      try:
-        frame = sys._getframe(i)
-      except ValueError:
-        # We reached the top of the stack and couldn't find a target file
-        return None
-      (filename,lineno,funcname,context,lineidx) = inspect.getframeinfo(frame)
+    if not getCaptureDefinitionLocations():
+      return None
+
+    frame = sys._getframe(1)
+    while frame != None:
+      filename = frame.f_code.co_filename
       if os.path.basename(filename) == buildfile.DEFAULT_BUILD_FILENAME:
-        return (filename, lineno)
+        return (filename, frame.f_lineno)
+      frame = frame.f_back
 
-  def __str__(self):
+    # We reached the top of the stack and couldn't find a target file
+    return None
+
+  def getDefinitionLocationString(self):
+    """ Return "filename:line" for where this target was defined """
     if self.definition_location:
-      def_loc = "%s:%d" % self.definition_location
+      return "%s:%d" % self.definition_location
     else:
-      def_loc = "<unknown location>"
-    return "<target %s defined at %s>" % (self.canonicalName, def_loc)
+      return "<unknown location>"
+
+  def __str__(self):
+    return "<target %s defined at %s>" % (self.canonicalName,
+        self.getDefinitionLocationString())
 
   def validate_arguments(self):
     """
@@ -143,11 +238,12 @@ class Target(object):
 
   def setCanonicalName(self, name, anon):
     """ sets the canonical name for this target """
-    self.canonicalName = name
+    self.canonicalName = intern(name)
     self.is_anon = anon
+    self.macroCache = {} # %(srcdir), etc., depend on our name.
 
     # register this canonical name for the target.
-    mapNameToTarget(name, self)
+    mapNameToTarget(intern(name), self)
 
   def getCanonicalName(self):
     return self.canonicalName
@@ -229,59 +325,63 @@ class Target(object):
 
         It is an error to use a macro that is not defined for the
         current target type (e.g., assemblydir in a JarTarget).
-    """
-
-    if not hasattr(self, "assembly_re") or self.assembly_re == None:
-      # None of the macros have been compiled yet. Do so now.
-      self.assembly_re = re.compile("%\\(assemblydir\\)")
-      self.topdir_re = re.compile("%\\(assemblytopdir\\)")
-      self.src_re = re.compile("%\\(srcdir\\)")
-      self.base_re = re.compile("%\\(basedir\\)")
-
-      # This regex matches any %%(foo), and will be used to replace it with %(foo)
-      # so that you can escape macros.
-      self.escape_re = re.compile("%(%\\([^\\)]*\\))")
-
-    def subst_re(r, input, replacement=""):
-      """ each span matched by 'r' in 'input' is replaced by 'replacement',
-          unless it is preceeded by another '%' (escape char)
-
-          If the matcher returns any (groups), ignores 'replacement' and
-          uses the first group
-      """
-      ESCAPE_CHAR = "%"
-      offset = 0
-      while offset < len(input):
-        m = r.search(input, offset)
-        if m == None:
-          break # no more matches left.
-        (start, end) = m.span()
-        if start > 0 and input[start - 1] == ESCAPE_CHAR:
-          # this is ecsaped; ignore it.
-          offset = start + 1
-          continue
-        else:
-          # do the replacement
-          if len(m.groups()) > 0:
-            repl = m.groups()[0]
-          else:
-            repl = replacement
-
-          input = input[0:start] + repl + input[end:]
-          offset = start + len(repl)
 
-      return input
-
-    # Expand real macros first.
-    value = subst_re(self.assembly_re, value, self.get_assembly_dir())
-    value = subst_re(self.topdir_re , value, self.get_assembly_top_dir())
-    value = subst_re(self.src_re, value, os.path.join("${basedir}", self.getInputDirectory()))
-    value = subst_re(self.base_re, value, "${basedir}")
+        Extension modules may add their own macros with registerMacro().
+        Prefix a macro with an extra '%' to keep it from being expanded:
+        "%%(srcdir)" becomes "%(srcdir)".
+    """
 
-    # Unescape macro-like strings.
-    value = subst_re(self.escape_re, value)
+    if value.find("%") == -1:
+      return value # nothing to expand.
 
-    return value
+    try:
+      return self.macroCache[value]
+    except KeyError:
+      pass
+
+    # A macro is not expanded if it is preceded by a '%'. Otherwise, "%%("
+    # starts an escape, which ends at the next ')' that is not part of an
+    # expanded macro. The first '%' of a complete escape is dropped, and no
+    # escapes begin inside one. (Macros inside an escape are expanded.)
+    out = []
+    start = 0          # start of the text not yet copied to out
+    pos = 0            # where to look for the next '%'
+    escapeIdx = None   # index in out of the '%' starting an open escape
+    while True:
+      pct = value.find("%", pos)
+      if escapeIdx != None:
+        close = value.find(")", pos)
+        if close != -1 and (pct == -1 or close < pct):
+          out[escapeIdx] = ""
+          escapeIdx = None
+          pos = close + 1
+          continue
+      if pct == -1:
+        break
+
+      escaped = pct > 0 and value[pct - 1] == "%"
+      if value.startswith("%(", pct):
+        close = value.find(")", pct + 2)
+        if close != -1 and not escaped:
+          macro = macroMap.get(value[pct + 2:close])
+          if macro != None:
+            out.append(value[start:pct])
+            out.append(macro(self))
+            start = pos = close + 1
+            continue
+      elif value.startswith("%%(", pct) and not escaped and escapeIdx == None:
+        out.append(value[start:pct])
+        escapeIdx = len(out)
+        out.append("%")
+        start = pct + 1
+        pos = pct + 3
+        continue
+      pos = pct + 1
+
+    out.append(value[start:])
+    result = "".join(out)
+    self.macroCache[value] = result
+    return result
 
 
   def normalize_select_user_path(self, path):
@@ -364,6 +464,18 @@ class Target(object):
   def get_required_targets(self):
     return self.force(self.required_targets)
 
+  def getDependencyTargets(self):
+    """ return the Target objects this target requires, in the order they
+        are listed in required_targets. """
+    buildGraph = graph.getBuildGraph()
+    if buildGraph != None and buildGraph.contains(self):
+      return buildGraph.getDependencies(self)
+
+    # not part of the graph (yet); resolve them ourselves.
+    if getattr(self, "required_targets", None) == None:
+      return []
+    return [ self.getTargetByName(name) for name in self.get_required_targets() ]
+
   def getClassPathElements(self):
     return []
 
@@ -384,6 +496,30 @@ class Target(object):
         as target names may be relative to the current directory or targets
         file.
     """
+    global resolutionIndex
+
+    if resolutionIndex != None:
+      key = (self.getBuildFile().getCanonicalName(), target_name)
+      try:
+        (canonicalName, targetObj) = resolutionIndex[key]
+      except KeyError:
+        (canonicalName, targetObj) = self.resolveTargetName(target_name)
+        resolutionIndex[key] = (canonicalName, targetObj)
+    else:
+      (canonicalName, targetObj) = self.resolveTargetName(target_name)
+
+    if targetObj == None:
+      if not allowMissingTargets:
+        self.missingTarget(canonicalName)
+    else:
+      thunks.recordTargetReference(targetObj)
+    return targetObj
+
+
+  def resolveTargetName(self, target_name):
+    """ return the tuple (canonical name, Target) for the target named
+        by 'target_name' relative to this target. The Target is None if
+        there is no such target. """
     global targetMap
     from stitch.buildfile import SUBTARGET_SPECIFIER
 
@@ -426,20 +562,15 @@ class Target(object):
 
     # now that everything is in canonical form, look up the actual
     # Target object associated with this name.
-    try:
-      return targetMap[target_name]
-    except KeyError:
-      if allowMissingTargets:
-        return None
-      else:
-        self.missingTarget(target_name)
+    return (target_name, targetMap.get(target_name))
 
 
-  def missingTarget(self, target_name):
+  def missingTarget(self, target_name, exit=True):
     """ Prints an error message and exits when a Target cannot be found """
     print "Error: Target " + self.getCanonicalName() + " in build file " \
         + self.getBuildFile().getFileName() + " referenced missing target: " + target_name
-    sys.exit(1)
+    if exit:
+      sys.exit(1)
 
   def force(self, val):
     """ If a val may represent a thunk, then we force it before returning our results,
@@ -464,7 +595,7 @@ class Target(object):
           out.append(this_out)
       return out
     elif hasattr(val, 'force'):
-      return val.force(self)
+      return thunks.forceThunk(val, self)
     else:
       return val
       
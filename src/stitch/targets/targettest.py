@@ -0,0 +1,54 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Unit test cases for Target.substitute_macros()
+
+import unittest
+
+import stitch.targets.target as target
+from   stitch.testutil.asserts import TestCaseWithAsserts
+
+class FakeTarget(target.Target):
+  """ A Target which is not defined by a Targets file """
+
+  def __init__(self):
+    self.resetAnonymousName()
+    self.setCanonicalName("//src/foo:bar", False)
+
+  def get_assembly_dir(self):
+    return "${outdir}/src/foo_bar/"
+
+
+class SubstituteMacrosTest(TestCaseWithAsserts):
+
+  def setUp(self):
+    self.target = FakeTarget()
+
+  def tearDown(self):
+    target.resetTargetMap()
+    target.resetMacros()
+
+  def test_macros(self):
+    self.assertEquals(self.target.substitute_macros("%(srcdir)/a.jar"),
+        "${basedir}/src/foo/a.jar")
+    self.assertEquals(self.target.substitute_macros(
+        "%(assemblytopdir)x %(basedir) %(unknown)"),
+        "${outdir}/src/foo_bar/x ${basedir} %(unknown)")
+
+  def test_escapes(self):
+    self.assertEquals(self.target.substitute_macros("%%(srcdir)"), "%(srcdir)")
+    self.assertEquals(self.target.substitute_macros("%%%(srcdir)"),
+        "%%%(srcdir)")
+    self.assertEquals(self.target.substitute_macros("%%(a %(basedir) b)"),
+        "%(a ${basedir} b)")
+    # the ')' ending an escape cannot belong to an expanded macro.
+    self.assertEquals(self.target.substitute_macros("%%(a %(basedir)"),
+        "%%(a ${basedir}")
+
+  def test_register_macro(self):
+    target.registerMacro("name", lambda t: t.getCanonicalName())
+    self.assertEquals(self.target.substitute_macros("%(name)!"),
+        "//src/foo:bar!")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -5,6 +5,125 @@
   thunks wherever you can use lists or strings in the parameters.
 """
 
+# Results of forced thunks, memoized while the build is generated (see
+# setThunkCacheEnabled()). A thunk must give the same result every time it
+# is forced in the same context, so once every Targets file is loaded its
+# result can be kept until one of the targets it looked at is replaced.
+#
+# Maps (thunk, context target) to the tuple (result, canonical names of
+# the targets it looked at).
+__thunkCache = {}
+
+# Maps the canonical name of each target that a cached result looked at
+# (including its context) to the keys of those results.
+__thunkCacheDeps = {}
+
+__thunkCacheEnabled = False
+__thunkCacheHits = 0
+__thunkCacheMisses = 0
+
+# Stack of lists collecting the canonical names of the targets looked up
+# (see Target.getTargetByName()), one for each thunk being forced into the
+# cache, and any started with startRecordingReferences().
+__referenceRecording = []
+
+
+def setThunkCacheEnabled(enabled):
+  """ Start or stop memoizing forced thunks. Only enable this once every
+      Targets file has been loaded. """
+  global __thunkCacheEnabled
+  __thunkCacheEnabled = enabled
+
+
+def resetThunkCache():
+  """ forget every cached result and stop caching """
+  global __thunkCacheEnabled, __thunkCacheHits, __thunkCacheMisses
+  __thunkCache.clear()
+  __thunkCacheDeps.clear()
+  __thunkCacheEnabled = False
+  __thunkCacheHits = 0
+  __thunkCacheMisses = 0
+
+
+def invalidateTarget(canonicalName):
+  """ forget the cached results that depend on the target with the given
+      canonical name, e.g., because it has been (re)defined. """
+  for key in __thunkCacheDeps.pop(canonicalName, []):
+    try:
+      del __thunkCache[key]
+    except KeyError:
+      pass # already invalidated through another target.
+
+
+def getThunkCacheStats():
+  """ return a dict with the number of forces answered from the cache
+      ("hits") and the number that were evaluated ("misses"). """
+  return { "hits"   : __thunkCacheHits,
+           "misses" : __thunkCacheMisses }
+
+
+def recordTargetReference(target):
+  """ note that 'target' was looked up, for whoever is recording """
+  if len(__referenceRecording) > 0:
+    __referenceRecording[-1].append(target.getCanonicalName())
+
+
+def startRecordingReferences():
+  """ start collecting the names of the targets that are looked up, until
+      the matching stopRecordingReferences() """
+  __referenceRecording.append([])
+
+
+def stopRecordingReferences():
+  """ return the canonical names of the targets looked up since the
+      matching startRecordingReferences(), in the order they were first
+      looked up. They are also passed on to any enclosing recording. """
+  names = __referenceRecording.pop()
+  if len(__referenceRecording) > 0:
+    __referenceRecording[-1].extend(names)
+
+  seen = {}
+  unique = []
+  for name in names:
+    if not seen.has_key(name):
+      seen[name] = True
+      unique.append(name)
+  return unique
+
+
+def forceThunk(thunk, context):
+  """ Force 'thunk' in the context of target 'context', reusing the result
+      of forcing it there before if the cache is enabled. """
+  global __thunkCacheHits, __thunkCacheMisses
+
+  if not __thunkCacheEnabled:
+    return thunk.force(context)
+
+  key = (thunk, context)
+  try:
+    (result, names) = __thunkCache[key]
+    __thunkCacheHits = __thunkCacheHits + 1
+    if len(__referenceRecording) > 0:
+      # we depend on what it looked at the first time.
+      __referenceRecording[-1].extend(names)
+  except KeyError:
+    __thunkCacheMisses = __thunkCacheMisses + 1
+    startRecordingReferences()
+    recordTargetReference(context)
+    try:
+      result = thunk.force(context)
+    finally:
+      names = stopRecordingReferences()
+    __thunkCache[key] = (result, names)
+    for name in names:
+      __thunkCacheDeps.setdefault(name, []).append(key)
+
+  if isinstance(result, list):
+    # callers may modify the list they get back.
+    return result[:]
+  return result
+
+
 class Thunk(object):
   """ Represents a delayed computation to be performed in the context of a
       target. By itself this interface class does nothing special. But
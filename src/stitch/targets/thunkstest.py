@@ -0,0 +1,102 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Unit test cases for the thunk cache
+
+import unittest
+
+import stitch.targets.thunks as thunks
+from   stitch.testutil.asserts import TestCaseWithAsserts
+
+class FakeTarget(object):
+  """ Just enough of a Target to force thunks in """
+
+  def __init__(self, name, targets, outputs):
+    self.name = name
+    self.outputs = outputs
+    self.targets = targets
+    targets[name] = self
+
+  def getTargetByName(self, name):
+    target = self.targets[name]
+    thunks.recordTargetReference(target)
+    return target
+
+  def getCanonicalName(self):
+    return "//" + self.name
+
+  def outputPaths(self):
+    return self.outputs
+
+
+class CountingThunk(thunks.Outputs):
+  """ Outputs thunk which counts how often it is really forced """
+
+  def __init__(self, target_name):
+    thunks.Outputs.__init__(self, target_name)
+    self.forced = 0
+
+  def force(self, context):
+    self.forced = self.forced + 1
+    return thunks.Outputs.force(self, context)
+
+
+class ThunkCacheTest(TestCaseWithAsserts):
+
+  def setUp(self):
+    thunks.resetThunkCache()
+    thunks.setThunkCacheEnabled(True)
+    self.targets = {}
+    self.a = FakeTarget("a", self.targets, [])
+    self.b = FakeTarget("b", self.targets, [ "b.jar" ])
+
+  def tearDown(self):
+    thunks.resetThunkCache()
+
+  def test_memoized(self):
+    thunk = CountingThunk("b")
+    self.assertEquals(thunks.forceThunk(thunk, self.a), [ "b.jar" ])
+    result = thunks.forceThunk(thunk, self.a)
+    self.assertEquals(result, [ "b.jar" ])
+    self.assertEquals(thunk.forced, 1)
+    self.assertEquals(thunks.getThunkCacheStats(), { "hits" : 1, "misses" : 1 })
+
+    # callers get their own copy of the list.
+    result.append("other.jar")
+    self.assertEquals(thunks.forceThunk(thunk, self.a), [ "b.jar" ])
+
+  def test_invalidated_by_referenced_target(self):
+    thunk = thunks.Concat([ "-cp ", CountingThunk("b") ])
+    self.assertEquals(thunks.forceThunk(thunk, self.a), "-cp b.jar")
+
+    # redefining some other target keeps the result.
+    thunks.invalidateTarget("//c")
+    thunks.forceThunk(thunk, self.a)
+    self.assertEquals(thunks.getThunkCacheStats()["hits"], 1)
+
+    # redefining the target it looked at (through a nested thunk) drops it.
+    self.b.outputs = [ "b2.jar" ]
+    thunks.invalidateTarget("//b")
+    self.assertEquals(thunks.forceThunk(thunk, self.a), "-cp b2.jar")
+
+  def test_disabled(self):
+    thunks.setThunkCacheEnabled(False)
+    thunk = CountingThunk("b")
+    thunks.forceThunk(thunk, self.a)
+    thunks.forceThunk(thunk, self.a)
+    self.assertEquals(thunk.forced, 2)
+
+  def test_recorded_references(self):
+    thunk = CountingThunk("b")
+    thunks.startRecordingReferences()
+    thunks.forceThunk(thunk, self.a)
+    self.assertEquals(thunks.stopRecordingReferences(), [ "//a", "//b" ])
+
+    # a cached result still reports the targets it looked at.
+    thunks.startRecordingReferences()
+    thunks.forceThunk(thunk, self.a)
+    self.assertEquals(thunks.stopRecordingReferences(), [ "//a", "//b" ])
+    self.assertEquals(thunk.forced, 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
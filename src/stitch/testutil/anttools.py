@@ -0,0 +1,130 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Helpers for tests which run ant: finding it and a JDK, building the
+# stitch-ant jar from src/java, and running stitch and the build script
+# it writes on a test project. Tests that need ant pass (with a note) on
+# machines which have no ant or JDK installed.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# the root of this stitch tree, and its sources.
+STITCH_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__),
+    "..", "..", ".."))
+JAVA_SRC_DIR = os.path.join(STITCH_HOME, "src", "java")
+
+
+def find_program(name):
+  """ return the path to the program 'name' on the PATH, or None """
+  for dir in os.getenv("PATH", "").split(os.pathsep):
+    path = os.path.join(dir, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+  return None
+
+
+def get_ant_home():
+  """ return the directory ant is installed in, or None """
+  ant_home = os.getenv("ANT_HOME")
+  if ant_home == None:
+    ant = find_program("ant")
+    if ant == None:
+      return None
+    ant_home = os.path.dirname(os.path.dirname(os.path.realpath(ant)))
+  if not os.path.exists(os.path.join(ant_home, "lib", "ant.jar")):
+    return None
+  return ant_home
+
+
+def have_programs(test_name, programs):
+  """ return True if all of 'programs' are on the PATH; otherwise print a
+      note that 'test_name' was skipped. """
+  for program in programs:
+    if find_program(program) == None:
+      sys.stderr.write("(skipping " + test_name + ": no " + program + ")\n")
+      return False
+  return True
+
+
+def have_ant(test_name):
+  """ return True if ant is available to run 'test_name'; otherwise
+      print a note that it was skipped. """
+  if not have_programs(test_name, [ "ant" ]):
+    return False
+  if get_ant_home() == None:
+    sys.stderr.write("(skipping " + test_name + ": cannot find ant.jar)\n")
+    return False
+  return True
+
+
+def have_jdk(test_name):
+  """ return True if ant and a JDK are available to run 'test_name';
+      otherwise print a note that it was skipped. """
+  return have_ant(test_name) and have_programs(test_name, [ "javac", "jar" ])
+
+
+def build_stitch_ant_jar(jar_file):
+  """ compile the classes in src/java into jar_file. """
+  lib_dir = os.path.join(get_ant_home(), "lib")
+  classpath = os.path.join(lib_dir, "ant.jar") + os.pathsep \
+      + os.path.join(lib_dir, "ant-launcher.jar")
+  sources = []
+  for (dirpath, dirnames, filenames) in os.walk(JAVA_SRC_DIR):
+    for filename in filenames:
+      if filename.endswith(".java"):
+        sources.append(os.path.join(dirpath, filename))
+
+  classes_dir = tempfile.mkdtemp()
+  try:
+    if os.system("javac -nowarn -classpath '" + classpath + "' -d '"
+        + classes_dir + "' '" + "' '".join(sources) + "'") != 0:
+      raise Exception("Could not compile " + JAVA_SRC_DIR)
+    if os.system("jar cf '" + jar_file + "' -C '" + classes_dir + "' .") != 0:
+      raise Exception("Could not write " + jar_file)
+  finally:
+    shutil.rmtree(classes_dir)
+
+
+def write_file(filename, text):
+  handle = open(filename, "w")
+  try:
+    handle.write(text)
+  finally:
+    handle.close()
+
+
+def run_python(project_dir, args):
+  """ run this python, with the stitch sources on its path, in
+      project_dir. Returns the exit status and the output. """
+  env = os.environ.copy()
+  python_path = os.path.join(STITCH_HOME, "src")
+  if os.getenv("PYTHONPATH"):
+    python_path = python_path + os.pathsep + os.getenv("PYTHONPATH")
+  env["PYTHONPATH"] = python_path
+  process = subprocess.Popen([ sys.executable ] + args, cwd=project_dir,
+      env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  output = process.communicate()[0]
+  return (process.returncode, output)
+
+
+def run_stitch(project_dir):
+  """ run stitch on project_dir. Returns the exit status and the output. """
+  return run_python(project_dir, [ "-m", "stitch.main", "--executable",
+      os.path.join(STITCH_HOME, "bin", "stitch") ])
+
+
+def run_ant(project_dir, args):
+  """ run ant in project_dir. Returns the exit status and the output. """
+  process = subprocess.Popen([ "ant" ] + args, cwd=project_dir,
+      stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  output = process.communicate()[0]
+  return (process.returncode, output)
+
+
+def run_sbuild(project_dir, args):
+  """ run the build script stitch wrote in project_dir. Returns the exit
+      status and the output. """
+  return run_python(project_dir, [ "sbuild" ] + args)
@@ -6,12 +6,14 @@
 import sys
 import unittest
 from stitch.util.propertiestest import PropertiesTest
+from stitch.util.xmlwritertest import XmlWriterTest
 
 def testSuite():
   # TODO: Add your test suites to the list here.
   propsSuite = unittest.makeSuite(PropertiesTest, 'test')
+  xmlWriterSuite = unittest.makeSuite(XmlWriterTest, 'test')
 
-  alltests = unittest.TestSuite([propsSuite])
+  alltests = unittest.TestSuite([propsSuite, xmlWriterSuite])
   return alltests
 
 if __name__ == "__main__":
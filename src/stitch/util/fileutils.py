@@ -0,0 +1,21 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# file tools.
+
+import filecmp
+import os
+
+
+def replace_if_changed(tmp_filename, filename):
+  """ Move tmp_filename over filename, unless the two have identical
+      contents; in that case tmp_filename is removed and filename is
+      only touched, so that its mtime still reflects when it was last
+      generated. Returns True if filename was rewritten. """
+
+  if os.path.exists(filename) and filecmp.cmp(tmp_filename, filename, False):
+    os.remove(tmp_filename)
+    os.utime(filename, None)
+    return False
+
+  os.rename(tmp_filename, filename)
+  return True
@@ -0,0 +1,69 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# xmlwriter: buffered output of XML text to a file.
+#
+# The ant generator hands an XmlWriter to each target (see
+# Target.writeAntRule()), which writes its rules into it a fragment at a
+# time rather than returning them as one string. Fragments are collected
+# in a list and written out whenever enough of them have built up, so the
+# cost of generating a build.xml grows linearly with its size, and memory
+# use is bounded by the buffer rather than by the file.
+
+# write buffered fragments once they add up to this many characters.
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+
+def escape(text):
+  """ Return 'text' with the characters that are special in XML character
+      data (&, < and >) replaced by entity references. """
+  return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def escape_attr(text):
+  """ Return 'text' escaped for use inside a double-quoted attribute """
+  return escape(text).replace("\"", "&quot;")
+
+
+class XmlWriter(object):
+  """ Writes text to a file-like object through a buffer of fragments """
+
+  def __init__(self, handle, buffer_size=DEFAULT_BUFFER_SIZE):
+    self.handle = handle
+    self.buffer_size = buffer_size
+    self.fragments = []
+    self.buffered = 0
+
+    # total number of characters written through this writer.
+    self.length = 0
+
+
+  def write(self, text):
+    """ Write 'text' as-is; it must already be valid XML. """
+    self.fragments.append(text)
+    self.buffered = self.buffered + len(text)
+    self.length = self.length + len(text)
+    if self.buffered >= self.buffer_size:
+      self.flush()
+
+
+  def write_text(self, text):
+    """ Write 'text' as character data, escaping it as needed """
+    self.write(escape(text))
+
+
+  def write_attr(self, name, value):
+    """ Write ' name="value"', escaping the value """
+    self.write(" " + name + "=\"" + escape_attr(value) + "\"")
+
+
+  def flush(self):
+    if len(self.fragments) > 0:
+      self.handle.write("".join(self.fragments))
+      self.fragments = []
+      self.buffered = 0
+
+
+  def close(self):
+    """ Flush the buffer and close the underlying file """
+    self.flush()
+    self.handle.close()
@@ -0,0 +1,35 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# Unit test cases for XmlWriter
+
+from cStringIO import StringIO
+
+from stitch.testutil.asserts import TestCaseWithAsserts
+
+import stitch.util.xmlwriter as xmlwriter
+
+class XmlWriterTest(TestCaseWithAsserts):
+
+  def test_buffering(self):
+    buf = StringIO()
+    writer = xmlwriter.XmlWriter(buf, buffer_size=8)
+    writer.write("<a>")
+    self.assertEquals(buf.getvalue(), "")
+    writer.write("<b/>text")
+    self.assertEquals(buf.getvalue(), "<a><b/>text")
+    writer.write("</a>")
+    writer.flush()
+    self.assertEquals(buf.getvalue(), "<a><b/>text</a>")
+    self.assertEquals(writer.length, 15)
+
+  def test_escaping(self):
+    buf = StringIO()
+    writer = xmlwriter.XmlWriter(buf)
+    writer.write("<echo")
+    writer.write_attr("message", "a < b & \"c\"")
+    writer.write(">")
+    writer.write_text("x > y")
+    writer.write("</echo>")
+    writer.flush()
+    self.assertEquals(buf.getvalue(),
+        "<echo message=\"a &lt; b &amp; &quot;c&quot;\">x &gt; y</echo>")
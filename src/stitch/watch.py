@@ -0,0 +1,217 @@
+# (c) Copyright 2009 Cloudera, Inc.
+#
+# watch: implements 'stitch --watch'. After generating the build files,
+# stitch stays resident and watches every file that went into them: the
+# Targets files, .signore files, properties files and stitch-ext modules.
+# When one changes, the build files are regenerated in-process.
+#
+# Regeneration reuses an in-memory parse cache (see stitch.parsecache), so
+# only the Targets files that changed are evaluated again; the others are
+# restored from the results of the previous pass. Likewise the rules of
+# targets that are unaffected by the change are taken from the in-memory
+# fragment cache (see stitch.fragmentcache). build.xml and the build
+# script are only rewritten if their contents changed.
+#
+# Changes are detected with inotify if the pyinotify module is installed;
+# otherwise the files are polled.
+#
+# While running, the watcher keeps its pid in ${stitch-cache-dir}/watch.pid
+# and creates watch.busy while it is regenerating. The generated build script
+# waits for a busy watcher to finish before it runs ant, so that editing a
+# Targets file never requires stitch-refresh to fail the build.
+
+import os
+import time
+
+import stitch.antgenerator as antgenerator
+import stitch.buildfile as buildfile
+import stitch.graph as graph
+import stitch.manifest as manifest
+import stitch.parsecache as parsecache
+import stitch.paths as paths
+import stitch.propstack as propstack
+import stitch.signore as signore
+import stitch.targets.target as target
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+WATCH_PID_FILENAME = "watch.pid"
+WATCH_BUSY_FILENAME = "watch.busy"
+
+# seconds between polls when inotify is not available
+DEFAULT_POLL_INTERVAL = 1.0
+
+# seconds to wait after a change for related changes (e.g., an editor
+# writing several files) before regenerating
+SETTLE_TIME = 0.2
+
+
+def get_pid_filename():
+  return os.path.join(parsecache.get_cache_dir(), WATCH_PID_FILENAME)
+
+def get_busy_filename():
+  return os.path.join(parsecache.get_cache_dir(), WATCH_BUSY_FILENAME)
+
+
+def reset_state(parseCache):
+  """ Reset the global state built up by loading the Targets files and
+      generating the build, so they can be loaded again in this process. """
+  target.resetTargetMap()
+  target.resetMacros()
+  graph.setBuildGraph(None)
+  paths.invalidatePathCache()
+  signore.reset()
+  propstack.reset_properties()
+  buildfile.reset_extensions()
+  antgenerator.resetAntGenerator()
+  parseCache.refresh()
+  fragmentCache = antgenerator.getFragmentCache()
+  if fragmentCache != None:
+    fragmentCache.refresh()
+
+
+def changed_files(old, new):
+  """ Return the sorted list of files whose snapshots differ """
+  changed = []
+  for file in new:
+    if old.get(file) != new[file]:
+      changed.append(file)
+  changed.sort()
+  return changed
+
+
+class PollingWatcher(object):
+  """ Waits for changes to a set of files by stat()ing them periodically """
+
+  def __init__(self, interval=DEFAULT_POLL_INTERVAL):
+    self.interval = interval
+    self.files = []
+
+  def set_files(self, files):
+    self.files = files
+
+  def wait(self):
+    """ Block until something may have changed """
+    time.sleep(self.interval)
+
+  def close(self):
+    pass
+
+
+class InotifyWatcher(object):
+  """ Waits for changes to a set of files using inotify, by watching
+      the directories that contain them. """
+
+  def __init__(self):
+    self.watch_manager = pyinotify.WatchManager()
+    self.notifier = pyinotify.Notifier(self.watch_manager)
+    self.watched_dirs = {}
+    self.mask = pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB \
+        | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE \
+        | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM \
+        | pyinotify.IN_MOVED_TO
+
+  def set_files(self, files):
+    for file in files:
+      if os.path.isdir(file):
+        dir = file
+      else:
+        dir = os.path.dirname(file)
+      if not self.watched_dirs.has_key(dir) and os.path.isdir(dir):
+        self.watched_dirs[dir] = self.watch_manager.add_watch(dir, self.mask)
+
+  def wait(self):
+    """ Block until an event arrives in one of the watched directories """
+    while not self.notifier.check_events(None):
+      pass
+    self.notifier.read_events()
+    self.notifier.process_events()
+
+  def close(self):
+    self.notifier.stop()
+
+
+def make_watcher():
+  if pyinotify != None:
+    try:
+      return InotifyWatcher()
+    except Exception, e:
+      print "Warning: Could not use inotify (" + str(e) + "); polling instead"
+  return PollingWatcher()
+
+
+def write_marker(filename, contents):
+  handle = open(filename, "w")
+  try:
+    handle.write(contents)
+  finally:
+    handle.close()
+
+
+def remove_marker(filename):
+  try:
+    os.remove(filename)
+  except OSError:
+    pass
+
+
+def watch(regenerate, parseCache, watchedFiles):
+  """ Watch watchedFiles and call regenerate() whenever one changes, until
+      interrupted. regenerate() loads the Targets files and generates the
+      build; it returns the list of BuildFile objects it loaded. """
+
+  cache_dir = parsecache.get_cache_dir()
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  pid_filename = os.path.abspath(get_pid_filename())
+  busy_filename = os.path.abspath(get_busy_filename())
+  write_marker(pid_filename, str(os.getpid()))
+
+  watcher = make_watcher()
+  try:
+    watcher.set_files(watchedFiles)
+    state = manifest.snapshot(watchedFiles)
+    print "Watching", len(watchedFiles), "files for changes. Press ^C to stop."
+
+    while True:
+      watcher.wait()
+      changed = changed_files(state, manifest.snapshot(watchedFiles))
+      if len(changed) == 0:
+        continue
+
+      write_marker(busy_filename, str(os.getpid()))
+      try:
+        # Let a burst of writes finish before we look at the files.
+        time.sleep(SETTLE_TIME)
+        for file in changed:
+          print "Changed:", file
+
+        before = manifest.snapshot(watchedFiles)
+        reset_state(parseCache)
+        try:
+          buildFileObjects = regenerate()
+          watchedFiles = manifest.get_input_files(buildFileObjects)
+        except (Exception, SystemExit), e:
+          # Keep watching the same files; the user will fix the error.
+          print "Error: Could not regenerate the build:", e
+        watcher.set_files(watchedFiles)
+
+        # Compare against the files as they were before we regenerated,
+        # so that changes made in the meantime are picked up next time.
+        state = manifest.snapshot(watchedFiles)
+        for file in state.keys():
+          if before.has_key(file):
+            state[file] = before[file]
+      finally:
+        remove_marker(busy_filename)
+  except KeyboardInterrupt:
+    print "Stopped watching."
+  finally:
+    watcher.close()
+    remove_marker(busy_filename)
+    remove_marker(pid_filename)
+
+  return 0